@@ -0,0 +1,353 @@
+"""
+Local stand-ins for Azure, the Kubernetes API, helm and the event collector, used by `pdm run bench-deploy`.
+
+Run as `python -m benchmarks.fakes <chart-builder arguments>` to run chart-builder with the
+fake Azure SDK installed. The other fakes are started by the benchmark and found through
+the environment.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import gzip
+import json
+import os
+import re
+import stat
+import sys
+import threading
+import time
+import types
+import yaml
+
+#----------------------------------------
+# Fake Azure SDK
+#----------------------------------------
+
+def _latency(name: str) -> None:
+    time.sleep(float(os.environ.get(name) or 0))
+
+class FakeCredential():
+
+    def __init__(self, tenant_id, client_id, client_secret, **kwargs) -> None:
+        self.token = None
+
+    def get_token(self, *scopes, **kwargs):
+        """A real credential fetches its token on first use and then reuses it."""
+        if self.token is None:
+            _latency("FAKE_AZURE_TOKEN_LATENCY")
+            self.token = types.SimpleNamespace(token="token", expires_on=int(time.time()) + 3600)
+        return self.token
+
+class FakeResourceGroups():
+
+    def __init__(self, credential, subscription_id) -> None:
+        self.credential = credential
+        self.subscription_id = subscription_id
+
+    def check_existence(self, resource_group) -> bool:
+        self.credential.get_token("https://management.azure.com/.default")
+        _latency("FAKE_AZURE_LATENCY")
+        return self.subscription_id == os.environ["FAKE_AZURE_MATCH"]
+
+class FakeResourceManagementClient():
+
+    def __init__(self, credential, subscription_id) -> None:
+        self.resource_groups = FakeResourceGroups(credential, subscription_id)
+
+class FakeSubscriptions():
+
+    def __init__(self, credential) -> None:
+        self.credential = credential
+
+    def list(self):
+        self.credential.get_token("https://management.azure.com/.default")
+        count = int(os.environ.get("FAKE_AZURE_SUBSCRIPTIONS") or 1)
+
+        # ARM pages subscriptions 100 at a time
+        for index in range(count):
+            if index % 100 == 0:
+                _latency("FAKE_AZURE_LATENCY")
+            yield types.SimpleNamespace(subscription_id=f"sub-{index}")
+
+class FakeSubscriptionClient():
+
+    def __init__(self, credential) -> None:
+        self.subscriptions = FakeSubscriptions(credential)
+
+class FakeManagedClusters():
+
+    def __init__(self, credential) -> None:
+        self.credential = credential
+
+    def list_cluster_admin_credentials(self, resource_group, cluster):
+        self.credential.get_token("https://management.azure.com/.default")
+        _latency("FAKE_AZURE_LATENCY")
+        value = yaml.safe_dump(admin_kubeconfig(cluster, os.environ["FAKE_KUBE_SERVER"])).encode("utf-8")
+        return types.SimpleNamespace(kubeconfigs=[types.SimpleNamespace(value=value)])
+
+class FakeContainerServiceClient():
+
+    def __init__(self, credential, subscription_id) -> None:
+        self.managed_clusters = FakeManagedClusters(credential)
+
+def install_fake_azure() -> None:
+    """Replace the Azure SDK modules chart-builder imports with the fakes above."""
+    modules = {
+        "azure.identity": {"ClientSecretCredential": FakeCredential},
+        "azure.mgmt.resource": {"ResourceManagementClient": FakeResourceManagementClient},
+        "azure.mgmt.subscription": {"SubscriptionClient": FakeSubscriptionClient},
+        "azure.mgmt.containerservice": {"ContainerServiceClient": FakeContainerServiceClient},
+    }
+    for name, attributes in modules.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+
+def admin_kubeconfig(cluster: str, server: str) -> dict:
+    return {
+        "apiVersion": "v1",
+        "kind": "Config",
+        "clusters": [{"name": cluster, "cluster": {"server": server}}],
+        "users": [{"name": f"clusterAdmin_rg-do-{cluster}_{cluster}", "user": {"token": "fake"}}],
+        "contexts": [{"name": cluster, "context": {"cluster": cluster, "user": f"clusterAdmin_rg-do-{cluster}_{cluster}"}}],
+        "current-context": cluster,
+    }
+
+#----------------------------------------
+# Fake Kubernetes API server
+#----------------------------------------
+
+def _selected(item: dict, query: dict) -> bool:
+    """Whether an object matches the metadata.name field selector and equality label selectors of a list request."""
+    metadata = item.get("metadata") or {}
+    for requirement in filter(None, query.get("fieldSelector", [""])[0].split(",")):
+        if requirement != f'metadata.name={metadata.get("name")}':
+            return False
+    labels = metadata.get("labels") or {}
+    for requirement in filter(None, query.get("labelSelector", [""])[0].split(",")):
+        key, _, value = requirement.partition("=")
+        if labels.get(key) != value:
+            return False
+    return True
+
+class FakeKubernetesHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    routes = [
+        ("version", re.compile(r"^/version$")),
+        ("groups", re.compile(r"^/apis$")),
+        ("group", re.compile(r"^/apis/scheduling.k8s.io/v1$")),
+        ("cluster object", re.compile(r"^/apis/scheduling.k8s.io/v1/(?P<kind>priorityclasses)/(?P<name>[^/]+)$")),
+        ("api", re.compile(r"^/api/v1$")),
+        ("namespaces", re.compile(r"^/api/v1/namespaces$")),
+        ("namespace", re.compile(r"^/api/v1/namespaces/(?P<name>[^/]+)$")),
+        ("all", re.compile(r"^/api/v1/(?P<kind>secrets|configmaps)$")),
+        ("objects", re.compile(r"^/api/v1/namespaces/(?P<namespace>[^/]+)/(?P<kind>secrets|configmaps|serviceaccounts|resourcequotas)$")),
+        ("object", re.compile(r"^/api/v1/namespaces/(?P<namespace>[^/]+)/(?P<kind>secrets|configmaps|serviceaccounts|resourcequotas)/(?P<name>[^/]+)$")),
+    ]
+    kinds = {"secrets": "Secret", "configmaps": "ConfigMap", "serviceaccounts": "ServiceAccount", "resourcequotas": "ResourceQuota"}
+
+    # Discovery documents for the kinds above, plus one cluster-scoped kind outside the core group
+    core_resources = [{"name": "namespaces", "kind": "Namespace", "namespaced": False, "verbs": ["get", "list", "patch"]}] + [
+        {"name": name, "kind": kind, "namespaced": True, "verbs": ["get", "list", "patch"]} for name, kind in kinds.items()]
+    scheduling_group = {"name": "scheduling.k8s.io", "versions": [{"groupVersion": "scheduling.k8s.io/v1", "version": "v1"}],
+        "preferredVersion": {"groupVersion": "scheduling.k8s.io/v1", "version": "v1"}}
+
+    def _route(self):
+        url = urlparse(self.path)
+        for name, pattern in self.routes:
+            match = pattern.match(url.path)
+            if match:
+                return name, match.groupdict(), parse_qs(url.query)
+        return None, {}, {}
+
+    def _body(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _respond(self, code: int, document: dict) -> None:
+        body = json.dumps(document).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_found(self) -> None:
+        self._respond(404, {"kind": "Status", "apiVersion": "v1", "status": "Failure", "reason": "NotFound", "code": 404})
+
+    def _handle(self, method: str) -> None:
+        _latency("FAKE_KUBE_LATENCY")
+
+        # Read the body even when it is not used, the connection is kept alive for the next request
+        body = self._body()
+        route, parts, query = self._route()
+        self.server.count(f"{method} {route}")
+        objects = self.server.objects
+
+        if route == "version" and method == "GET":
+            self._respond(200, {"major": "1", "minor": "30", "gitVersion": "v1.30.0"})
+
+        elif route == "groups" and method == "GET":
+            self._respond(200, {"kind": "APIGroupList", "apiVersion": "v1", "groups": [self.scheduling_group]})
+
+        elif route == "group" and method == "GET":
+            self._respond(200, {"kind": "APIResourceList", "groupVersion": "scheduling.k8s.io/v1", "resources": [
+                {"name": "priorityclasses", "kind": "PriorityClass", "namespaced": False, "verbs": ["get", "list", "patch"]}]})
+
+        elif route == "cluster object" and method == "PATCH":
+            objects[(parts["kind"], "", parts["name"])] = body
+            self._respond(200, body)
+
+        elif route == "api" and method == "GET":
+            self._respond(200, {"kind": "APIResourceList", "groupVersion": "v1", "resources": self.core_resources})
+
+        elif route == "namespaces" and method == "GET":
+            items = [item for key, item in objects.items() if key[0] == "namespaces" and _selected(item, query)]
+            self._respond(200, {"kind": "NamespaceList", "apiVersion": "v1", "metadata": {}, "items": items})
+
+        elif route == "namespaces" and method == "POST":
+            document = dict(body, kind="Namespace", apiVersion="v1")
+            objects[("namespaces", "", document["metadata"]["name"])] = document
+            self._respond(201, document)
+
+        elif route == "namespace" and method == "PATCH":
+            document = dict(body, kind="Namespace", apiVersion="v1")
+            objects[("namespaces", "", parts["name"])] = document
+            self._respond(200, document)
+
+        elif route == "all" and method == "GET":
+            self._respond(200, {"kind": self.kinds[parts["kind"]] + "List", "apiVersion": "v1", "metadata": {}, "items": [
+                item for key, item in objects.items() if key[0] == parts["kind"] and _selected(item, query)]})
+
+        elif route == "objects" and method == "GET":
+            self._respond(200, {"kind": self.kinds[parts["kind"]] + "List", "apiVersion": "v1", "metadata": {}, "items": [
+                item for key, item in objects.items() if key[:2] == (parts["kind"], parts["namespace"]) and "labelSelector" not in query]})
+
+        elif route == "objects" and method == "POST":
+            document = dict(body, kind=self.kinds[parts["kind"]], apiVersion="v1")
+            objects[(parts["kind"], parts["namespace"], document["metadata"]["name"])] = document
+            self._respond(201, document)
+
+        elif route == "object":
+            key = (parts["kind"], parts["namespace"], parts["name"])
+            if method == "GET":
+                self._respond(200, objects[key]) if key in objects else self._not_found()
+            elif method == "PUT" and key not in objects:
+                self._not_found()
+            elif method in ("PUT", "PATCH"):
+                objects[key] = dict(body, kind=self.kinds[parts["kind"]], apiVersion="v1")
+                self._respond(200, objects[key])
+            else:
+                self._not_found()
+        else:
+            self._not_found()
+
+    def do_GET(self) -> None:
+        self._handle("GET")
+
+    def do_POST(self) -> None:
+        self._handle("POST")
+
+    def do_PUT(self) -> None:
+        self._handle("PUT")
+
+    def do_PATCH(self) -> None:
+        self._handle("PATCH")
+
+    def log_message(self, format, *args) -> None: # pylint: disable=redefined-builtin
+        pass
+
+class CountingServer(ThreadingHTTPServer):
+    """Loopback HTTP server on a free port, counting requests by kind."""
+
+    daemon_threads = True
+
+    def __init__(self, handler) -> None:
+        super().__init__(("127.0.0.1", 0), handler)
+        self.counts = {}
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, name: str, amount: int=1) -> None:
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.shutdown()
+        self.server_close()
+
+def fake_kubernetes() -> CountingServer:
+    return CountingServer(FakeKubernetesHandler)
+
+#----------------------------------------
+# Fake event collector
+#----------------------------------------
+
+class FakeCollectorHandler(BaseHTTPRequestHandler):
+    """Accepts New Relic style gzip JSON arrays of events."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self) -> None:
+        _latency("FAKE_COLLECTOR_LATENCY")
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        self.server.count("requests")
+        self.server.count("events", len(json.loads(body)))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args) -> None: # pylint: disable=redefined-builtin
+        pass
+
+def fake_collector() -> CountingServer:
+    return CountingServer(FakeCollectorHandler)
+
+#----------------------------------------
+# Fake helm and chart
+#----------------------------------------
+
+def write_fake_helm(directory: str) -> str:
+    """A helm executable that takes FAKE_HELM_LATENCY seconds and prints what helm upgrade prints. Returns its directory."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "helm")
+    with open(path, "w") as stream:
+        stream.write(f"""#!{sys.executable}
+import os, sys, time
+time.sleep(float(os.environ.get("FAKE_HELM_LATENCY") or 0))
+release = sys.argv[4] if len(sys.argv) > 4 else "release"
+print(f'Release "{{release}}" has been upgraded. Happy Helming!')
+print(f"NAME: {{release}}")
+print("STATUS: deployed")
+print("REVISION: 2")
+""")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return directory
+
+def write_chart(directory: str) -> str:
+    os.makedirs(os.path.join(directory, "templates"), exist_ok=True)
+    with open(os.path.join(directory, "Chart.yaml"), "w") as stream:
+        yaml.safe_dump({"apiVersion": "v2", "name": "bench", "version": "0.1.0"}, stream)
+    with open(os.path.join(directory, "values.yaml"), "w") as stream:
+        yaml.safe_dump({"replicaCount": 1, "image": {"repository": "nginx", "tag": "stable"}}, stream)
+    return directory
+
+if __name__ == "__main__":
+    install_fake_azure()
+
+    from chart.builder.__main__ import run
+    run()
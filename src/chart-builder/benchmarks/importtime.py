@@ -0,0 +1,61 @@
+"""Reports what importing chart-builder costs, from `python -X importtime`. Run with `pdm run bench-import`."""
+
+from argparse import ArgumentParser
+
+import os
+import subprocess
+import sys
+
+# GLOBAL VARIABLES
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def import_times(module: str="chart.builder.__main__") -> tuple:
+    """
+    Time a fresh interpreter spends importing module, in microseconds, and how it splits by top-level package.
+
+    return (total, {package: microseconds})
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=root, capture_output=True, text=True, check=True)
+
+    # import time: self [us] | cumulative | imported package, nesting shown by indentation
+    rows = []
+    for line in result.stderr.splitlines():
+        fields = line[len("import time:"):].split("|")
+        if not line.startswith("import time:") or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((depth, name.strip(), int(fields[1])))
+
+    # Rows come out after their children, the parent of a row is the next one out a level up
+    total = 0
+    packages = {}
+    parents = {}
+    for depth, name, cumulative in reversed(rows):
+        parent = parents.get(depth - 1)
+        parents[depth] = name
+        package = name.split(".")[0]
+        if parent is None:
+            if package == module.split(".")[0]:
+                total += cumulative
+        elif parent.split(".")[0] == package:
+            continue
+        packages[package] = packages.get(package, 0) + cumulative
+    return total, packages
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--module", default="chart.builder.__main__")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    total, packages = import_times(args.module)
+    print(f"{'package':<30} {'ms':>10}")
+    for name, microseconds in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"{name:<30} {microseconds / 1000:>10.1f}")
+    print(f"{'total':<30} {total / 1000:>10.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""Times merging one cluster into kubeconfigs of growing size. Run with `pdm run bench-merge`."""
+
+from argparse import ArgumentParser
+
+from chart.builder.modules.kubeconfig import merge_kubeconfig
+
+import copy
+import timeit
+
+def kubeconfig(names: list) -> dict:
+    return {
+        "apiVersion": "v1",
+        "clusters": [{"name": name, "cluster": {"server": f"https://{name}:443", "certificate-authority-data": "x" * 1500}} for name in names],
+        "users": [{"name": f"clusterAdmin_{name}", "user": {"client-certificate-data": "x" * 2000, "client-key-data": "x" * 2000}} for name in names],
+        "contexts": [{"name": f"{name}-admin", "context": {"cluster": name, "user": f"clusterAdmin_{name}"}} for name in names],
+        "current-context": f"{names[-1]}-admin",
+    }
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--contexts", type=int, nargs="+", default=[10, 100, 500, 1000, 5000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'contexts':>10} {'merge ms':>10}")
+    for count in args.contexts:
+        existing = kubeconfig([f"aks-{index}" for index in range(count)])
+        addition = kubeconfig([f"aks-{count // 2}", "aks-new"])
+        seconds = min(timeit.repeat(lambda: merge_kubeconfig(copy.copy(existing), addition), number=1, repeat=args.repeat))
+        print(f"{count:>10} {seconds * 1000:>10.3f}")
+
+if __name__ == "__main__":
+    main()
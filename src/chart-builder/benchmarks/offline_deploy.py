@@ -0,0 +1,181 @@
+"""
+Runs the full deployment flow against local fakes of Azure, Kubernetes, helm and the event collector.
+Run with `pdm run bench-deploy`, add `--check` in CI to fail when a stage regresses.
+
+Every scenario runs chart-builder in a fresh process, like a pipeline job does. Per-stage
+latency and call counts come from the run's own trace (--trace-file).
+"""
+
+from argparse import ArgumentParser
+
+from benchmarks.fakes import fake_collector, fake_kubernetes, write_chart, write_fake_helm
+from benchmarks.kubeconfig_merge import kubeconfig
+from chart.builder.modules.process import run_streaming
+
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import yaml
+
+# GLOBAL VARIABLES
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+default_baseline = os.path.join(root, "benchmarks", "baseline.json")
+stages = ["credentials", "namespace", "registry", "package", "deploy"]
+
+#----------------------------------------
+# Helper Functions
+#----------------------------------------
+
+def scenario_name(subscriptions: int, contexts: int, batch: int) -> str:
+    return f"subscriptions={subscriptions},contexts={contexts},batch={batch}"
+
+def _spans(trace_file: str) -> list:
+    with open(trace_file) as stream:
+        document = json.load(stream)
+    return [span for resource in document["resourceSpans"] for scope in resource["scopeSpans"] for span in scope["spans"]]
+
+def _seconds(span: dict) -> float:
+    return (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e9
+
+def run_scenario(subscriptions: int, contexts: int, batch: int, latency: dict) -> dict:
+    """Run one deployment (or one batch of deployments) with fresh caches. Returns its measurements."""
+
+    with tempfile.TemporaryDirectory(prefix="chart-builder-bench-") as home, fake_kubernetes() as kubernetes, fake_collector() as collector:
+
+        # An existing kubeconfig of the requested size
+        os.makedirs(os.path.join(home, ".kube"))
+        with open(os.path.join(home, ".kube", "config"), "w") as stream:
+            yaml.safe_dump(kubeconfig([f"aks-existing-{index}" for index in range(max(contexts, 1))]), stream)
+
+        chart = write_chart(os.path.join(home, "chart"))
+        trace_file = os.path.join(home, "trace.json")
+        arguments = [
+            "--environment", "bench", "--reporting-platform", "newrelic",
+            "--clustername", "aks-bench", "--client-id", "client", "--client-secret", "secret", "--tenant", "tenant",
+            "--chart", chart, "--namespace", "bench",
+            "--pull-secret-name", "registry", "--docker-registry", "registry.example.com",
+            "--docker-username", "user", "--docker-password", "password",
+            "--trace-file", trace_file,
+        ]
+        if batch > 1:
+            batch_file = os.path.join(home, "batch.yaml")
+            with open(batch_file, "w") as stream:
+                yaml.safe_dump([{"release": f"app-{index}"} for index in range(batch)], stream)
+            arguments.extend(["--batch", batch_file])
+        else:
+            arguments.extend(["--release", "app-0"])
+
+        environment = dict(os.environ,
+            HOME=home,
+            CHART_BUILDER_CACHE_DIR=os.path.join(home, "cache"),
+            CHART_BUILDER_SUPPORTED_ENVIRONMENTS="bench",
+            PATH=write_fake_helm(os.path.join(home, "bin")) + os.pathsep + os.environ.get("PATH", ""),
+            FAKE_AZURE_SUBSCRIPTIONS=str(subscriptions),
+            FAKE_AZURE_MATCH=f"sub-{subscriptions - 1}",
+            FAKE_KUBE_SERVER=kubernetes.url,
+            NEW_RELIC_EVENTS_URL=collector.url,
+            NEW_RELIC_ACCOUNT_ID="0",
+            NEW_RELIC_INSERT_KEY="bench",
+            **{name: str(value) for name, value in latency.items()})
+
+        start = time.perf_counter()
+        result = run_streaming([sys.executable, "-m", "benchmarks.fakes", *arguments], env=environment, cwd=root)
+        wall = time.perf_counter() - start
+        if result.returncode:
+            raise Exception(f"{scenario_name(subscriptions, contexts, batch)} failed:\n{result.output}")
+
+        spans = _spans(trace_file)
+        calls = {}
+        for span in spans:
+            if span["kind"] == 3:
+                calls[span["name"]] = calls.get(span["name"], 0) + 1
+
+        return {
+            "wall": wall,
+            "stages": {stage: statistics.median([_seconds(span) for span in spans if span["name"] == f"stage.{stage}"] or [0]) for stage in stages},
+            "max_rss": result.max_rss,
+            "calls": calls,
+            "kubernetes_requests": sum(kubernetes.counts.values()),
+            "events_delivered": collector.counts.get("events", 0),
+        }
+
+def summarize(runs: list) -> dict:
+    """Median of every measurement across repeated runs."""
+    return {
+        "wall": statistics.median(run["wall"] for run in runs),
+        "stages": {stage: statistics.median(run["stages"][stage] for run in runs) for stage in stages},
+        "max_rss": max(run["max_rss"] or 0 for run in runs),
+        "calls": runs[-1]["calls"],
+        "kubernetes_requests": runs[-1]["kubernetes_requests"],
+        "events_delivered": runs[-1]["events_delivered"],
+    }
+
+def regressions(results: dict, baseline: dict, tolerance: float, slack: float) -> list:
+    """Stages slower than their baseline by more than tolerance (a fraction) plus slack seconds."""
+    found = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        for stage, seconds in list(result["stages"].items()) + [("wall", result["wall"])]:
+            limit = (expected["stages"].get(stage, 0) if stage != "wall" else expected["wall"]) * (1 + tolerance) + slack
+            if seconds > limit:
+                found.append(f"{name} {stage}: {seconds:.3f}s, limit {limit:.3f}s")
+    return found
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--subscriptions", type=int, nargs="+", default=[1, 50])
+    parser.add_argument("--contexts", type=int, nargs="+", default=[10, 1000])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--azure-latency", type=float, default=0.02, help="Seconds per ARM call.")
+    parser.add_argument("--token-latency", type=float, default=0.1, help="Seconds to fetch an AAD token.")
+    parser.add_argument("--kube-latency", type=float, default=0.005, help="Seconds per Kubernetes API call.")
+    parser.add_argument("--helm-latency", type=float, default=0.2, help="Seconds per helm run.")
+    parser.add_argument("--collector-latency", type=float, default=0.01, help="Seconds per event delivery.")
+    parser.add_argument("--baseline", default=default_baseline)
+    parser.add_argument("--check", action="store_true", help="Exit 1 when a stage is slower than the baseline allows.")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Allowed slowdown as a fraction of the baseline.")
+    parser.add_argument("--slack", type=float, default=0.1, help="Allowed slowdown in seconds on top of the tolerance.")
+    args = parser.parse_args()
+
+    latency = {
+        "FAKE_AZURE_LATENCY": args.azure_latency,
+        "FAKE_AZURE_TOKEN_LATENCY": args.token_latency,
+        "FAKE_KUBE_LATENCY": args.kube_latency,
+        "FAKE_HELM_LATENCY": args.helm_latency,
+        "FAKE_COLLECTOR_LATENCY": args.collector_latency,
+    }
+
+    print(f"{'scenario':<42} {'wall s':>8} " + " ".join(f"{stage + ' s':>13}" for stage in stages) + f" {'rss MB':>8} {'ARM':>5} {'k8s':>5} {'events':>6}")
+    results = {}
+    for subscriptions, contexts, batch in itertools.product(args.subscriptions, args.contexts, args.batch_sizes):
+        name = scenario_name(subscriptions, contexts, batch)
+        result = summarize([run_scenario(subscriptions, contexts, batch, latency) for _ in range(args.repeat)])
+        results[name] = result
+        arm_calls = sum(count for call, count in result["calls"].items() if call.startswith("azure."))
+        print(f"{name:<42} {result['wall']:>8.3f} " + " ".join(f"{result['stages'][stage]:>13.3f}" for stage in stages)
+            + f" {result['max_rss'] / 2**20:>8.1f} {arm_calls:>5} {result['kubernetes_requests']:>5} {result['events_delivered']:>6}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as stream:
+            json.dump(results, stream, indent=2, sort_keys=True)
+            stream.write("\n")
+        print(f"Baseline written to {args.baseline}")
+
+    if args.check:
+        with open(args.baseline) as stream:
+            found = regressions(results, json.load(stream), args.tolerance, args.slack)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        if found:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,35 @@
 """Logs into Platform hosting Kubernetes to generate a kubeconfig for Helm to install charts."""
 
 from logging import Logger
+import atexit
+import os
+import sys
 import timeit
 import traceback
 
 from datetime import timedelta
 from rich.console import Console
+from rich.markup import escape
+from rich.table import Table
+from rich import box
 
-from chart.builder.modules.arguments import get_parser
+from chart.builder.modules.arguments import get_batch_parser, get_output_parser, get_parser, get_pull_secrets_parser, get_serve_parser
+from chart.builder.modules.batch import BatchJob, BatchRunner, ClusterConnections, batch_arguments, connection_key, expand_clusters, load_batch
+from chart.builder.modules.cache import cache_directory
 from chart.builder.modules.clusteroperations import ManagedClusterOperationsFactory
-from chart.builder.modules.clusterservices import ManagedClusterServicesFactory
+from chart.builder.modules.clusterservices import ManagedClusterServicesFactory, load_manifests
+from chart.builder.modules.fingerprint import release_fingerprint
+from chart.builder.modules.kubeconfig import default_path as default_kubeconfig
+from chart.builder.modules.output import bind, bind_output, console as shared_console, event, fields, job_output, set_output
 from chart.builder.modules.packagemanager import PackageManagerFactory
+from chart.builder.modules.preflight import preflight
 from chart.builder.modules.reportingservices import ReportingServicesFactory
+from chart.builder.modules.rollout import duration_seconds, utc_now
+from chart.builder.modules.stages import Stage, StageExecutor, set_demo_mode
+from chart.builder.modules.tracing import export_spans, start_span
 
 
-def main(args: object, console: object, reporter: object) -> None:
+def main(args: object, console: object, reporter: object, connections: object=None, progress=None) -> bool:
     """
     Logs into platform hosting kubernetes, generates a kubeconfig, and installs a helm chart.
 
@@ -27,63 +42,203 @@ def main(args: object, console: object, reporter: object) -> None:
     :param log: An instantiated 'Reporter' class
     :type reporter: object
 
-    return None
+    :param connections: An instantiated 'ClusterConnections' class, shares credentials between deployments to one cluster
+    :type connections: object
+
+    :param progress: Called with the stage name and "started", "finished" or "failed" as stages run
+    :type progress: function
+
+    return "deployed" or "no-op" when the deployment succeeded, False when it failed
     """
 
+    # Trace the deployment, stages and outbound calls become its child spans
+    deployment = start_span("deploy", release=args.helm_release, cluster=args.cluster, namespace=args.helm_namespace)
+    executor = None
+
+    # Every ndjson event of the deployment names it
+    output_fields = bind(release=args.helm_release, cluster=args.cluster, namespace=args.helm_namespace)
+
     try:
 
         # Start Timer
         start_time = timeit.default_timer()
 
+        # Cosmetic pauses only in demo mode
+        set_demo_mode(args.demo)
+
         # Print Console
         console.print("Running [italic bold]chart-builder[white]...")
         
-        # Cluster Operations
+        # Cluster Operations, Cluster Services, Package Manager
         managed_cluster_operations = ManagedClusterOperationsFactory().get("azure")
-        managed_cluster_operations.build_cluster_admin_credentials(
-            args.resource_group,
-            args.cluster,
-            args.tenant_id,
-            args.client_id,
-            args.client_secret)
-
-        # Cluster Services - build namespace, build registry credentials
         managed_cluster_services = ManagedClusterServicesFactory().get("azure")
-        managed_cluster_services.build_namespace(args.helm_namespace)
-        managed_cluster_services.build_registery_credentials(
-            name=args.pull_secret_name,
-            registry=args.docker_registry,
-            username=args.docker_username,
-            password=args.docker_password,
-            namespace=args.helm_namespace)
-
-        # # Package Manager - build package, deploy package
         package_manager = PackageManagerFactory().get("helm")
-        package = package_manager.build(
-            release=args.helm_release,
-            chart=args.helm_chart,
-            namespace=args.helm_namespace,
-            version=args.helm_version,
-            repository=args.helm_repository,
-            values=args.helm_values,
-            sets=args.helm_sets,
-            atomic=args.helm_atomic,
-            timeout=args.helm_timeout,
-            wait=args.helm_wait)     
-        package_manager.deploy(package)
-
-        # Post event to reporter
-        reporter.post_event(service=args.app_name, env=args.environment, version=args.app_version, team=args.app_team)
+
+        # Cluster Operations - build kubeconfig, once per cluster when connections are shared
+        def build_credentials():
+            return managed_cluster_operations.build_cluster_admin_credentials(
+                args.resource_group,
+                args.cluster,
+                args.tenant_id,
+                args.client_id,
+                args.client_secret,
+                subscription_id=args.subscription_id,
+                subscription_index_ttl=args.subscription_index_ttl,
+                credential_expiry_margin=args.credential_expiry_margin,
+                pool_size=args.kube_pool_size,
+                isolated=args.isolated_kubeconfig,
+                token_cache=args.token_cache)
+
+        if connections is not None:
+            cluster_key = connection_key(args)
+            credentials = lambda: connections.get(cluster_key, build_credentials)
+        else:
+            credentials = build_credentials
+
+        # Package Manager - deploy package, skipped when the release fingerprint is unchanged
+        deployed_at = {}
+        def deploy():
+            command = executor.results["package"]
+            connection = executor.results["credentials"]
+            fingerprint = release_fingerprint(command)
+
+            # Pods created before the upgrade are not part of its rollout, allow for clock skew with the API server
+            deployed_at["time"] = utc_now() - timedelta(seconds=5)
+
+            if fingerprint is not None and not args.force:
+                if managed_cluster_services.get_release_fingerprint(args.helm_release, args.helm_namespace, connection.api_client) == fingerprint:
+                    console.print(f'[bright_green]:heavy_check_mark:[/] [white]Release[/] [bright_green]"{args.helm_release}"[/] [white]is unchanged, skipping package manager[/]')
+                    return "no-op"
+
+            package_manager.deploy(
+                command,
+                context=connection.context,
+                fail_patterns=args.helm_fail_patterns,
+                kubeconfig=connection.kubeconfig,
+                label=f"{args.helm_release}@{args.cluster}" if connections is not None else None)
+
+            # With a rollout watch the release is only known good, and its fingerprint recorded, once its workloads are ready
+            if fingerprint is not None and not args.rollout_watch:
+                managed_cluster_services.set_release_fingerprint(args.helm_release, args.helm_namespace, fingerprint, connection.api_client)
+            return "deployed"
+
+        # Cluster Services - watch the release's workloads instead of helm --wait, roll back a failed release like --atomic
+        def rollout():
+            if executor.results["deploy"] != "deployed":
+                return None
+            connection = executor.results["credentials"]
+            try:
+                managed_cluster_services.watch_rollout(
+                    args.helm_release,
+                    args.helm_namespace,
+                    selector=args.rollout_selector,
+                    timeout=duration_seconds(args.helm_timeout),
+                    since=deployed_at["time"],
+                    label=f"{args.helm_release}@{args.cluster}" if connections is not None else None,
+                    api_client=connection.api_client)
+            except Exception as err:
+                if args.helm_atomic is not None:
+
+                    # The rollout failure is what the user needs to see, a failed rollback is attached as its cause
+                    try:
+                        package_manager.rollback(args.helm_release, args.helm_namespace, context=connection.context, path=connection.kubeconfig)
+                    except Exception as rollback_error: # pylint: disable=broad-except
+                        raise err from rollback_error
+                raise
+
+            fingerprint = release_fingerprint(executor.results["package"])
+            if fingerprint is not None:
+                managed_cluster_services.set_release_fingerprint(args.helm_release, args.helm_namespace, fingerprint, connection.api_client)
+            return "ready"
+
+        # Stages - run concurrently once the stages they require have finished, after the preflight check when it is enabled
+        checked = ["preflight"] if args.preflight else []
+        executor = StageExecutor([
+
+            # Preflight - catch bad values before any network call
+            *([Stage("preflight", lambda: preflight(
+                chart=args.helm_chart,
+                repository=args.helm_repository,
+                version=args.helm_version,
+                values=args.helm_values,
+                sets=args.helm_sets,
+                chart_cache=args.chart_cache,
+                chart_cache_ttl=args.chart_cache_ttl,
+                chart_cache_size=args.chart_cache_size))] if args.preflight else []),
+
+            # Cluster Operations - build kubeconfig
+            Stage("credentials", credentials, requires=checked),
+
+            # Cluster Services - apply namespace, then registry credentials and other prerequisites that live in it
+            Stage("namespace", lambda: managed_cluster_services.build_namespace(
+                args.helm_namespace,
+                api_client=executor.results["credentials"].api_client),
+                requires=["credentials"]),
+            Stage("registry", lambda: managed_cluster_services.build_registery_credentials(
+                name=args.pull_secret_name,
+                registry=args.docker_registry,
+                username=args.docker_username,
+                password=args.docker_password,
+                namespace=args.helm_namespace,
+                api_client=executor.results["credentials"].api_client),
+                requires=["namespace"]),
+            Stage("prerequisites", lambda: managed_cluster_services.build_prerequisites(
+                args.helm_namespace,
+                load_manifests(args.prerequisites),
+                api_client=executor.results["credentials"].api_client),
+                requires=["namespace"]),
+
+            # Package Manager - build package, does not need the cluster
+            Stage("package", lambda: package_manager.build(
+                release=args.helm_release,
+                chart=args.helm_chart,
+                namespace=args.helm_namespace,
+                version=args.helm_version,
+                repository=args.helm_repository,
+                values=args.helm_values,
+                sets=args.helm_sets,
+                atomic=args.helm_atomic if not args.rollout_watch else None,
+                timeout=args.helm_timeout,
+                wait=args.helm_wait if not args.rollout_watch else None,
+                chart_cache=args.chart_cache,
+                chart_cache_ttl=args.chart_cache_ttl,
+                chart_cache_size=args.chart_cache_size,
+                path=None if args.isolated_kubeconfig else default_kubeconfig),
+                requires=checked),
+
+            # Package Manager - deploy package
+            Stage("deploy", deploy, requires=["package", "registry", "prerequisites"]),
+
+            # Cluster Services - watch the rollout
+            *([Stage("rollout", rollout, requires=["deploy"])] if args.rollout_watch else []),
+        ], on_stage=progress)
+        result = executor.run()["deploy"]
+        deployment.set(result=result)
+        deployment.end()
+
+        # Post event to reporter, with the duration of every stage
+        if result == "no-op":
+            reporter.post_event(service=args.app_name, env=args.environment, version=args.app_version, team=args.app_team, cluster=args.cluster,
+                event_message="No changes since the last deployment, package manager skipped.", event_status="info", result=result, **stage_durations(executor))
+        else:
+            reporter.post_event(service=args.app_name, env=args.environment, version=args.app_version, team=args.app_team, cluster=args.cluster,
+                result=result, **stage_durations(executor))
 
         # Record elapsed time
         elapsed_time = timeit.default_timer() - start_time
         console.print(f"[white]Summary:[/] [bright_green]{timedelta(seconds=elapsed_time)}[/]")
+        event("deploy", status=result, seconds=round(elapsed_time, 3))
+        return result
 
-    except Exception: # pylint: disable=broad-except
+    except Exception as err: # pylint: disable=broad-except
+        if deployment.end_time is None:
+            deployment.end(err)
         
         # Record elapsed time
         elapsed_time = timeit.default_timer() - start_time
         console.print(f"[white]Summary:[/] [bright_green]{timedelta(seconds=elapsed_time)}[/]")
+        event("deploy", status="failed", seconds=round(elapsed_time, 3), error=str(err) or type(err).__name__)
+        event("error", message=str(err) or type(err).__name__, traceback=traceback.format_exc())
 
         # Post error to reporter
         event_message = f'An operation failed:\n{traceback.format_exc()}'
@@ -93,20 +248,261 @@ def main(args: object, console: object, reporter: object) -> None:
             event_message=event_message,
             version=args.app_version,
             team=args.app_team,
-            event_status="error")
+            cluster=args.cluster,
+            event_status="error",
+            result="failed",
+            **stage_durations(executor))
+        return False
 
-if __name__ == "__main__":
+    finally:
+        fields.reset(output_fields)
+
+def stage_durations(executor: object) -> dict:
+    """Seconds each stage took, as reporter event attributes such as stage_deploy_seconds."""
+    if executor is None:
+        return {}
+    return {f"stage_{name}_seconds": round(seconds, 3) for name, seconds in executor.durations.items()}
+
+def deploy_all(deployments: list, console: object, max_workers: int=None, cluster_concurrency: int=None) -> bool:
+    """
+    Runs deployments in parallel, sharing credentials per cluster, and prints one summary table.
+
+    :param deployments: Instantiated 'argparse.Namespace' classes, one per deployment.
+    :type deployments: list
+
+    :param console: An instantiated 'rich.console' class
+    :type console: object
+
+    return True when every deployment succeeded
+    """
+
+    reporting_services = ReportingServicesFactory(deployments[0].report_flush_timeout if deployments else None)
+    if deployments:
+        atexit.register(export_spans, deployments[0].trace_file, deployments[0].metrics_file)
+    connections = ClusterConnections()
+    jobs = [
+        BatchJob(args.helm_release, args.cluster,
+            lambda args=args: main(args, console, reporting_services.get(args.reporting_platform), connections))
+        for args in deployments
+    ]
+    BatchRunner(max_workers, cluster_concurrency).run(jobs)
+
+    # Summary Table
+    table = Table(box=box.SIMPLE)
+    for column in ("Release", "Cluster", "Namespace", "Status", "Duration"):
+        table.add_column(column)
+    for job, args in zip(jobs, deployments):
+        outcome = f"[bright_green]{job.result}[/]" if job.succeeded else "[red]failed[/]"
+        table.add_row(job.name, job.cluster, args.helm_namespace, outcome, str(timedelta(seconds=job.seconds)))
+    console.print(table)
+
+    return all(job.succeeded for job in jobs)
+
+def batch(batch_args: object, arguments: list, console: object) -> bool:
+    """
+    Runs every deployment of a batch file in one process.
+
+    :param batch_args: The parsed batch options.
+    :type batch_args: object
+
+    :param arguments: Command line arguments applied to every deployment.
+    :type arguments: list
+
+    :param console: An instantiated 'rich.console' class
+    :type console: object
+
+    return True when every deployment succeeded
+    """
+
+    # Parse every deployment before running any, a bad entry fails the whole batch up front
+    deployments = []
+    for entry in load_batch(batch_args.batch):
+        args, unknown_args = get_parser().parse_known_args(arguments + batch_arguments(entry))
+        if unknown_args:
+            console.print(f"[yellow]Unrecognized arguments:[/] [white italic]{unknown_args}[/]")
+        deployments.extend(expand_clusters(args))
 
-    # Get Logger
-    console = Console(color_system="standard")
+    return deploy_all(deployments, console, batch_args.batch_workers, batch_args.batch_cluster_concurrency)
+
+def serve(serve_args: object, arguments: list, console: object) -> None:
+    """
+    Runs deploy jobs sent to a local job API until interrupted.
+
+    Cluster connections, Azure credentials, parsed kubeconfigs and reporter sessions stay
+    warm between jobs.
+
+    :param serve_args: The parsed serve options.
+    :type serve_args: object
+
+    :param arguments: Command line arguments applied to every job.
+    :type arguments: list
+
+    :param console: An instantiated 'rich.console' class
+    :type console: object
+    """
+
+    # Only the agent needs the HTTP server, keep it out of every other run's start-up
+    from chart.builder.modules.agent import DeployAgent, JobOutput, make_server
+
+    reporting_services = ReportingServicesFactory()
+    connections = ClusterConnections(ttl=3600 if serve_args.connection_ttl is None else serve_args.connection_ttl)
+
+    # A job is a mapping of option names, like a batch entry, or {"args": [...]}
+    def parse(document: dict):
+        job_arguments = document["args"] if "args" in document else batch_arguments(document)
+        args, unknown_args = get_parser().parse_known_args(arguments + [str(argument) for argument in job_arguments])
+        if unknown_args:
+            raise ValueError(f"Unrecognized arguments: {unknown_args}")
+        deployments = expand_clusters(args) if args.cluster is not None or args.cluster_group is not None else []
+        if len(deployments) != 1:
+            raise ValueError("A job deploys to exactly one cluster, set clustername")
+        args = deployments[0]
+
+        def run_job(job):
+            job_console = Console(file=JobOutput(job), color_system=None, width=120)
+
+            # Every module prints through the shared console, bind it to this job so its client sees them.
+            # Stage events come from the progress callback, in the format job clients already read
+            output = bind_output(job_console, on_event=lambda document: document["event"] == "stage" or job.emit(document))
+            try:
+                return main(args, job_console, reporting_services.get(args.reporting_platform), connections,
+                    progress=lambda stage, state: job.emit({"event": "stage", "stage": stage, "state": state}))
+            finally:
+                job_output.reset(output)
+                export_spans(args.trace_file, args.metrics_file)
+
+        return args.helm_release, args.cluster, run_job
+
+    agent = DeployAgent(serve_args.serve_workers, serve_args.serve_cluster_concurrency)
+    socket_path = serve_args.socket or os.path.join(cache_directory(), "agent.sock")
+    server = make_server(agent, parse, socket_path=socket_path, port=serve_args.port)
+
+    address = f"http://127.0.0.1:{serve_args.port}" if serve_args.port is not None else socket_path
+    console.print(f"[white]chart-builder agent listening on[/] [bright_green]{address}[/]")
+    if serve_args.port is not None:
+        console.print(f"[white]Requests need the bearer token in[/] [bright_green]{os.path.join(cache_directory(), 'agent.token')}[/]")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        agent.shutdown()
+
+def pull_secrets(args: object, console: object) -> bool:
+    """
+    Creates or updates the registry pull secret in every target namespace of one cluster.
+
+    :param args: The parsed pull-secrets options.
+    :type args: object
+
+    :param console: An instantiated 'rich.console' class
+    :type console: object
+
+    return True when every namespace has the secret
+    """
+
+    # Start Timer
+    start_time = timeit.default_timer()
+    workers = args.pull_secret_workers or 16
+    namespaces = [namespace.strip() for namespace in args.namespaces.split(",") if namespace.strip()] if args.namespaces else []
+
+    try:
+        managed_cluster_operations = ManagedClusterOperationsFactory().get("azure")
+        managed_cluster_services = ManagedClusterServicesFactory().get("azure")
+
+        # One connection pool, large enough for every worker
+        connection = managed_cluster_operations.build_cluster_admin_credentials(
+            args.resource_group,
+            args.cluster,
+            args.tenant_id,
+            args.client_id,
+            args.client_secret,
+            subscription_id=args.subscription_id,
+            subscription_index_ttl=args.subscription_index_ttl,
+            credential_expiry_margin=args.credential_expiry_margin,
+            pool_size=max(args.kube_pool_size or 0, workers),
+            isolated=args.isolated_kubeconfig,
+            token_cache=args.token_cache)
+
+        summary = managed_cluster_services.propagate_registry_credentials(
+            args.pull_secret_name,
+            args.docker_registry,
+            args.docker_username,
+            args.docker_password,
+            namespaces=namespaces,
+            selector=args.namespace_selector,
+            api_client=connection.api_client,
+            max_workers=workers)
+
+    except Exception as err: # pylint: disable=broad-except
+        console.print(f"[bright_red]Pull secret propagation failed:[/] [white]{err}[/]")
+        return False
+
+    for outcome in ("created", "updated"):
+        for namespace in summary[outcome]:
+            console.print(f'[bright_green]:heavy_check_mark:[/] [white]Registry credentials[/] [bright_green]"{args.pull_secret_name}"[/] [white]{outcome} in[/] [bright_green]"{namespace}"[/]')
+    for namespace in summary["failed"]:
+        console.print(f'[bright_red]Registry credentials "{args.pull_secret_name}" failed in "{namespace}":[/] [white]{escape(summary["errors"][namespace])}[/]')
+
+    # Record elapsed time
+    elapsed_time = timeit.default_timer() - start_time
+    console.print(f'[white]Summary:[/] [bright_green]{len(summary["created"])}[/] [white]created,[/] [bright_green]{len(summary["updated"])}[/] [white]updated,[/] '
+        f'[bright_green]{len(summary["unchanged"])}[/] [white]unchanged,[/] [bright_red]{len(summary["failed"])}[/] [white]failed in[/] [bright_green]{timedelta(seconds=elapsed_time)}[/]')
+    return not summary["failed"]
+
+def run() -> None:
+    """Command line entry point, used by 'python -m chart.builder' and the chart-builder launcher."""
+
+    # Get Logger - every module prints through the shared console, in the format chosen with --output
+    output_args, _ = get_output_parser().parse_known_args()
+    set_output(output_args.output)
+    console = shared_console
+
+    # Agent Mode - chart-builder serve
+    if sys.argv[1:2] == ["serve"]:
+        serve_args, arguments = get_serve_parser().parse_known_args(sys.argv[2:])
+        serve(serve_args, arguments, console)
+        return
+
+    # Pull Secret Mode - chart-builder pull-secrets
+    if sys.argv[1:2] == ["pull-secrets"]:
+        parser = get_pull_secrets_parser()
+        secret_args = parser.parse_args(sys.argv[2:])
+        if secret_args.cluster is None or "," in secret_args.cluster:
+            parser.error("argument --clustername: one cluster is required")
+        if secret_args.pull_secret_name is None or secret_args.docker_registry is None:
+            parser.error("argument --pull-secret-name: required with --docker-registry")
+        if secret_args.namespaces is None and secret_args.namespace_selector is None:
+            parser.error("argument --namespaces: required unless --namespace-selector is given")
+        sys.exit(0 if pull_secrets(secret_args, console) else 1)
+
+    # Batch Mode - deployment options come from the batch file
+    batch_args, arguments = get_batch_parser().parse_known_args()
+    if batch_args.batch is not None:
+        sys.exit(0 if batch(batch_args, arguments, console) else 1)
 
     # Get Arguments
-    args, unknown_args = get_parser().parse_known_args()
+    parser = get_parser()
+    args, unknown_args = parser.parse_known_args()
     if unknown_args:
         console.print(f"[yellow]Unrecognized arguments:[/] [white italic]{unknown_args}[/]")
+    if args.cluster is None and args.cluster_group is None:
+        parser.error("argument --clustername: required unless --cluster-group is given")
+
+    # Multi-Cluster Mode - the same release to every target cluster in parallel
+    deployments = expand_clusters(args)
+    if len(deployments) > 1 or args.cluster_group is not None:
+        sys.exit(0 if deploy_all(deployments, console, args.max_parallel_clusters, 1) else 1)
+
+    # Export spans at exit, after reporter events have been flushed
+    atexit.register(export_spans, args.trace_file, args.metrics_file)
 
     # Get Reporter
-    reporter = ReportingServicesFactory().get(args.reporting_platform)
+    reporter = ReportingServicesFactory(args.report_flush_timeout).get(args.reporting_platform)
 
     # Run Main
-    main(args, console, reporter)
\ No newline at end of file
+    sys.exit(0 if main(args, console, reporter) else 1)
+
+if __name__ == "__main__":
+    run()
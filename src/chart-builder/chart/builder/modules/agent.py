@@ -0,0 +1,334 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from chart.builder.modules.cache import cache_directory
+
+import hmac
+import itertools
+import json
+import os
+import secrets
+import socketserver
+import threading
+import time
+
+#----------------------------------------
+# Implementation Classes
+#----------------------------------------
+
+class AgentJob():
+    """One deployment handed to the agent, with the events clients can follow."""
+
+    def __init__(self, job_id: str, name: str, cluster: str, func) -> None:
+        self.id = job_id
+        self.name = name
+        self.cluster = cluster
+        self.func = func
+        self.status = "queued"
+        self.events = []
+        self.condition = threading.Condition()
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def done(self) -> bool:
+        return self.finished is not None
+
+    def emit(self, event: dict) -> None:
+        with self.condition:
+            self.events.append(dict(event, job=self.id, time=time.time()))
+            self.condition.notify_all()
+
+    def follow(self, timeout: float=1):
+        """Yield every event of the job, including those still to come, until it has finished."""
+        index = 0
+        while True:
+            with self.condition:
+                while index == len(self.events) and not self.done:
+                    self.condition.wait(timeout)
+                events, finished = self.events[index:], self.done
+            index += len(events)
+            yield from events
+            if finished and index == len(self.events):
+                return
+
+    def describe(self) -> dict:
+        return {
+            "job": self.id,
+            "release": self.name,
+            "cluster": self.cluster,
+            "status": self.status,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+class JobOutput():
+    """File-like object for a rich Console, every line written to it becomes a log event of the job."""
+
+    def __init__(self, job: AgentJob) -> None:
+        self.job = job
+        self.buffer = ""
+
+    def write(self, text: str) -> int:
+        self.buffer += text
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            self.job.emit({"event": "log", "line": line})
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+class DeployAgent():
+    """
+    Runs deploy jobs as they arrive on a bounded pool, at most cluster_concurrency at once per cluster.
+
+    Jobs waiting for their cluster do not hold a worker, so a busy cluster never blocks the
+    others. The last history finished jobs are kept for status lookups.
+    """
+
+    def __init__(self, max_workers: int=None, cluster_concurrency: int=None, history: int=100) -> None:
+        self.max_workers = max_workers or 4
+        self.cluster_concurrency = cluster_concurrency or 1
+        self.history = history
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.jobs = {}
+        self.pending = []
+        self.running = 0
+        self.per_cluster = {}
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def submit(self, name: str, cluster: str, func) -> AgentJob:
+        """Queue func(job) to run against cluster. func returns a status such as "deployed", or False when it failed."""
+        with self.lock:
+            job = AgentJob(str(next(self.counter)), name, cluster, func)
+            self.jobs[job.id] = job
+            self.pending.append(job)
+            job.emit({"event": "status", "status": job.status})
+            self._dispatch()
+        return job
+
+    def get(self, job_id: str) -> AgentJob:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self) -> list:
+        with self.lock:
+            return list(self.jobs.values())
+
+    def shutdown(self, wait: bool=True) -> None:
+        self.executor.shutdown(wait=wait)
+
+    def _dispatch(self) -> None:
+        """Start queued jobs whose cluster has capacity, called with the lock held."""
+        for job in list(self.pending):
+            if self.running >= self.max_workers:
+                break
+            if self.per_cluster.get(job.cluster, 0) < self.cluster_concurrency:
+                self.per_cluster[job.cluster] = self.per_cluster.get(job.cluster, 0) + 1
+                self.running += 1
+                self.pending.remove(job)
+                self.executor.submit(self._run, job)
+
+    def _run(self, job: AgentJob) -> None:
+        job.started = time.time()
+        job.status = "running"
+        job.emit({"event": "status", "status": job.status})
+        try:
+            result = job.func(job)
+            job.status = result if result else "failed"
+        except BaseException as err: # pylint: disable=broad-except
+            job.status = "failed"
+            job.emit({"event": "error", "message": str(err) or type(err).__name__})
+
+        with job.condition:
+            job.finished = time.time()
+            job.events.append({"event": "status", "status": job.status, "seconds": job.finished - job.started, "job": job.id, "time": job.finished})
+            job.condition.notify_all()
+
+        with self.lock:
+            self.running -= 1
+            self.per_cluster[job.cluster] -= 1
+            self._forget()
+            self._dispatch()
+
+    def _forget(self) -> None:
+        """Drop the oldest finished jobs beyond history, called with the lock held."""
+        finished = [job for job in self.jobs.values() if job.done]
+        for job in finished[:max(len(finished) - self.history, 0)]:
+            del self.jobs[job.id]
+
+class AgentRequestHandler(BaseHTTPRequestHandler):
+    """
+    Job API of the agent.
+
+    POST /jobs             queue a deployment, streams its events as NDJSON until it finishes (?wait=false returns at once)
+    GET  /jobs             every known job
+    GET  /jobs/<id>        one job
+    GET  /jobs/<id>/events events of one job, streamed until it finishes
+    GET  /healthz          liveness
+
+    Over a loopback port every request but /healthz needs "Authorization: Bearer <token>",
+    the token is in agent.token in the cache directory.
+    """
+
+    def _allowed(self, path: str) -> bool:
+        """Reject requests a Unix socket's permissions would have kept out. Sends the error response."""
+        token = getattr(self.server, "token", None)
+        if token is None:
+            return True
+
+        # Web pages reach loopback ports through DNS names that resolve to 127.0.0.1
+        host = self.headers.get("Host") or ""
+        host = host.partition("]")[0] + "]" if host.startswith("[") else host.partition(":")[0]
+        if host.lower() not in ("127.0.0.1", "localhost", "[::1]"):
+            self._json(403, {"error": "Only loopback Host headers are accepted"})
+            return False
+
+        if path == "/healthz":
+            return True
+        scheme, _, presented = (self.headers.get("Authorization") or "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(presented.strip().encode("utf-8"), token.encode("utf-8")):
+            self._json(401, {"error": "A bearer token is required, see agent.token in the cache directory"})
+            return False
+        return True
+
+    def do_GET(self) -> None:
+        path = self.path.split("?", 1)[0].rstrip("/")
+        parts = path.split("/")[1:]
+        if not self._allowed(path):
+            return
+
+        if path == "/healthz":
+            self._json(200, {"status": "ok"})
+        elif path == "/jobs":
+            self._json(200, [job.describe() for job in self.server.agent.list()])
+        elif len(parts) in (2, 3) and parts[0] == "jobs":
+            job = self.server.agent.get(parts[1])
+            if job is None:
+                self._json(404, {"error": f"Job {parts[1]} not found"})
+            elif len(parts) == 2:
+                self._json(200, job.describe())
+            elif parts[2] == "events":
+                self._stream(job)
+            else:
+                self._json(404, {"error": f"{path} not found"})
+        else:
+            self._json(404, {"error": f"{path} not found"})
+
+    def do_POST(self) -> None:
+        path, _, query = self.path.partition("?")
+        if not self._allowed(path.rstrip("/")):
+            return
+        if path.rstrip("/") != "/jobs":
+            self._json(404, {"error": f"{path} not found"})
+            return
+
+        # Browsers send text/plain and form bodies cross-site without asking first, JSON needs a preflight they never get
+        if (self.headers.get("Content-Type") or "").split(";", 1)[0].strip().lower() != "application/json":
+            self._json(415, {"error": "The request body must be sent as application/json"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            document = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(document, dict):
+                raise ValueError("The request body must be a JSON object")
+            name, cluster, func = self.server.parse(document)
+        except ValueError as err:
+            self._json(400, {"error": str(err)})
+            return
+        except SystemExit:
+            self._json(400, {"error": "Invalid arguments, see the agent output"})
+            return
+
+        job = self.server.agent.submit(name, cluster, func)
+        if "wait=false" in query.split("&"):
+            self._json(202, job.describe())
+        else:
+            self._stream(job)
+
+    def _json(self, code: int, document) -> None:
+        body = json.dumps(document).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, job: AgentJob) -> None:
+        """One JSON event per line as it happens, the response ends when the job has finished."""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        try:
+            for event in job.follow():
+                self.wfile.write(json.dumps(event).encode("utf-8") + b"\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass # The client went away, the job carries on
+
+    def log_message(self, format, *args) -> None: # pylint: disable=redefined-builtin
+        pass
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP over a Unix socket only its owner can connect to."""
+
+    daemon_threads = True
+
+    def server_bind(self) -> None:
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        old_umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(old_umask)
+
+    def server_close(self) -> None:
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+class LoopbackHTTPServer(ThreadingHTTPServer):
+    """HTTP on 127.0.0.1, open to every local user, so requests need the bearer token."""
+
+    daemon_threads = True
+
+#----------------------------------------
+# Helper Functions
+#----------------------------------------
+
+def agent_token(path: str=None) -> str:
+    """Bearer token of the loopback job API, created on first use in a file only its owner can read."""
+    path = path or os.path.join(cache_directory(), "agent.token")
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as stream:
+            stream.write(secrets.token_urlsafe(32))
+    except FileExistsError:
+        os.chmod(path, 0o600)
+    with open(path) as stream:
+        return stream.read().strip()
+
+def make_server(agent: DeployAgent, parse, socket_path: str=None, port: int=None, token: str=None):
+    """
+    Job API server on a Unix socket, or on a loopback port when port is given.
+
+    The loopback port requires token (by default from agent_token) as a bearer token.
+
+    :param parse: Turns a request body into (release, cluster, func) for DeployAgent.submit, raises ValueError for a bad request.
+
+    return the server, call serve_forever() to start it
+    """
+    if port is not None:
+        server = LoopbackHTTPServer(("127.0.0.1", port), AgentRequestHandler)
+        server.token = token or agent_token()
+    else:
+        server = UnixHTTPServer(socket_path, AgentRequestHandler)
+    server.agent = agent
+    server.parse = parse
+    return server
@@ -1,15 +1,13 @@
 from argparse import ArgumentParser, Action
 from typing import Optional, IO
-from rich.console import Console
 from rich.panel import Panel
 
+from chart.builder.modules.output import console, output_formats
+
 import os
 import re
 import sys
 
-# Global Variables
-console = Console(color_system="standard")
-
 class RichParser(ArgumentParser):
 
     def error(self, message):
@@ -47,76 +45,115 @@ def environment(env: str):
 
     return env.lower()
 
-def get_parser():
+def add_batch_arguments(batch):
 
-    # PARSER OBJECT
-    parser = RichParser(
-        description="Logs into platform hosting kubernetes, generates a kubeconfig, and installs a helm chart."
+    # BATCH FILE
+    batch.add_argument("--batch",
+        action=EnvDefault, metavar="BATCH_FILE", required=False,
+        dest="batch",
+        help="YAML or JSON list of deployments, each using the option names of this command (e.g. release, helm-set). Options given on the command line apply to every deployment.",
     )
 
-    # ---------------------------
-    # DEFAULT ARGUMENTS
-    # ---------------------------
-    default = parser.add_argument_group("Default arguments")
+    # BATCH WORKERS
+    batch.add_argument("--batch-workers",
+        action=EnvDefault, metavar="BATCH_WORKERS", required=False,
+        dest="batch_workers", type=int,
+        help="Deployments run at the same time (default 8).",
+    )
 
-    # DEPARTMENT NAME
-    default.add_argument("--department-name",
-        action=EnvDefault, metavar="DEPARTMENT_NAME", required=False,
-        dest="department_name",
-        help="The department that owns the application.",
+    # BATCH CLUSTER CONCURRENCY
+    batch.add_argument("--batch-cluster-concurrency",
+        action=EnvDefault, metavar="BATCH_CLUSTER_CONCURRENCY", required=False,
+        dest="batch_cluster_concurrency", type=int,
+        help="Deployments run at the same time against one cluster (default 4).",
     )
 
-    # DEPARTMENT TEAM
-    default.add_argument("--department-team",
-        action=EnvDefault, metavar="DEPARTMENT_TEAM", required=False,
-        dest="department_team",
-        help="The department team who owns the application.",
+def add_output_arguments(output):
+
+    # OUTPUT FORMAT
+    output.add_argument("--output",
+        action=EnvDefault, metavar="OUTPUT_FORMAT", required=False,
+        dest="output", choices=output_formats,
+        help="text (default) prints spinners and panels, ndjson prints one JSON event per line for CI logs and parallel runs.",
     )
 
-    # APP NAME
-    default.add_argument("--app-name",
-        action=EnvDefault, metavar="APP_NAME", required=False,
-        dest="app_name",
-        help="Name of the application.",
+def get_output_parser():
+    """Parser for the output format only, read first so every mode prints in the chosen format."""
+    parser = RichParser(add_help=False)
+    add_output_arguments(parser)
+    return parser
+
+def get_batch_parser():
+    """Parser for the batch options only, read before the full parser so per-deployment options can come from the batch file."""
+    parser = RichParser(add_help=False)
+    add_batch_arguments(parser)
+    return parser
+
+def add_serve_arguments(serve):
+
+    # AGENT SOCKET
+    serve.add_argument("--socket",
+        action=EnvDefault, metavar="AGENT_SOCKET", required=False,
+        dest="socket",
+        help="Unix socket the job API listens on (default ~/.cache/chart-builder/agent.sock).",
     )
 
-    # APP TEAM
-    default.add_argument("--team",
-        action=EnvDefault, metavar="APP_TEAM", required=False,
-        dest="app_team",
-        help="Application Team.",
+    # AGENT PORT
+    serve.add_argument("--port",
+        action=EnvDefault, metavar="AGENT_PORT", required=False,
+        dest="port", type=int,
+        help="Serve the job API over HTTP on this loopback port instead of a Unix socket.",
     )
 
-    # APP VERSION
-    default.add_argument("--version", "--app-version",
-        action=EnvDefault, metavar="APP_VERSION", required=False,
-        dest="app_version",
-        help="Version of the application.",
+    # AGENT WORKERS
+    serve.add_argument("--serve-workers",
+        action=EnvDefault, metavar="AGENT_WORKERS", required=False,
+        dest="serve_workers", type=int,
+        help="Jobs run at the same time (default 4).",
     )
 
-    # ENVIRONMENT
-    default.add_argument("--environment",
-        action=EnvDefault, metavar="ENVIRONMENT",
-        dest="environment", type=environment,
-        help="Supported environments: [ eph, dev, test, stage, prod ]",
+    # AGENT CLUSTER CONCURRENCY
+    serve.add_argument("--serve-cluster-concurrency",
+        action=EnvDefault, metavar="AGENT_CLUSTER_CONCURRENCY", required=False,
+        dest="serve_cluster_concurrency", type=int,
+        help="Jobs run at the same time against one cluster (default 1).",
     )
 
-    default.add_argument("--reporting-platform",
-        action=EnvDefault, metavar="REPORTING_PLATFORM", required=False,
-        dest="reporting_platform",
-        help="The reporting platform where events are posted (Datadog, NewRelic, Local). Do not set this flag within your gitlab job.",
+    # AGENT CONNECTION TTL
+    serve.add_argument("--connection-ttl",
+        action=EnvDefault, metavar="AGENT_CONNECTION_TTL", required=False,
+        dest="connection_ttl", type=float,
+        help="Seconds a cluster connection is kept before credentials are fetched again (default 3600).",
     )
 
-    # ---------------------------
-    # AZURE ARGUMENTS
-    # ---------------------------
-    azure = parser.add_argument_group("Azure arguments")
+def get_serve_parser():
+    """Parser for 'chart-builder serve', other options given to serve apply to every job."""
+    parser = RichParser(prog="chart-builder serve",
+        description="Keeps clients, caches and reporter sessions warm and runs deploy jobs sent to a local job API.")
+    add_serve_arguments(parser)
+    return parser
+
+def add_azure_arguments(azure):
 
     # CLUSTER NAME
     azure.add_argument("--clustername", "--aksclustername",
-        action=EnvDefault, metavar="AKS_CLUSTER_NAME",
+        action=EnvDefault, metavar="AKS_CLUSTER_NAME", required=False,
         dest="cluster",
-        help="Name of the Managed Kubernetes Cluster.",
+        help="Name of the Managed Kubernetes Cluster. Separate names with commas to deploy to several clusters in parallel.",
+    )
+
+    # CLUSTER GROUP
+    azure.add_argument("--cluster-group",
+        action=EnvDefault, metavar="CLUSTER_GROUP_FILE", required=False,
+        dest="cluster_group",
+        help="YAML or JSON list of clusters to deploy to in parallel, as names or mappings with clustername, resource-group and subscription.",
+    )
+
+    # MAX PARALLEL CLUSTERS
+    azure.add_argument("--max-parallel-clusters",
+        action=EnvDefault, metavar="MAX_PARALLEL_CLUSTERS", required=False,
+        dest="max_parallel_clusters", type=int,
+        help="Clusters deployed to at the same time (default 8).",
     )
 
     # RESOURCE GROUP
@@ -147,10 +184,50 @@ def get_parser():
         help="The AAD tenant, must provide when using service principals. Do not set this flag within your gitlab job.",
     )
 
-    # ---------------------------
-    # DOCKER ARGUMENTS
-    # ---------------------------
-    docker = parser.add_argument_group("Docker arguments")
+    # Subscription ID
+    azure.add_argument("--subscription", "--subscription-id",
+        action=EnvDefault, metavar="AZURE_SUBSCRIPTION_ID", required=False,
+        dest="subscription_id",
+        help="Subscription that holds the resource group. Skips subscription discovery when set.",
+    )
+
+    # Subscription Index TTL
+    azure.add_argument("--subscription-index-ttl",
+        action=EnvDefault, metavar="SUBSCRIPTION_INDEX_TTL", required=False,
+        dest="subscription_index_ttl", type=float,
+        help="Seconds a cached resource group to subscription lookup is trusted before discovery runs again (default 86400).",
+    )
+
+    # Credential Expiry Margin
+    azure.add_argument("--credential-expiry-margin",
+        action=EnvDefault, metavar="CREDENTIAL_EXPIRY_MARGIN", required=False,
+        dest="credential_expiry_margin", type=float,
+        help="Seconds before the client certificate expires that cached cluster credentials stop being reused (default 3600).",
+    )
+
+    # Token Cache
+    azure.add_argument("--no-token-cache",
+        action="store_false",
+        dest="token_cache",
+        help="Always request Azure AD tokens instead of reusing unexpired ones from the local token cache.",
+    )
+
+    # Isolated Kubeconfig
+    azure.add_argument("--isolated-kubeconfig",
+        action="store_true",
+        dest="isolated_kubeconfig",
+        help="Keep this run's cluster credentials in a private kubeconfig (on tmpfs when available) that helm uses and that is removed at exit, instead of merging them into ~/.kube/config.",
+    )
+
+    # Kubernetes Connection Pool Size
+    azure.add_argument("--kube-pool-size",
+        action=EnvDefault, metavar="KUBE_CONNECTION_POOL_SIZE", required=False,
+        dest="kube_pool_size", type=int,
+        help="Maximum keep-alive connections to the Kubernetes API server shared by every call in a run.",
+    )
+
+
+def add_docker_arguments(docker):
 
     # Docker Registry
     docker.add_argument("--docker-registry", "--container-registry",
@@ -180,6 +257,150 @@ def get_parser():
         help="Name for Docker Registry Secret.",
     )
 
+def add_pull_secret_arguments(pull_secrets):
+
+    # TARGET NAMESPACES
+    pull_secrets.add_argument("--namespaces",
+        action=EnvDefault, metavar="PULL_SECRET_NAMESPACES", required=False,
+        dest="namespaces",
+        help="Comma separated namespaces that get the registry pull secret.",
+    )
+
+    # NAMESPACE SELECTOR
+    pull_secrets.add_argument("--namespace-selector",
+        action=EnvDefault, metavar="PULL_SECRET_NAMESPACE_SELECTOR", required=False,
+        dest="namespace_selector",
+        help="Label selector for the namespaces that get the registry pull secret, e.g. tenant=retail.",
+    )
+
+    # PULL SECRET WORKERS
+    pull_secrets.add_argument("--pull-secret-workers",
+        action=EnvDefault, metavar="PULL_SECRET_WORKERS", required=False,
+        dest="pull_secret_workers", type=int,
+        help="Namespaces updated at the same time (default 16).",
+    )
+
+def get_pull_secrets_parser():
+    """Parser for 'chart-builder pull-secrets', only the cluster, registry and target namespace options."""
+    parser = RichParser(prog="chart-builder pull-secrets",
+        description="Creates or updates the registry pull secret in many namespaces of a cluster at once.")
+    add_azure_arguments(parser.add_argument_group("Azure arguments"))
+    add_docker_arguments(parser.add_argument_group("Docker arguments"))
+    add_pull_secret_arguments(parser.add_argument_group("Namespace arguments"))
+    add_output_arguments(parser)
+    return parser
+
+def get_parser():
+
+    # PARSER OBJECT
+    parser = RichParser(
+        description="Logs into platform hosting kubernetes, generates a kubeconfig, and installs a helm chart."
+    )
+
+    # ---------------------------
+    # DEFAULT ARGUMENTS
+    # ---------------------------
+    default = parser.add_argument_group("Default arguments")
+
+    # DEPARTMENT NAME
+    default.add_argument("--department-name",
+        action=EnvDefault, metavar="DEPARTMENT_NAME", required=False,
+        dest="department_name",
+        help="The department that owns the application.",
+    )
+
+    # DEPARTMENT TEAM
+    default.add_argument("--department-team",
+        action=EnvDefault, metavar="DEPARTMENT_TEAM", required=False,
+        dest="department_team",
+        help="The department team who owns the application.",
+    )
+
+    # APP NAME
+    default.add_argument("--app-name",
+        action=EnvDefault, metavar="APP_NAME", required=False,
+        dest="app_name",
+        help="Name of the application.",
+    )
+
+    # APP TEAM
+    default.add_argument("--team",
+        action=EnvDefault, metavar="APP_TEAM", required=False,
+        dest="app_team",
+        help="Application Team.",
+    )
+
+    # APP VERSION
+    default.add_argument("--version", "--app-version",
+        action=EnvDefault, metavar="APP_VERSION", required=False,
+        dest="app_version",
+        help="Version of the application.",
+    )
+
+    # ENVIRONMENT
+    default.add_argument("--environment",
+        action=EnvDefault, metavar="ENVIRONMENT",
+        dest="environment", type=environment,
+        help="Supported environments: [ eph, dev, test, stage, prod ]",
+    )
+
+    default.add_argument("--reporting-platform",
+        action=EnvDefault, metavar="REPORTING_PLATFORM", required=False,
+        dest="reporting_platform",
+        help="The reporting platform where events are posted (Datadog, NewRelic, Local). Do not set this flag within your gitlab job.",
+    )
+
+    # REPORT FLUSH TIMEOUT
+    default.add_argument("--report-flush-timeout",
+        action=EnvDefault, metavar="REPORT_FLUSH_TIMEOUT", required=False,
+        dest="report_flush_timeout", type=float,
+        help="Seconds to keep delivering deployment events at exit before the rest are saved for the next run (default 5).",
+    )
+
+    # TRACE FILE
+    default.add_argument("--trace-file",
+        action=EnvDefault, metavar="TRACE_FILE", required=False,
+        dest="trace_file",
+        help="Write the timing spans of every stage and outbound call to this file as OpenTelemetry (OTLP) JSON at exit.",
+    )
+
+    # METRICS FILE
+    default.add_argument("--metrics-file",
+        action=EnvDefault, metavar="METRICS_TEXTFILE", required=False,
+        dest="metrics_file",
+        help="Write span and stage durations to this file in the Prometheus text format at exit, e.g. for the node exporter's textfile collector.",
+    )
+
+    add_output_arguments(default)
+
+    # DEMO MODE
+    default.add_argument("--demo",
+        action="store_true",
+        dest="demo",
+        help="Pause between stages so spinner output can be followed. Off by default.",
+    )
+
+    # ---------------------------
+    # AZURE ARGUMENTS
+    # ---------------------------
+    azure = parser.add_argument_group("Azure arguments")
+
+    add_azure_arguments(azure)
+
+    # Namespace Prerequisites
+    azure.add_argument("--prerequisites",
+        action="append", required=False,
+        dest="prerequisites",
+        help="YAML file of more objects to apply to the namespace before deploying, such as service accounts, quotas and config maps (can specify multiple)",
+    )
+
+    # ---------------------------
+    # DOCKER ARGUMENTS
+    # ---------------------------
+    docker = parser.add_argument_group("Docker arguments")
+
+    add_docker_arguments(docker)
+
     # ---------------------------
     # HELM ARGUMENTS
     # ---------------------------
@@ -246,6 +467,20 @@ def get_parser():
         help="Time to wait for any individual Kubernetes operation (like Jobs for hooks) (default 5m0s)",
     )
 
+    # Rollout Watch
+    helm.add_argument("--rollout-watch",
+        action="store_true",
+        dest="rollout_watch",
+        help="Instead of helm --wait, watch the release's workloads after the upgrade and fail as soon as a pod cannot start. Failed releases are rolled back, as with --helm-atomic.",
+    )
+
+    # Rollout Selector
+    helm.add_argument("--rollout-selector",
+        action=EnvDefault, metavar="ROLLOUT_SELECTOR", required=False,
+        dest="rollout_selector",
+        help="Label selector of the release's workloads for --rollout-watch (default app.kubernetes.io/instance=<release>).",
+    )
+
     # Helm Version
     helm.add_argument("--helm-version",
         action=EnvDefault, metavar="HELM_VERSION", required=False,
@@ -253,6 +488,53 @@ def get_parser():
         help="Specify a version constraint for the chart version to use. This constraint can be a specific tag (e.g. 1.1.1) or it may reference a valid range (e.g. ^2.0.0). If this is not specified, the latest version is used.",
     )
 
+    # Force
+    helm.add_argument("--force",
+        action="store_true",
+        dest="force",
+        help="Run the package manager even when the chart, values and flags match the last deployment of the release.",
+    )
+
+    # Preflight
+    helm.add_argument("--no-preflight",
+        action="store_false",
+        dest="preflight",
+        help="Skip checking values files, --helm-set entries and the chart's values.schema.json before connecting to the cluster.",
+    )
+
+    # Chart Cache
+    helm.add_argument("--no-chart-cache",
+        action="store_false",
+        dest="chart_cache",
+        help="Always fetch repository charts through helm instead of the local chart cache.",
+    )
+
+    # Chart Cache TTL
+    helm.add_argument("--chart-cache-ttl",
+        action=EnvDefault, metavar="CHART_CACHE_TTL", required=False,
+        dest="chart_cache_ttl", type=float,
+        help="Seconds a version range or latest stays resolved to the same cached chart version (default 300). Exact versions never expire.",
+    )
+
+    # Chart Cache Size
+    helm.add_argument("--chart-cache-size",
+        action=EnvDefault, metavar="CHART_CACHE_SIZE", required=False,
+        dest="chart_cache_size", type=lambda size: int(size) * 1024 * 1024,
+        help="Megabytes of packaged charts kept before the least recently used are evicted (default 1024).",
+    )
+
+    # Helm Fail Patterns
+    helm.add_argument("--helm-fail-pattern",
+        action="append", required=False,
+        dest="helm_fail_patterns",
+        help="Stop helm as soon as a line of its output matches this regular expression (can specify multiple). Added to the built-in patterns such as ImagePullBackOff.",
+    )
+
+    # ---------------------------
+    # BATCH ARGUMENTS
+    # ---------------------------
+    add_batch_arguments(parser.add_argument_group("Batch arguments"))
+
     # ---------------------------
     # DATADOG ARGUMENTS
     # ---------------------------
@@ -0,0 +1,182 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import copy
+import hashlib
+import json
+import threading
+import time
+import yaml
+
+#----------------------------------------
+# Helper Functions
+#----------------------------------------
+
+def _load_list(path: str, key: str) -> list:
+    """Read a YAML or JSON list, either at the top level or under key."""
+    with open(path) as stream:
+        document = json.load(stream) if path.endswith(".json") else yaml.safe_load(stream)
+
+    if isinstance(document, dict):
+        document = document.get(key)
+    if not isinstance(document, list):
+        raise Exception(f'{path} must contain a list of {key}')
+    return document
+
+def load_batch(path: str) -> list:
+    """Read a YAML or JSON list of deployments. Each deployment maps option names to values."""
+    document = _load_list(path, "deployments")
+    if not all(isinstance(entry, dict) for entry in document):
+        raise Exception(f'{path} must contain a list of deployments')
+    return document
+
+def cluster_targets(cluster: str=None, group: str=None) -> list:
+    """
+    Clusters to deploy to, from a comma-separated --clustername and a cluster-group file.
+
+    Group entries are cluster names or mappings with clustername and optionally
+    resource-group and subscription.
+    """
+    targets = [{"cluster": name.strip()} for name in (cluster or "").split(",") if name.strip()]
+    for entry in _load_list(group, "clusters") if group else []:
+        if isinstance(entry, dict):
+            targets.append({
+                "cluster": entry.get("clustername") or entry.get("cluster"),
+                "resource_group": entry.get("resource-group") or entry.get("resource_group"),
+                "subscription_id": entry.get("subscription") or entry.get("subscription_id"),
+            })
+        else:
+            targets.append({"cluster": str(entry)})
+    return targets
+
+def expand_clusters(args: object) -> list:
+    """One copy of the parsed arguments per target cluster."""
+    targets = cluster_targets(args.cluster, getattr(args, "cluster_group", None))
+    if not targets:
+        raise Exception('No cluster given, set --clustername or --cluster-group')
+
+    deployments = []
+    for target in targets:
+        deployment = copy.copy(args)
+        for key, value in target.items():
+            if value is not None:
+                setattr(deployment, key, value)
+        deployments.append(deployment)
+    return deployments
+
+def batch_arguments(entry: dict) -> list:
+    """
+    Turn one deployment into command line arguments for get_parser.
+
+    Keys are option names without the leading dashes (e.g. "release", "helm-set"),
+    lists repeat the option and true booleans become flags.
+    """
+    arguments = []
+    for key, value in entry.items():
+        option = "--" + str(key).lstrip("-").replace("_", "-")
+        if value is None or value is False:
+            continue
+        if value is True:
+            arguments.append(option)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                arguments.extend([option, str(item)])
+        else:
+            arguments.extend([option, str(value)])
+    return arguments
+
+def connection_key(args: object) -> tuple:
+    """
+    Key a shared cluster connection by the cluster and the identity signing in to it.
+
+    Jobs that sign in as different service principals never share a connection,
+    the client secret is only kept as a sha256 digest.
+    """
+    secret = hashlib.sha256((args.client_secret or "").encode("utf-8")).hexdigest()
+    return (args.tenant_id, args.client_id, secret, args.subscription_id, args.resource_group, args.cluster)
+
+#----------------------------------------
+# Implementation Classes
+#----------------------------------------
+
+class ClusterConnections():
+    """
+    Fetches credentials once per cluster and shares the result with every deployment to it.
+
+    With a ttl, a connection older than ttl seconds is fetched again on its next use.
+    """
+
+    def __init__(self, ttl: float=None) -> None:
+        self.ttl = ttl
+        self.connections = {}
+        self.created = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, factory):
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+
+        # Deployments to other clusters are not held up while this one fetches
+        with lock:
+            expired = self.ttl is not None and time.monotonic() - self.created.get(key, 0) > self.ttl
+            if key not in self.connections or expired:
+                self.connections[key] = factory()
+                self.created[key] = time.monotonic()
+            return self.connections[key]
+
+class BatchJob():
+
+    def __init__(self, name: str, cluster: str, func) -> None:
+        self.name = name
+        self.cluster = cluster
+        self.func = func
+        self.succeeded = None
+        self.result = None
+        self.error = None
+        self.seconds = None
+
+class BatchRunner():
+    """Runs jobs on a bounded thread pool, with at most cluster_concurrency jobs per cluster at once."""
+
+    def __init__(self, max_workers: int=None, cluster_concurrency: int=None) -> None:
+        self.max_workers = max_workers or 8
+        self.cluster_concurrency = cluster_concurrency or 4
+
+    @staticmethod
+    def _run(job: BatchJob) -> BatchJob:
+        start = time.perf_counter()
+        try:
+            job.result = job.func()
+            job.succeeded = job.result is not False
+        except BaseException as err: # pylint: disable=broad-except
+            job.succeeded, job.error = False, err
+        job.seconds = time.perf_counter() - start
+        return job
+
+    def run(self, jobs: list) -> list:
+        """Run every job, a failing job does not stop the others. Returns the jobs in their original order."""
+
+        pending = list(jobs)
+        running = {}
+        per_cluster = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+
+            while pending or running:
+
+                # Submit jobs whose cluster has capacity, keeping the pool no busier than its workers
+                for job in list(pending):
+                    if len(running) >= self.max_workers:
+                        break
+                    if per_cluster.get(job.cluster, 0) < self.cluster_concurrency:
+                        per_cluster[job.cluster] = per_cluster.get(job.cluster, 0) + 1
+                        running[executor.submit(self._run, job)] = job
+                        pending.remove(job)
+
+                # Wait for the next job to finish
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    per_cluster[job.cluster] -= 1
+
+        return list(jobs)
@@ -0,0 +1,277 @@
+from contextlib import contextmanager
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+import yaml
+
+# GLOBAL VARIABLES
+default_directory = os.path.join(os.path.expanduser('~'), '.cache', 'chart-builder')
+exact_version = re.compile(r'^v?\d+\.\d+\.\d+(-[0-9A-Za-z.-]+)?(\+[0-9A-Za-z.-]+)?$')
+
+#----------------------------------------
+# Helper Functions
+#----------------------------------------
+
+def cache_directory(*parts: str) -> str:
+    """Directory for files kept between runs. Override with CHART_BUILDER_CACHE_DIR."""
+    directory = os.path.join(os.environ.get("CHART_BUILDER_CACHE_DIR") or default_directory, *parts)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return directory
+
+def read_json(path: str, default=None):
+    """Read a JSON file, returning the default when it is missing or unreadable."""
+    try:
+        with open(path) as stream:
+            return json.load(stream)
+    except (OSError, ValueError):
+        return default
+
+def write_json(path: str, document) -> None:
+    """Write a JSON file atomically so concurrent runs never read a partial file."""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, 'w') as stream:
+            json.dump(document, stream)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+@contextmanager
+def file_lock(path: str):
+    """Hold an exclusive lock on path, shared by every thread and process that locks the same file."""
+    with open(path, "a") as stream:
+        fcntl.flock(stream.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(stream.fileno(), fcntl.LOCK_UN)
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for block in iter(lambda: stream.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def chart_metadata(package: str) -> dict:
+    """Chart.yaml of a packaged chart."""
+    with tarfile.open(package, "r:gz") as archive:
+        for member in archive:
+            if member.isfile() and member.name.count("/") == 1 and member.name.endswith("/Chart.yaml"):
+                return yaml.safe_load(archive.extractfile(member)) or {}
+    raise Exception(f'{package} is not a packaged chart')
+
+#----------------------------------------
+# Implementation Classes
+#----------------------------------------
+
+class SubscriptionIndex():
+    """
+    Remembers which subscription holds a resource group, per tenant, for ttl seconds.
+
+    Updates hold a lock file next to the index, so concurrent runs never drop each other's entries.
+    """
+
+    def __init__(self, path: str=None, ttl: float=None) -> None:
+        self.path = path or os.path.join(cache_directory(), "subscriptions.json")
+        self.ttl = 86400 if ttl is None else ttl
+        self.lock_path = self.path + ".lock"
+
+    @staticmethod
+    def key(tenant_id: str, resource_group: str) -> str:
+        return f'{tenant_id}/{resource_group}'.lower()
+
+    def get(self, tenant_id: str, resource_group: str):
+        """Subscription id for the resource group, or None when unknown or stale."""
+        entry = read_json(self.path, {}).get(self.key(tenant_id, resource_group))
+        if not entry or time.time() - entry.get("updated", 0) > self.ttl:
+            return None
+        return entry.get("subscription_id")
+
+    def set(self, tenant_id: str, resource_group: str, subscription_id: str) -> None:
+        with file_lock(self.lock_path):
+            index = read_json(self.path, {})
+            index[self.key(tenant_id, resource_group)] = {"subscription_id": subscription_id, "updated": time.time()}
+            write_json(self.path, index)
+
+    def discard(self, tenant_id: str, resource_group: str) -> None:
+        with file_lock(self.lock_path):
+            index = read_json(self.path, {})
+            if index.pop(self.key(tenant_id, resource_group), None) is not None:
+                write_json(self.path, index)
+
+class CredentialCache():
+    """Cluster admin kubeconfigs by subscription, resource group and cluster, reused until shortly before they expire."""
+
+    def __init__(self, directory: str=None, margin: float=None) -> None:
+        self.directory = directory or cache_directory("credentials")
+        self.margin = 3600 if margin is None else margin
+
+    def path(self, subscription_id: str, resource_group: str, cluster: str) -> str:
+        key = f'{subscription_id}/{resource_group}/{cluster}'.lower()
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, subscription_id: str, resource_group: str, cluster: str):
+        """Cached kubeconfig text, or None when missing or within the safety margin of expiry."""
+        entry = read_json(self.path(subscription_id, resource_group, cluster), {})
+        if not entry or entry.get("expires", 0) - self.margin <= time.time():
+            return None
+        return entry.get("kubeconfig")
+
+    def set(self, subscription_id: str, resource_group: str, cluster: str, kubeconfig: str, expires: float) -> None:
+        write_json(self.path(subscription_id, resource_group, cluster), {"kubeconfig": kubeconfig, "expires": expires})
+
+    def discard(self, subscription_id: str, resource_group: str, cluster: str) -> None:
+        try:
+            os.remove(self.path(subscription_id, resource_group, cluster))
+        except FileNotFoundError:
+            pass
+
+class TokenCache():
+    """
+    Azure AD access tokens by tenant, client id and scopes, reused until shortly before they expire.
+
+    One file per key, readable by the owner only, so concurrent runs on a runner share tokens
+    without rewriting each other's entries. An entry is only served to the secret it was issued for.
+    """
+
+    def __init__(self, directory: str=None, margin: float=None) -> None:
+        self.directory = directory or cache_directory("tokens")
+        self.margin = 300 if margin is None else margin
+
+        # Tokens grant access to the subscription, other users must not read them
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        os.chmod(self.directory, 0o700)
+
+    @staticmethod
+    def secret_digest(client_secret: str) -> str:
+        return hashlib.sha256((client_secret or "").encode("utf-8")).hexdigest()
+
+    def path(self, tenant_id: str, client_id: str, scopes: tuple) -> str:
+        key = f'{tenant_id}/{client_id}/{" ".join(sorted(scopes))}'.lower()
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, tenant_id: str, client_id: str, client_secret: str, scopes: tuple):
+        """(token, expires_on) or None when missing, issued for another secret or within the safety margin of expiry."""
+        entry = read_json(self.path(tenant_id, client_id, scopes), {})
+        if not entry or entry.get("secret") != self.secret_digest(client_secret) or entry.get("expires_on", 0) - self.margin <= time.time():
+            return None
+        return entry["token"], entry["expires_on"]
+
+    def set(self, tenant_id: str, client_id: str, client_secret: str, scopes: tuple, token: str, expires_on: int) -> None:
+        write_json(self.path(tenant_id, client_id, scopes), {"token": token, "expires_on": expires_on, "secret": self.secret_digest(client_secret)})
+
+    def discard(self, tenant_id: str, client_id: str, scopes: tuple) -> None:
+        try:
+            os.remove(self.path(tenant_id, client_id, scopes))
+        except FileNotFoundError:
+            pass
+
+class ChartCache():
+    """
+    Packaged charts by repository, chart and version, stored once per content digest.
+
+    Exact versions are immutable and always served from the cache. Ranges and "latest" are
+    resolved to an exact version at most once per ttl seconds. The least recently used
+    charts are evicted once the cache grows past max_size bytes, except those used within
+    the last min_age seconds, which another deploy may be handing to helm.
+
+    Index updates and eviction hold a lock file, so concurrent runs sharing the directory never
+    lose each other's entries.
+    """
+
+    def __init__(self, directory: str=None, ttl: float=None, max_size: int=None, min_age: float=None) -> None:
+        self.directory = directory or cache_directory("charts")
+        self.ttl = 300 if ttl is None else ttl
+        self.max_size = max_size or 1024 * 1024 * 1024
+        self.min_age = 600 if min_age is None else min_age
+        self.index_path = os.path.join(self.directory, "index.json")
+        self.lock_path = os.path.join(self.directory, "index.lock")
+
+    @staticmethod
+    def key(repository: str, chart: str, version: str=None) -> str:
+        return f'{repository.rstrip("/")}|{chart}|{version or ""}'
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest + ".tgz")
+
+    def _index(self) -> dict:
+        index = read_json(self.index_path, {})
+        index.setdefault("charts", {})
+        index.setdefault("resolved", {})
+        return index
+
+    def get(self, repository: str, chart: str, version: str=None):
+        """Path of the cached chart, or None when it has to be pulled."""
+        index = self._index()
+
+        # Ranges and latest - use the version they resolved to while it is fresh
+        if version is None or not exact_version.match(version):
+            resolved = index["resolved"].get(self.key(repository, chart, version))
+            if not resolved or time.time() - resolved["updated"] > self.ttl:
+                return None
+            version = resolved["version"]
+
+        digest = index["charts"].get(self.key(repository, chart, version.lstrip("v")))
+        if digest is None:
+            return None
+
+        # Recently used charts are evicted last, and not at all while helm may still be reading them
+        try:
+            os.utime(self.path(digest))
+        except FileNotFoundError:
+            return None
+        return self.path(digest)
+
+    def put(self, repository: str, chart: str, version: str, package: str) -> str:
+        """Store a pulled chart package (moved into the cache) and return its cached path."""
+        digest = file_digest(package)
+        chart_version = str(chart_metadata(package).get("version"))
+
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.remove(package)
+        else:
+            shutil.move(package, path)
+
+        with file_lock(self.lock_path):
+            index = self._index()
+            index["charts"][self.key(repository, chart, chart_version.lstrip("v"))] = digest
+            if version is None or not exact_version.match(version):
+                index["resolved"][self.key(repository, chart, version)] = {"version": chart_version, "updated": time.time()}
+            self._evict(index, keep=digest)
+            write_json(self.index_path, index)
+
+        return path
+
+    def _evict(self, index: dict, keep: str) -> None:
+        packages = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".tgz"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                packages.append((stat.st_mtime, stat.st_size, name[:-4]))
+
+        size = sum(package[1] for package in packages)
+        recent = time.time() - self.min_age
+        for modified, package_size, digest in sorted(packages):
+            if size <= self.max_size or modified > recent:
+                break
+            if digest == keep:
+                continue
+            os.remove(self.path(digest))
+            size -= package_size
+
+        # Forget versions whose package was evicted
+        index["charts"] = {key: digest for key, digest in index["charts"].items() if os.path.exists(self.path(digest))}
@@ -1,21 +1,25 @@
 from abc import ABC, abstractmethod
-from rich.console import Console
 
-from azure.identity import ClientSecretCredential
-from azure.mgmt.containerservice import ContainerServiceClient
-from azure.mgmt.resource import ResourceManagementClient
-from azure.mgmt.subscription import SubscriptionClient
+from chart.builder.modules.cache import CredentialCache, SubscriptionIndex, TokenCache
+from chart.builder.modules.kubeconfig import certificate_expiry, load_kubeconfig, merge_kubeconfig, parse_kubeconfig, private_kubeconfig, write_kubeconfig
+from chart.builder.modules.output import console
+from chart.builder.modules.registry import ProviderRegistry
+from chart.builder.modules.stages import first_match, pause, status
+from chart.builder.modules.tracing import span, traced
 
 import errno
+import hashlib
 import os
 import platform
 import stat
-import tempfile
+import threading
 import time
 import yaml
 
 # GLOBAL VARIABLES
-console = Console(color_system="standard")
+kubeconfig_lock = threading.Lock()
+credential_objects = {}
+credential_objects_lock = threading.Lock()
 
 #----------------------------------------
 # Factory Class
@@ -24,13 +28,13 @@ console = Console(color_system="standard")
 class ManagedClusterOperationsFactory():
 
     def __init__(self) -> None:
-        self.factories = {
-            "azure": AzureManagedClusterOperations()
-        }
+        self.factories = ProviderRegistry("chart_builder.cluster_operations", {
+            "azure": "chart.builder.modules.clusteroperations:AzureManagedClusterOperations"
+        })
     
     def get(self, cluster_operations: str=None):
         try:
-            factory = self.factories[cluster_operations]
+            factory = self.factories.get(cluster_operations)
         except KeyError as err:
             raise Exception(err)
         return factory
@@ -45,64 +49,251 @@ class ManagedClusterOperations(ABC):
     def build_cluster_admin_credentials(self) -> None:
         pass
 
+class ClusterConnection():
+    """What later stages need to reach a cluster: a pooled ApiClient, and the kubeconfig file and context for helm."""
+
+    def __init__(self, api_client, context: str, kubeconfig: str=None) -> None:
+        self.api_client = api_client
+        self.context = context
+        self.kubeconfig = kubeconfig
+
+class PersistentTokenCredential():
+    """
+    Stands in for an Azure credential and keeps its access tokens in the on-disk token cache.
+
+    Tokens held by this process are returned first. Next comes the token cache shared with other
+    runs, which counts as a hit. Only a miss reaches Azure AD. Each disk lookup is recorded as an
+    "azure.token" span with a cache attribute of "hit" or "miss".
+    """
+
+    def __init__(self, credential, tenant_id: str, client_id: str, client_secret: str, token_cache: TokenCache) -> None:
+        self.credential = credential
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_cache = token_cache
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def get_token(self, *scopes: str, claims: str=None, tenant_id: str=None, enable_cae: bool=False, **kwargs):
+        from azure.core.credentials import AccessToken
+
+        # Claims challenges need a fresh token from Azure AD
+        if claims is not None:
+            return self.credential.get_token(*scopes, claims=claims, tenant_id=tenant_id, enable_cae=enable_cae, **kwargs)
+
+        fetch = lambda: self.credential.get_token(*scopes, tenant_id=tenant_id, enable_cae=enable_cae, **kwargs)
+        return AccessToken(*self._token(scopes, tenant_id, enable_cae, fetch))
+
+    def get_token_info(self, *scopes: str, options: dict=None):
+        """Newer azure-core policies call this instead of get_token when the credential has it."""
+        from azure.core.credentials import AccessTokenInfo
+
+        options = dict(options or {})
+        if options.get("claims") is not None:
+            return self._fetch_info(scopes, options)
+
+        fetch = lambda: self._fetch_info(scopes, options)
+        return AccessTokenInfo(*self._token(scopes, options.get("tenant_id"), options.get("enable_cae", False), fetch))
+
+    def _fetch_info(self, scopes: tuple, options: dict):
+        if hasattr(self.credential, "get_token_info"):
+            return self.credential.get_token_info(*scopes, options=options)
+        return self.credential.get_token(*scopes, **options)
+
+    def _token(self, scopes: tuple, tenant_id: str, enable_cae: bool, fetch) -> tuple:
+        """(token, expires_on) from this process, the token cache, or fetch() on a miss."""
+
+        # Tokens that accept continuous access evaluation are kept apart from those that do not
+        key = tuple(scopes) + (("cae",) if enable_cae else ())
+        tenant = tenant_id or self.tenant_id
+        with self.lock:
+            token = self.tokens.get((tenant,) + key)
+            if token is not None and token[1] - self.token_cache.margin > time.time():
+                return token
+
+            with span("azure.token", tenant=tenant, client=self.client_id) as current:
+                token = self.token_cache.get(tenant, self.client_id, self.client_secret, key)
+                if token is not None:
+                    current.set(cache="hit")
+                else:
+                    current.set(cache="miss")
+                    fetched = fetch()
+                    token = (fetched.token, fetched.expires_on)
+                    self.token_cache.set(tenant, self.client_id, self.client_secret, key, *token)
+
+            self.tokens[(tenant,) + key] = token
+            return token
+
+    def close(self) -> None:
+        self.credential.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
 class AzureManagedClusterOperations(ManagedClusterOperations):
 
     def build_cluster_admin_credentials(self, resource_group: str, cluster: str, 
                                             tenant_id: str, client_id: str, client_secret: str, 
-                                            path=os.path.join(os.path.expanduser('~'), '.kube', 'config')) -> None:
+                                            path=os.path.join(os.path.expanduser('~'), '.kube', 'config'),
+                                            subscription_id: str=None, subscription_index_ttl: float=None,
+                                            credential_expiry_margin: float=None, pool_size: int=None, isolated: bool=False, token_cache: bool=True):
+        """
+        Fetch admin credentials, merge them into the kubeconfig at path and return a ClusterConnection.
+
+        With isolated, the credentials go to a private kubeconfig of their own instead, removed at exit.
+        With token_cache, Azure AD tokens are shared with other runs through the on-disk token cache.
+        """
         
         # Log it
-        with console.status("Getting access credentials to managed Kubernetes cluster...", spinner="line") as status:
+        with status(console, "Getting access credentials to managed Kubernetes cluster..."):
 
             # Slow Down for logging output
-            time.sleep(2)
-
-            # Set credentials
-            credentials = ClientSecretCredential(tenant_id, client_id, client_secret, logging_enable=False)
+            pause()
 
             # Set Resource Group If Not Exist
             if resource_group is None: 
                 resource_group = f'rg-do-{cluster}'
 
-            # Subscription Client
-            subscription_client = SubscriptionClient(credentials)
+            # Concurrent runs on one machine must not share a kubeconfig or its current-context
+            if isolated:
+                path = private_kubeconfig()
+
+            # Reuse cached credentials until shortly before the client certificate expires, never on disk when isolated
+            credential_cache = CredentialCache(margin=credential_expiry_margin) if not isolated else None
+            cached_subscription_id = subscription_id or SubscriptionIndex(ttl=subscription_index_ttl).get(tenant_id, resource_group)
+            if credential_cache is not None and cached_subscription_id is not None:
+                kubeconfig = credential_cache.get(cached_subscription_id, resource_group, cluster)
+                if kubeconfig is not None:
+                    document = parse_kubeconfig(kubeconfig)
+                    api_client = self._api_client(document, pool_size)
+
+                    # Rotated credentials are rejected by the API server
+                    if self._is_reachable(api_client):
+                        console.print(f'[bright_green]:heavy_check_mark:[/] [white]Reusing cached credentials for[/] [bright_green]"{cluster}"[/]')
+                        self._merge_credentials(document, path, overwrite_existing=False)
+                        return ClusterConnection(api_client, document.get('current-context'), path)
+                    api_client.close()
+                    credential_cache.discard(cached_subscription_id, resource_group, cluster)
+
+            # The Azure SDK is only imported once credentials have to be fetched
+            from azure.mgmt.containerservice import ContainerServiceClient
 
-            # Get List of All Subscriptions
-            sub_list = subscription_client.subscriptions.list()
+            # Set credentials
+            credentials = self._credentials(tenant_id, client_id, client_secret, token_cache)
 
-            # Set Subscription Where Resource Group Exists
-            for sub in sub_list:
+            # Discover Subscription Unless Pinned
+            if subscription_id is None:
+                subscription_id = self._find_subscription(credentials, tenant_id, resource_group, subscription_index_ttl)
+
+            # Connect to Azure Container Service
+            managed_clusters = traced(ContainerServiceClient(credentials, subscription_id).managed_clusters, "azure.managed_clusters")
+
+            # Get Kubeconfig
+            kubeconfig = managed_clusters.list_cluster_admin_credentials(resource_group, cluster).kubeconfigs[0].value.decode(encoding='UTF-8')
 
+            document = parse_kubeconfig(kubeconfig)
+
+            # Cache Kubeconfig Until Its Certificate Expires
+            expires = None
+            if credential_cache is not None:
                 try:
+                    expires = certificate_expiry(document)
+                except (ValueError, IndexError) as error:
+                    # An unreadable certificate only costs the cache entry, not the deploy
+                    console.print(f'[yellow]:warning: [white]Could not read the client certificate expiry of[/] [bright_magenta]{cluster}[/][white], not caching its credentials:[/] [yellow]{error}[/]')
+            if expires is not None:
+                credential_cache.set(subscription_id, resource_group, cluster, kubeconfig, expires)
+
+            # Build the client before the merge renames the admin context
+            api_client = self._api_client(document, pool_size)
+            self._merge_credentials(document, path, overwrite_existing=False)
+            return ClusterConnection(api_client, document.get('current-context'), path)
+
+    def _credentials(self, tenant_id: str, client_id: str, client_secret: str, token_cache: bool=True):
+        """One credential per service principal for the life of the process, its access tokens are reused until they expire."""
+        from azure.identity import ClientSecretCredential
+
+        key = (tenant_id, client_id, hashlib.sha256((client_secret or "").encode("utf-8")).hexdigest(), token_cache)
+        with credential_objects_lock:
+            if key not in credential_objects:
+                credential = ClientSecretCredential(tenant_id, client_id, client_secret, logging_enable=False)
+
+                # Tokens outlive the process, later runs and other workers on the runner reuse them
+                if token_cache:
+                    credential = PersistentTokenCredential(credential, tenant_id, client_id, client_secret, TokenCache())
+                credential_objects[key] = credential
+            return credential_objects[key]
+
+    def _api_client(self, kubeconfig: dict, pool_size: int=None):
+        """ApiClient for the current context of a parsed kubeconfig, one keep-alive connection pool shared by every call."""
+        from kubernetes import client as kubernetes_client, config as kubernetes_config
+
+        configuration = kubernetes_client.Configuration()
+        kubernetes_config.load_kube_config_from_dict(kubeconfig, client_configuration=configuration, persist_config=False)
+        if pool_size is not None:
+            configuration.connection_pool_maxsize = pool_size
+        return kubernetes_client.ApiClient(configuration)
+
+    def _is_reachable(self, api_client) -> bool:
+        """Cheap authenticated call against the API server, False when it fails."""
+        from kubernetes import client as kubernetes_client
+
+        try:
+            traced(kubernetes_client.CoreV1Api(api_client), "kubernetes").get_api_resources(_request_timeout=5)
+            return True
+        except Exception: # pylint: disable=broad-except
+            return False
 
-                    # Resource Client
-                    resource_client = ResourceManagementClient(credentials, sub.subscription_id)
+    def _find_subscription(self, credentials, tenant_id: str, resource_group: str, ttl: float, max_workers: int=8) -> str:
+        """Subscription holding the resource group, from the on-disk index when it is still valid."""
+        from azure.mgmt.resource import ResourceManagementClient
+        from azure.mgmt.subscription import SubscriptionClient
 
-                    # Check If Resource Group Exists
-                    result_check = resource_client.resource_groups.check_existence(resource_group)
-                    
-                    # Success
-                    if result_check:
+        index = SubscriptionIndex(ttl=ttl)
 
-                        # Set Subscription Id
-                        subscription_id = sub.subscription_id
+        # Index hit - confirm with a single call
+        subscription_id = index.get(tenant_id, resource_group)
+        if subscription_id is not None:
+            try:
+                if traced(ResourceManagementClient(credentials, subscription_id).resource_groups, "azure.resource_groups").check_existence(resource_group):
+                    return subscription_id
+            except Exception: # pylint: disable=broad-except
+                pass
+            index.discard(tenant_id, resource_group)
+
+        # Index miss - probe every subscription the service principal can see, stop at the first match
+        with span("azure.subscriptions.list", kind="client"):
+            subscriptions = list(SubscriptionClient(credentials).subscriptions.list())
+        probes = {
+            sub.subscription_id: (lambda subscription_id=sub.subscription_id:
+                traced(ResourceManagementClient(credentials, subscription_id).resource_groups, "azure.resource_groups").check_existence(resource_group))
+            for sub in subscriptions
+        }
+        subscription_id, results = first_match(probes, max_workers=max_workers)
 
-                # Next Loop
-                except Exception:
-                    pass
+        # Surface slow and failing subscriptions
+        for probed_id, seconds, error in sorted(results, key=lambda result: result[1], reverse=True):
+            if error is not None:
+                console.print(f'[yellow]:warning: [white]Subscription[/] [bright_magenta]{probed_id}[/] [white]failed after {seconds:.2f}s:[/] [yellow]{error}[/]')
+        if results:
+            slowest_id, slowest_seconds, _ = max(results, key=lambda result: result[1])
+            console.print(f'[white]Probed {len(results)} of {len(probes)} subscriptions, slowest[/] [bright_magenta]{slowest_id}[/] [white]({slowest_seconds:.2f}s)[/]')
 
-            # Connect to Azure Container Service
-            container_service_client = ContainerServiceClient(credentials, subscription_id)
+        if subscription_id is not None:
+            index.set(tenant_id, resource_group, subscription_id)
+            return subscription_id
 
-            # Get Kubeconfig
-            kubeconfig = container_service_client.managed_clusters.list_cluster_admin_credentials(resource_group, cluster).kubeconfigs[0].value.decode(encoding='UTF-8')
-            self._merge_credentials(kubeconfig, path, overwrite_existing=False)
+        raise Exception(f'Resource group "{resource_group}" was not found in any subscription')
 
-    def _merge_credentials(self, kubeconfig, path, overwrite_existing=False):
+    def _merge_credentials(self, kubeconfig: dict, path, overwrite_existing=False):
 
-        """Merge an unencrypted kubeconfig into the file at the specified self.path"""
+        """Merge a parsed, unencrypted kubeconfig into the file at the specified self.path"""
 
-        # ensure that at least an empty ~/.kube/config exists
+        # ensure that the ~/.kube directory exists
         directory = os.path.dirname(path)
         if directory and not os.path.exists(directory):
             try:
@@ -110,27 +301,22 @@ class AzureManagedClusterOperations(ManagedClusterOperations):
             except OSError as ex:
                 if ex.errno != errno.EEXIST:
                     raise Exception
-        if not os.path.exists(path):
-            with os.fdopen(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600), 'wt'):
-                pass
 
-        # merge the new kubeconfig into the existing one
-        fd, temp_path = tempfile.mkstemp()
-        additional_file = os.fdopen(fd, 'w+t')
-        try:
-            additional_file.write(kubeconfig)
-            additional_file.flush()
-            self._merge_kubernetes_configurations(path, temp_path, overwrite_existing)
-        except yaml.YAMLError as ex:
-            console.print((f'[red]:cross_mark: [white]Failed to merge credentials to kube config file: %s', ex))
-        finally:
-            additional_file.close()
-            os.remove(temp_path)
+        # concurrent deployments in this process must not lose each other's merges
+        with span("kubeconfig.merge"), kubeconfig_lock:
+            existing = self._load_kubernetes_configuration(path) if os.path.exists(path) else None
+
+            # the loaded document is shared, merge into a copy of its top level
+            if existing is not None:
+                existing = dict(existing)
 
-    def _merge_kubernetes_configurations(self, existing_file, addition_file, replace, context_name=None) -> None:
+            # merge the new kubeconfig into the existing one
+            self._merge_kubernetes_configurations(path, existing, kubeconfig, overwrite_existing)
 
-        existing = self._load_kubernetes_configuration(existing_file)
-        addition = self._load_kubernetes_configuration(addition_file)
+    def _merge_kubernetes_configurations(self, existing_file, existing, addition, replace, context_name=None) -> None:
+
+        if addition is None:
+            raise Exception('failed to load additional configuration')
 
         if context_name is not None:
             addition['contexts'][0]['name'] = context_name
@@ -148,62 +334,35 @@ class AzureManagedClusterOperations(ManagedClusterOperations):
             except (KeyError, TypeError):
                 continue
 
-        if addition is None:
-            raise Exception(f'failed to load additional configuration from {addition_file}')
-
         if existing is None:
             existing = addition
+            changed = True
         else:
-            self._handle_merge(existing, addition, 'clusters', replace)
-            self._handle_merge(existing, addition, 'users', replace)
-            self._handle_merge(existing, addition, 'contexts', replace)
-            existing['current-context'] = addition['current-context']
+            changed = merge_kubeconfig(existing, addition, replace)
+
+        current_context = addition.get('current-context', 'UNKNOWN')
+
+        # Nothing to write when the file already holds these credentials
+        if not changed:
+            console.print(f'[bright_green]:heavy_check_mark: [white]Context[/] [bright_green]"{current_context}"[/] [white]is already current in[/] [bright_magenta]{existing_file}[/]')
+            return
 
         # check that ~/.kube/config is only read and writable by its owner
-        if platform.system() != 'Windows':
-            existing_file_perms = "{:o}".format(stat.S_IMODE(os.lstat(existing_file).st_mode))
+        if platform.system() != 'Windows' and os.path.exists(existing_file):
+            existing_file_perms = "{:o}".format(stat.S_IMODE(os.stat(existing_file).st_mode))
             if not existing_file_perms.endswith('600'):
-                console.print('%s has permissions "%s".\nIt should be readable and writable only by its owner.',
-                            existing_file, existing_file_perms)
+                console.print(f'[yellow]:warning: [white]{existing_file} had permissions "{existing_file_perms}", it is now readable and writable only by its owner.[/]')
 
-        with open(existing_file, 'w+') as stream:
-            yaml.safe_dump(existing, stream, default_flow_style=False)
-
-        current_context = addition.get('current-context', 'UNKNOWN')
+        write_kubeconfig(existing_file, existing)
         console.print(f'[bright_green]:heavy_check_mark: [white]Merged[/] [bright_green]"{current_context}"[/] [white]as current context in[/] [bright_magenta]{existing_file}[/]')
 
     def _load_kubernetes_configuration(self, filename) -> None:
 
         try:
-            with open(filename) as stream:
-                return yaml.safe_load(stream)
+            return load_kubeconfig(filename)
         except (IOError, OSError) as ex:
             if getattr(ex, 'errno', 0) == errno.ENOENT:
                 raise Exception('{} does not exist'.format(filename))
             raise
         except (yaml.parser.ParserError, UnicodeDecodeError) as ex:
             raise Exception('Error parsing {} ({})'.format(filename, str(ex)))
-
-    def _handle_merge(self, existing, addition, key, replace) -> None:
-        if not addition.get(key, False):
-            return
-        if existing[key] is None:
-            existing[key] = addition[key]
-            return
-
-        for i in addition[key]:
-            for j in existing[key]:
-                if not i.get('name', False) or not j.get('name', False):
-                    continue
-                if i['name'] == j['name']:
-                    if replace or i == j:
-                        existing[key].remove(j)
-                    else:
-                        msg = 'A different object named {} already exists in your kubeconfig file.\nOverwrite?'
-                        overwrite = False
-                        if overwrite:
-                            existing[key].remove(j)
-                        else:
-                            msg = 'A different object named {} already exists in {} in your kubeconfig file.'
-                            raise Exception(msg.format(i['name'], key))
-            existing[key].append(i)
\ No newline at end of file
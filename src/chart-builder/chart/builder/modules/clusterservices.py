@@ -1,16 +1,131 @@
-
 from abc import ABC, abstractmethod
-from rich.console import Console
+from concurrent.futures import ThreadPoolExecutor
+
+from rich.markup import escape
 
-from kubernetes import client, config
-from kubernetes.client.exceptions import ApiException
+from chart.builder.modules.cache import cache_directory
+from chart.builder.modules.kubeconfig import load_kubeconfig
+from chart.builder.modules.output import console
+from chart.builder.modules.registry import ProviderRegistry
+from chart.builder.modules.stages import pause, status
+from chart.builder.modules.tracing import propagate, span, traced
 
 import base64
+import hashlib
 import json
-import time
+import os
+import threading
+import weakref
+import yaml
 
 # GLOBAL VARIABLES
-console = Console(color_system="standard")
+field_manager = "chart-builder"
+discovery_clients = weakref.WeakKeyDictionary()
+discovery_lock = threading.Lock()
+
+#----------------------------------------
+# Helper Functions
+#----------------------------------------
+
+def namespace_manifest(namespace: str) -> dict:
+    return {"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": namespace}}
+
+def pull_secret_manifest(name: str, namespace: str, registry: str, username: str, password: str, email: str) -> dict:
+    """Image pull secret for one registry, as kubectl create secret docker-registry writes it."""
+    auth = base64.b64encode(f"{username}:{password}".encode("utf-8")).decode("utf-8")
+    docker_config = {
+        "auths": {
+            registry: {
+                "username": username,
+                "password": password,
+                "email": email,
+                "auth": auth,
+            }
+        }
+    }
+    return {
+        "apiVersion": "v1",
+        "kind": "Secret",
+        "metadata": {"name": name, "namespace": namespace},
+        "type": "kubernetes.io/dockerconfigjson",
+        "data": {".dockerconfigjson": base64.b64encode(json.dumps(docker_config).encode("utf-8")).decode("utf-8")},
+    }
+
+def content_hash(secret_type: str, data: dict) -> str:
+    """Hash of what a secret holds, to tell whether an existing secret needs updating."""
+    return hashlib.sha256(json.dumps({"type": secret_type, "data": data or {}}, sort_keys=True).encode("utf-8")).hexdigest()
+
+def load_manifests(paths: list) -> list:
+    """Every object in the YAML files at paths, files may hold several documents."""
+    manifests = []
+    for path in paths or []:
+        with open(path) as stream:
+            manifests.extend(document for document in yaml.safe_load_all(stream) if document)
+    return manifests
+
+def api_resource(api_client, api_version: str, kind: str):
+    """
+    The API server's description of a kind, its plural name and whether it is namespaced.
+
+    Discovery documents are cached on disk per API server, a kind missing from the cache refreshes it.
+    """
+    from kubernetes.dynamic import DynamicClient
+
+    with discovery_lock:
+        dynamic_client = discovery_clients.get(api_client)
+        if dynamic_client is None:
+            host = api_client.configuration.host
+            cache_file = os.path.join(cache_directory("discovery"), hashlib.sha256(host.encode("utf-8")).hexdigest() + ".json")
+            with span("kubernetes.discovery", kind="client"):
+                dynamic_client = discovery_clients[api_client] = DynamicClient(api_client, cache_file=cache_file)
+        return dynamic_client.resources.get(api_version=api_version, kind=kind)
+
+def manifest_path(manifest: dict, resource) -> str:
+    """API path of the object a manifest describes, e.g. /api/v1/namespaces/default/secrets/registry."""
+    api_version = manifest["apiVersion"]
+    base = f"/api/{api_version}" if "/" not in api_version else f"/apis/{api_version}"
+    metadata = manifest["metadata"]
+    if not resource.namespaced:
+        return f'{base}/{resource.name}/{metadata["name"]}'
+    return f'{base}/namespaces/{metadata["namespace"]}/{resource.name}/{metadata["name"]}'
+
+def apply_manifest(api_client, manifest: dict) -> dict:
+    """
+    Create or update an object in one request with server-side apply.
+
+    Fields chart-builder set before are owned by its field manager, conflicts with other
+    managers are forced so chart-builder's declared state wins.
+    """
+    with span("kubernetes.apply", kind="client", object_kind=manifest["kind"], object_name=manifest["metadata"]["name"]):
+        return api_client.call_api(
+            manifest_path(manifest, api_resource(api_client, manifest["apiVersion"], manifest["kind"])), "PATCH",
+            query_params=[("fieldManager", field_manager), ("force", "true")],
+            header_params={"Content-Type": "application/apply-patch+yaml", "Accept": "application/json"},
+
+            # The client only serializes JSON content types itself, JSON is also valid YAML
+            body=json.dumps(manifest),
+            response_type="object",
+            auth_settings=["BearerToken"],
+            _return_http_data_only=True)
+
+def server_side_apply(api_client, manifests: list, max_workers: int=8) -> list:
+    """
+    Apply manifests concurrently, one request each. Namespaces are applied before the objects that live in them.
+
+    return the applied objects as the API server returned them, in the order given
+    """
+    namespaced = {id(manifest): api_resource(api_client, manifest["apiVersion"], manifest["kind"]).namespaced for manifest in manifests}
+
+    results = {}
+    for group in ([manifest for manifest in manifests if not namespaced[id(manifest)]],
+                  [manifest for manifest in manifests if namespaced[id(manifest)]]):
+        if len(group) == 1:
+            results[id(group[0])] = apply_manifest(api_client, group[0])
+        elif group:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {id(manifest): executor.submit(propagate(apply_manifest), api_client, manifest) for manifest in group}
+                results.update({key: future.result() for key, future in futures.items()})
+    return [results[id(manifest)] for manifest in manifests]
 
 #----------------------------------------
 # Factory Class
@@ -19,13 +134,13 @@ console = Console(color_system="standard")
 class ManagedClusterServicesFactory():
 
     def __init__(self) -> None:
-        self.factories = {
-            "azure": AzureManagedClusterServices()
-        }
+        self.factories = ProviderRegistry("chart_builder.cluster_services", {
+            "azure": "chart.builder.modules.clusterservices:AzureManagedClusterServices"
+        })
     
     def get(self, cluster_services: str=None):
         try:
-            factory = self.factories[cluster_services]
+            factory = self.factories.get(cluster_services)
         except KeyError as err:
             raise Exception(err)
         return factory
@@ -44,92 +159,192 @@ class ManagedClusterServices(ABC):
     def build_registery_credentials(self) -> None:
         pass
 
+    @abstractmethod
+    def build_prerequisites(self) -> None:
+        pass
+
+    @abstractmethod
+    def propagate_registry_credentials(self) -> None:
+        pass
+
+    @abstractmethod
+    def watch_rollout(self) -> None:
+        pass
+
+    @abstractmethod
+    def get_release_fingerprint(self) -> None:
+        pass
+
+    @abstractmethod
+    def set_release_fingerprint(self) -> None:
+        pass
+
 class AzureManagedClusterServices(ManagedClusterServices):
 
-    def build_namespace(self, namespace) -> None:
+    def _api_client(self):
+        """ApiClient for the current context of the default kubeconfig, used when no client is handed in."""
+        from kubernetes import config
+
+        return config.new_client_from_config_dict(load_kubeconfig())
+
+    def build_namespace(self, namespace, api_client=None) -> None:
 
         # Log it
-        with console.status("Creating kubernetes namespace...", spinner="line") as status:
+        with status(console, "Creating kubernetes namespace..."):
 
             # Slow Down for logging output
-            time.sleep(2)
+            pause()
 
-            # Start Timer
             if namespace is not None:
+                server_side_apply(api_client or self._api_client(), [namespace_manifest(namespace)])
+                console.print(f'[bright_green]:heavy_check_mark:[/] [white]Namespace[/] [bright_green]"{namespace}"[/] [white]applied[/]')
 
-                # Load Kubeconfig
-                config.load_kube_config()
+    def build_registery_credentials(self, name: str=None, registry: str=None, username: str=None, password: str=None, namespace: str=None, email: str = "someone@spreetail.com", api_client=None):
 
-                # Configure Client
-                v1 = client.CoreV1Api()
+        # Log it
+        with status(console, "Creating registry credentials..."):
 
-                # Check if Namespace Exists
-                field_selector = f'metadata.name={namespace}'
-                result = v1.list_namespace(field_selector=field_selector).items
+            # Slow Down for logging output
+            pause()
 
-                if not result:
-                    metadata=client.V1ObjectMeta(name=namespace)
-                    v1.create_namespace(client.V1Namespace(metadata))
-                else:
-                    console.print(f'[bright_green]:heavy_check_mark:[/] [white]Namespace[/] [bright_green]"{namespace}"[/] [white]already exists[/]')
+            if name is not None:
+                server_side_apply(api_client or self._api_client(), [pull_secret_manifest(name, namespace, registry, username, password, email)])
+                console.print(f'[bright_green]:heavy_check_mark:[/] [white]Registry credentials[/] [bright_green]"{name}"[/] [white]applied[/]')
+
+    def build_prerequisites(self, namespace: str, manifests: list, api_client=None) -> None:
+        """Apply more objects the release needs in its namespace, such as service accounts, quotas and config maps."""
+
+        if not manifests:
+            return
+
+        api_client = api_client or self._api_client()
 
-    def build_registery_credentials(self, name: str=None, registry: str=None, username: str=None, password: str=None, namespace: str=None, email: str = "someone@spreetail.com"):
-    
         # Log it
-        with console.status("Creating registry credentials...", spinner="line") as status:
+        with status(console, "Applying namespace prerequisites..."):
 
-            # Slow Down for logging output
-            time.sleep(2)
+            # Cluster-scoped objects, such as priority classes, have no namespace to put them in
+            manifests = [dict(manifest, metadata=dict(manifest.get("metadata") or {}, namespace=namespace))
+                if api_resource(api_client, manifest["apiVersion"], manifest["kind"]).namespaced else manifest for manifest in manifests]
+            applied = server_side_apply(api_client, manifests)
+            for result in applied:
+                console.print(f'[bright_green]:heavy_check_mark:[/] [white]{result["kind"]}[/] [bright_green]"{result["metadata"]["name"]}"[/] [white]applied[/]')
 
-            if name is not None:
+    def propagate_registry_credentials(self, name: str, registry: str, username: str, password: str, namespaces: list=None, selector: str=None,
+                                       email: str = "someone@spreetail.com", api_client=None, max_workers: int=None) -> dict:
+        """
+        Put the same registry pull secret in many namespaces, each given by name or matching a label selector.
+
+        Secrets that already hold the same content are left alone, the others are applied concurrently.
+        A namespace that cannot be written is recorded as failed, the others are still written.
+
+        return the namespaces by outcome: {"created": [...], "updated": [...], "unchanged": [...], "failed": [...]},
+        and the error for each failed namespace under "errors"
+        """
+        from kubernetes import client
+
+        api_client = api_client or self._api_client()
+        v1 = traced(client.CoreV1Api(api_client), "kubernetes")
+
+        # Log it
+        with status(console, "Propagating registry credentials..."):
+
+            # Target namespaces
+            targets = set(namespaces or [])
+            if selector is not None:
+                targets.update(item.metadata.name for item in v1.list_namespace(label_selector=selector).items)
 
-                    # Load Kubeconfig
-                    config.load_kube_config()
-
-                    # Configure Client
-                    v1 = client.CoreV1Api()
-
-                    # Check Secret
-                    try: 
-                        result = v1.read_namespaced_secret(name, namespace)
-                    except ApiException as err:
-                        if err.status == 404: # Not found
-                            result = None
-                    
-                    # If secret does not exist, create it
-                    if result is None:
-
-                        # Write docker config 
-                        auth = base64.b64encode(f"{username}:{password}".encode("utf-8")).decode("utf-8")
-                        docker_config_dict = {
-                            "auths": {
-                                registry: {
-                                    "username": username,
-                                    "password": password,
-                                    "email": email,
-                                    "auth": auth,
-                                }
-                            }
-                        }
-
-                        docker_config = base64.b64encode(
-                            json.dumps(docker_config_dict).encode("utf-8")
-                        ).decode("utf-8")
-
-                        try: 
-                            v1.create_namespaced_secret(
-                                namespace=namespace,
-                                body=client.V1Secret(
-                                    metadata=client.V1ObjectMeta(
-                                        name=name,
-                                    ),
-                                    type="kubernetes.io/dockerconfigjson",
-                                    data={".dockerconfigjson": docker_config},
-                                ),
-                            )
-                            console.print(f'[bright_green]:heavy_check_mark:[/] [white]Registry credentials[/] [bright_green]"{name}"[/] [white]created[/]')
-                        except (ApiException, Exception) as err:
-                            raise Exception(err)
+            # The payload is the same in every namespace, build and hash it once
+            desired = pull_secret_manifest(name, None, registry, username, password, email)
+            desired_hash = content_hash(desired["type"], desired["data"])
 
+            # One call finds the secret in every namespace that has it
+            existing = {item.metadata.namespace: content_hash(item.type, item.data)
+                for item in v1.list_secret_for_all_namespaces(field_selector=f'metadata.name={name}').items}
+
+            summary = {"created": [], "updated": [], "unchanged": [], "failed": [], "errors": {}}
+            outcomes = {}
+            for namespace in sorted(targets):
+                if namespace not in existing:
+                    outcomes[namespace] = "created"
+                elif existing[namespace] != desired_hash:
+                    outcomes[namespace] = "updated"
+                else:
+                    summary["unchanged"].append(namespace)
+
+            # One namespace failing, e.g. terminating or denied by a policy, must not hide what happened in the others
+            with ThreadPoolExecutor(max_workers=max_workers or 16) as executor:
+                futures = {namespace: executor.submit(propagate(apply_manifest), api_client, dict(desired, metadata=dict(desired["metadata"], namespace=namespace)))
+                    for namespace in outcomes}
+                for namespace, future in futures.items():
+                    error = future.exception()
+                    if error is None:
+                        summary[outcomes[namespace]].append(namespace)
                     else:
-                        console.print(f'[bright_green]:heavy_check_mark:[/] [white]Registry credentials[/] [bright_green]"{name}"[/] [white]already exists[/]')
+                        summary["failed"].append(namespace)
+                        summary["errors"][namespace] = str(error).strip() or type(error).__name__
+
+        return summary
+
+    def watch_rollout(self, release: str, namespace: str, selector: str=None, timeout: float=300, since=None, label: str=None, api_client=None) -> dict:
+        """Follow the release's workloads until they are ready, raises as soon as one cannot become ready."""
+        from chart.builder.modules.rollout import RolloutWatcher
+
+        # Prefix each line when several deployments share the console, escaped so rich does not read it as a tag
+        prefix = escape(f"[{label}] ") if label else ""
+
+        def progress(name: str, ready: int, desired: int):
+            console.print(f'[bright_green]:heavy_check_mark:[/] [white]{prefix}{name}[/] [bright_green]{ready}/{desired}[/] [white]ready[/]')
+
+        # Log it
+        with status(console, "Watching rollout..."):
+            selector = selector or f'app.kubernetes.io/instance={release}'
+            workloads = RolloutWatcher(api_client or self._api_client(), namespace, selector, timeout=timeout, since=since, on_progress=progress).wait()
+
+        # Either the release has no workloads or the selector misses them, say so rather than pass silently
+        if not workloads:
+            console.print(f'[yellow]:warning: [white]{prefix}No Deployments, StatefulSets, DaemonSets or Jobs match[/] [bright_green]"{escape(selector)}"[/] '
+                f'[white]in namespace[/] [bright_green]"{namespace}"[/][white], nothing to wait for. Set --rollout-selector if the release has workloads.[/]')
+        return workloads
+
+    def _deployed_revision(self, v1, release: str, namespace: str):
+        """Revision of the release helm currently has deployed, from helm's own release secrets."""
+        secrets = v1.list_namespaced_secret(namespace, label_selector=f'owner=helm,name={release},status=deployed').items
+        return secrets[0].metadata.labels.get("version") if secrets else None
+
+    def get_release_fingerprint(self, release: str, namespace: str, api_client=None):
+        """Fingerprint recorded for the deployed revision of a release, None when unknown or helm deployed since."""
+        from kubernetes import client
+        from kubernetes.client.exceptions import ApiException
+
+        v1 = traced(client.CoreV1Api(api_client or self._api_client()), "kubernetes")
+        try:
+            recorded = v1.read_namespaced_config_map(f'chart-builder.{release}', namespace).data or {}
+        except ApiException as err:
+            if err.status == 404: # Not found
+                return None
+            raise
+
+        # A later helm upgrade or rollback outside chart-builder invalidates the fingerprint
+        if recorded.get("revision") != self._deployed_revision(v1, release, namespace):
+            return None
+        return recorded.get("fingerprint")
+
+    def set_release_fingerprint(self, release: str, namespace: str, fingerprint: str, api_client=None) -> None:
+        """Record the fingerprint against the revision helm just deployed."""
+        from kubernetes import client
+        from kubernetes.client.exceptions import ApiException
+
+        v1 = traced(client.CoreV1Api(api_client or self._api_client()), "kubernetes")
+        body = client.V1ConfigMap(
+            metadata=client.V1ObjectMeta(
+                name=f'chart-builder.{release}',
+                labels={"app.kubernetes.io/managed-by": "chart-builder", "app.kubernetes.io/instance": release},
+            ),
+            data={"fingerprint": fingerprint, "revision": self._deployed_revision(v1, release, namespace) or ""},
+        )
+        try:
+            v1.replace_namespaced_config_map(f'chart-builder.{release}', namespace, body)
+        except ApiException as err:
+            if err.status != 404: # Not found
+                raise
+            v1.create_namespaced_config_map(namespace, body)
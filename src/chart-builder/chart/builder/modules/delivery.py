@@ -0,0 +1,239 @@
+from chart.builder.modules.cache import cache_directory
+from chart.builder.modules.tracing import span
+
+import atexit
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+
+#----------------------------------------
+# Helper Functions
+#----------------------------------------
+
+def rejected(err: Exception) -> bool:
+    """Whether the platform refused the events themselves (4xx, e.g. a bad key or payload), so sending them again cannot succeed."""
+    response = getattr(err, "response", None)
+    status = getattr(err, "status", None) or getattr(response, "status_code", None)
+    return isinstance(status, int) and 400 <= status < 500 and status not in (408, 429)
+
+#----------------------------------------
+# Implementation Classes
+#----------------------------------------
+
+class DeliveryWorker():
+    """
+    Delivers events on a background thread so reporting never holds up a deployment.
+
+    Events are handed to send in batches of up to batch_size, a batch goes out once it is
+    full or batch_delay seconds after its first event. Failed batches are retried with
+    exponential backoff, send may remove the events it delivered from the batch so only
+    the rest are retried. Whatever is not delivered by the time the process exits (or the
+    queue is full) is appended to an outbox file and replayed by the next run that uses
+    the same platform.
+
+    Events the platform rejects (4xx) are dropped, not retried or spilled. An outbox entry
+    is dropped once max_attempts runs failed to deliver it or it is older than max_age
+    seconds, and the outbox keeps at most max_outbox entries, the newest.
+    """
+
+    def __init__(self, send, name: str, outbox: str=None, max_queue: int=1000, retries: int=3,
+                    backoff: float=0.5, flush_timeout: float=None, on_delivered=None,
+                    batch_size: int=1, batch_delay: float=0, max_attempts: int=5,
+                    max_age: float=259200, max_outbox: int=1000) -> None:
+        self.send = send
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.name = name
+        self.outbox = outbox
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.retries = retries
+        self.backoff = backoff
+        self.flush_timeout = 5 if flush_timeout is None else flush_timeout
+        self.on_delivered = on_delivered
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.flushing = threading.Event()
+        self.thread = None
+        self.in_flight = None
+        self.abandoned = False
+        self.last_error = None
+        self.max_attempts = max_attempts
+        self.max_age = max_age
+        self.max_outbox = max_outbox
+        self.dropped = 0
+
+        # Outbox attempts and age of replayed events, by id, holding the event so its id is not reused
+        self.replayed = {}
+
+    def start(self) -> None:
+        with self.lock:
+            if self.thread is not None:
+                return
+            if self.outbox is None:
+                self.outbox = os.path.join(cache_directory("outbox"), f"{self.name}.jsonl")
+            self.thread = threading.Thread(target=self._run, name=f"delivery-{self.name}", daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+        self.replay()
+
+    def submit(self, event: dict) -> None:
+        """Queue an event for delivery, never blocks."""
+        self.start()
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self._spill([event])
+
+    def replay(self) -> int:
+        """Queue the events earlier runs could not deliver. Returns how many were queued."""
+        claimed = f"{self.outbox}.{os.getpid()}.{threading.get_ident()}"
+        try:
+            os.replace(self.outbox, claimed)
+        except FileNotFoundError:
+            return 0
+
+        with open(claimed) as stream:
+            entries = [json.loads(line) for line in stream if line.strip()]
+        os.remove(claimed)
+
+        events = []
+        for entry in entries:
+
+            # Entries written before attempts were recorded are plain events
+            if "attempts" not in entry or "event" not in entry:
+                entry = {"event": entry, "attempts": 0, "queued": time.time()}
+            with self.lock:
+                self.replayed[id(entry["event"])] = (entry["event"], entry["attempts"], entry["queued"])
+            events.append(entry["event"])
+
+        for event in events:
+            try:
+                self.queue.put_nowait(event)
+            except queue.Full:
+                self._spill([event])
+        return len(events)
+
+    def flush(self, timeout: float=None) -> int:
+        """Wait up to timeout seconds for queued events, then move the rest to the outbox. Returns how many were moved."""
+        if self.thread is None:
+            return 0
+
+        # Send partial batches straight away
+        self.flushing.set()
+
+        deadline = time.monotonic() + (self.flush_timeout if timeout is None else timeout)
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.queue.all_tasks_done.wait(remaining)
+
+        # Out of time - keep what is left for the next run
+        self.stopping.set()
+        undelivered = []
+        with self.lock:
+            self.abandoned = True
+            if self.in_flight is not None:
+                undelivered.extend(self.in_flight)
+        while True:
+            try:
+                undelivered.append(self.queue.get_nowait())
+                self.queue.task_done()
+            except queue.Empty:
+                break
+
+        self._spill(undelivered)
+        return len(undelivered)
+
+    def _collect(self) -> list:
+        """Wait for an event, then gather more until the batch is full or batch_delay passes. A flush stops the waiting."""
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.flushing.is_set():
+                break
+            try:
+                batch.append(self.queue.get(timeout=min(remaining, 0.05)))
+            except queue.Empty:
+                continue
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            size = len(batch)
+            with self.lock:
+                self.in_flight = batch
+
+            events = list(batch)
+            delivered = self._deliver(batch)
+
+            with self.lock:
+                self.in_flight = None
+                spill = not delivered and not self.abandoned
+                if not spill:
+                    for event in events:
+                        self.replayed.pop(id(event), None)
+            if spill:
+                self._spill(batch)
+            for _ in range(size):
+                self.queue.task_done()
+
+    def _deliver(self, batch: list) -> bool:
+        """Send a batch with retries. False when it should be kept for a later run, True once delivered or rejected."""
+        for attempt in range(self.retries):
+
+            # Back off between attempts, give up at once when the process is exiting
+            if attempt and self.stopping.wait(self.backoff * 2 ** (attempt - 1)):
+                return False
+            try:
+                with span(f"reporter.{self.name}.deliver", kind="client", events=len(batch), attempt=attempt + 1):
+                    self.send(batch)
+                if self.on_delivered is not None:
+                    self.on_delivered(batch)
+                return True
+            except Exception as err: # pylint: disable=broad-except
+                self.last_error = err
+
+                # Sending the same events again gets the same answer, every later run would only resend them
+                if rejected(err):
+                    with self.lock:
+                        self.dropped += len(batch)
+                    return True
+        return False
+
+    def _spill(self, events: list) -> None:
+        if not events:
+            return
+        now = time.time()
+        with self.lock:
+            entries = []
+            for event in events:
+                _, attempts, queued = self.replayed.pop(id(event), (event, 0, now))
+                if attempts + 1 >= self.max_attempts or now - queued > self.max_age:
+                    self.dropped += 1
+                    continue
+                entries.append(json.dumps({"event": event, "attempts": attempts + 1, "queued": queued}) + "\n")
+
+            with open(self.outbox, "a") as stream:
+                stream.writelines(entries)
+
+            # Keep the newest entries once the outbox is full
+            with open(self.outbox) as stream:
+                lines = stream.readlines()
+            if len(lines) > self.max_outbox:
+                self.dropped += len(lines) - self.max_outbox
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.outbox), prefix=".tmp-")
+                with os.fdopen(fd, "w") as stream:
+                    stream.writelines(lines[-self.max_outbox:])
+                os.replace(temp_path, self.outbox)
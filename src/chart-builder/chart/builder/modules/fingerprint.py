@@ -0,0 +1,67 @@
+from chart.builder.modules.cache import exact_version, file_digest
+
+import hashlib
+import os
+
+# GLOBAL VARIABLES
+ignored_options = {"--kubeconfig", "--kube-context"}
+
+#----------------------------------------
+# Helper Functions
+#----------------------------------------
+
+def directory_digest(path: str) -> str:
+    """Digest of every file name and content below a chart directory."""
+    digest = hashlib.sha256()
+    for root, directories, files in os.walk(path):
+        directories.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode("utf-8") + b"\0")
+            digest.update(file_digest(file_path).encode("ascii"))
+    return digest.hexdigest()
+
+def _content_digest(reference: str):
+    if os.path.isdir(reference):
+        return directory_digest(reference)
+    if os.path.isfile(reference):
+        return file_digest(reference)
+    return None
+
+def release_fingerprint(command: list):
+    """
+    Fingerprint of everything a 'helm upgrade' command deploys, or None when it cannot be pinned down.
+
+    Local charts and values files are hashed by content. A repository chart only has a
+    fingerprint when an exact version is requested, and values from a URL never do.
+    """
+    arguments = list(command)
+    digest = hashlib.sha256()
+
+    # helm upgrade --install [release] [chart]
+    chart = arguments[4]
+    chart_digest = _content_digest(chart)
+    if chart_digest is None:
+        version = arguments[arguments.index("--version") + 1] if "--version" in arguments else None
+        if version is None or not exact_version.match(version):
+            return None
+        chart_digest = chart
+    digest.update(arguments[3].encode("utf-8") + b"\0" + chart_digest.encode("utf-8") + b"\0")
+
+    index = 5
+    while index < len(arguments):
+        argument = arguments[index]
+        if argument in ignored_options:
+            index += 2
+            continue
+        if argument == "--values":
+            values_digest = _content_digest(arguments[index + 1])
+            if values_digest is None:
+                return None
+            digest.update(b"--values\0" + values_digest.encode("ascii") + b"\0")
+            index += 2
+            continue
+        digest.update(argument.encode("utf-8") + b"\0")
+        index += 1
+
+    return digest.hexdigest()
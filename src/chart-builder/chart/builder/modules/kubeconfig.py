@@ -0,0 +1,177 @@
+from datetime import datetime, timezone
+
+import atexit
+import base64
+import os
+import shutil
+import ssl
+import tempfile
+import threading
+import yaml
+
+# libyaml is several times faster than the pure-Python parser, fall back when it is not compiled in
+try:
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
+
+# GLOBAL VARIABLES
+default_path = os.path.join(os.path.expanduser('~'), '.kube', 'config')
+parsed = {}
+parsed_lock = threading.Lock()
+
+#----------------------------------------
+# Helper Functions
+#----------------------------------------
+
+def _der_element(data: bytes, offset: int):
+    """Read one DER element at offset. Returns (tag, content start, content end)."""
+    tag, length = data[offset], data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7f
+        length = int.from_bytes(data[offset:offset + size], "big")
+        offset += size
+    return tag, offset, offset + length
+
+def _der_children(data: bytes, start: int, end: int) -> list:
+    children = []
+    while start < end:
+        child = _der_element(data, start)
+        children.append(child)
+        start = child[2]
+    return children
+
+def certificate_not_after(pem: str) -> float:
+    """Expiry of a PEM certificate as a unix timestamp."""
+    der = ssl.PEM_cert_to_DER_cert(pem)
+
+    # Certificate -> tbsCertificate -> [version], serialNumber, signature, issuer, validity
+    _, start, end = _der_element(der, 0)
+    _, start, end = _der_children(der, start, end)[0]
+    fields = _der_children(der, start, end)
+    if fields[0][0] == 0xa0:
+        fields = fields[1:]
+    _, start, end = fields[3]
+    tag, start, end = _der_children(der, start, end)[1]
+
+    value = der[start:end].decode("ascii")
+    layout = "%y%m%d%H%M%SZ" if tag == 0x17 else "%Y%m%d%H%M%SZ"
+    return datetime.strptime(value, layout).replace(tzinfo=timezone.utc).timestamp()
+
+def parse_kubeconfig(text: str) -> dict:
+    return yaml.load(text, Loader=SafeLoader)
+
+def load_kubeconfig(path: str=None) -> dict:
+    """
+    Parsed kubeconfig, parsed again only when the file's mtime or size changes.
+
+    The returned document is shared between callers and must not be mutated, copy it first.
+    """
+    path = os.path.realpath(path or default_path)
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+
+    with parsed_lock:
+        entry = parsed.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+    with open(path) as stream:
+        document = yaml.load(stream, Loader=SafeLoader)
+
+    with parsed_lock:
+        parsed[path] = (key, document)
+    return document
+
+def certificate_expiry(kubeconfig: dict):
+    """Earliest client-certificate expiry across the users of a kubeconfig, None when no user has one."""
+    expiries = []
+    for user in (kubeconfig or {}).get("users") or []:
+        data = (user.get("user") or {}).get("client-certificate-data")
+        if data:
+            expiries.append(certificate_not_after(base64.b64decode(data).decode("ascii")))
+    return min(expiries) if expiries else None
+
+def merge_entries(existing: dict, addition: dict, key: str, replace: bool=False) -> bool:
+    """
+    Merge the named clusters, users or contexts of addition into existing, in place.
+
+    Entries are matched by name through an index, so merging stays linear in the size of
+    both documents. A merged entry moves to the end of the list, like kubectl does.
+
+    return True when existing changed
+    """
+    if not addition.get(key):
+        return False
+    if not existing.get(key):
+        existing[key] = list(addition[key])
+        return True
+
+    entries = list(existing[key])
+    positions = {entry['name']: position for position, entry in enumerate(entries) if entry.get('name')}
+    changed = False
+
+    for entry in addition[key]:
+        name = entry.get('name')
+        position = positions.get(name) if name else None
+        if position is not None:
+            if entries[position] != entry:
+                if not replace:
+                    raise Exception(f'A different object named {name} already exists in {key} in your kubeconfig file.')
+                changed = True
+            entries[position] = None
+        else:
+            changed = True
+        if name:
+            positions[name] = len(entries)
+        entries.append(entry)
+
+    existing[key] = [entry for entry in entries if entry is not None]
+    return changed
+
+def merge_kubeconfig(existing: dict, addition: dict, replace: bool=False) -> bool:
+    """Merge clusters, users, contexts and current-context of addition into existing. Returns True when existing changed."""
+    changed = False
+    for key in ('clusters', 'users', 'contexts'):
+        changed = merge_entries(existing, addition, key, replace) or changed
+    if 'current-context' in addition and existing.get('current-context') != addition['current-context']:
+        existing['current-context'] = addition['current-context']
+        changed = True
+    return changed
+
+def runtime_directory():
+    """A memory-backed directory only this user can write to, None when there is none and the temp directory has to do."""
+    for directory in (os.environ.get("XDG_RUNTIME_DIR"), "/dev/shm"):
+        if directory and os.path.isdir(directory) and os.access(directory, os.W_OK | os.X_OK):
+            return directory
+    return None
+
+def private_kubeconfig() -> str:
+    """
+    Path for a kubeconfig only this run uses, in a new directory only its owner can enter.
+
+    The directory is on tmpfs when there is one, so credentials never reach the disk, and
+    it is removed at exit.
+    """
+    directory = tempfile.mkdtemp(prefix="chart-builder-", dir=runtime_directory())
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    return os.path.join(directory, "config")
+
+def write_kubeconfig(path: str, document: dict) -> None:
+    """Write a kubeconfig readable only by its owner, replacing the old file atomically so readers never see a partial file."""
+    target = os.path.realpath(path)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".kubeconfig-")
+    try:
+        with os.fdopen(fd, 'w') as stream:
+            yaml.dump(document, stream, Dumper=SafeDumper, default_flow_style=False)
+        os.replace(temp_path, target)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    # The written document is already parsed, keep it for the next load
+    stat = os.stat(target)
+    with parsed_lock:
+        parsed[target] = ((stat.st_mtime_ns, stat.st_size), document)
@@ -0,0 +1,121 @@
+from contextlib import nullcontext
+from rich.console import Console
+from rich.text import Text
+
+import contextvars
+import json
+import sys
+import threading
+import time
+import traceback
+
+# GLOBAL VARIABLES
+output_formats = ["text", "ndjson"]
+
+# Fields every event of the current deployment carries, such as release and cluster
+fields = contextvars.ContextVar("output_fields", default={})
+
+# Console and event handler of the current agent job, prints and events go to its stream instead of the process's
+job_output = contextvars.ContextVar("job_output", default=None)
+
+#----------------------------------------
+# Implementation Classes
+#----------------------------------------
+
+class NdjsonWriter():
+    """
+    Writes events as one JSON object per line to a buffered stream.
+
+    Each line is written whole under a lock, so events from concurrent deployments never
+    interleave. Lines are left in the stream's buffer until an event asks for a flush.
+    """
+
+    def __init__(self, stream=None) -> None:
+        self.stream = stream if stream is not None else sys.stdout
+        self.lock = threading.Lock()
+
+    def write(self, event: dict, flush: bool=False) -> None:
+        line = json.dumps(dict({"time": time.time()}, **fields.get(), **event), default=str, separators=(",", ":")) + "\n"
+        with self.lock:
+            self.stream.write(line)
+            if flush:
+                self.stream.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            self.stream.flush()
+
+class NdjsonConsole():
+    """Stands in for a rich Console in ndjson mode. Printed text becomes log events, spinners are dropped."""
+
+    def __init__(self, writer: NdjsonWriter) -> None:
+        self.writer = writer
+
+    def print(self, *objects, markup: bool=True, **kwargs) -> None:
+
+        # Panels and tables are left out, what they show is carried by the events
+        texts = [Text.from_markup(item).plain if markup else item for item in objects if isinstance(item, str)]
+        if texts:
+            self.writer.write({"event": "log", "message": " ".join(texts).strip()})
+
+    def print_exception(self, **kwargs) -> None:
+        self.writer.write({"event": "log", "level": "error", "message": traceback.format_exc()}, flush=True)
+
+    def status(self, *args, **kwargs):
+        return nullcontext()
+
+class SharedConsole():
+    """
+    The console every module prints through.
+
+    Prints go to a rich Console until set_output("ndjson") switches every module to the
+    NDJSON writer at once. Within bind_output they go to the bound console instead.
+    """
+
+    def __init__(self) -> None:
+        self.target = Console(color_system="standard")
+        self.writer = None
+
+    def __getattr__(self, name: str):
+        bound = job_output.get()
+        return getattr(bound[0] if bound is not None else self.target, name)
+
+# Process-wide console, modules import it instead of creating their own
+console = SharedConsole()
+
+#----------------------------------------
+# Helper Functions
+#----------------------------------------
+
+def set_output(output: str=None, stream=None) -> None:
+    """Switch every module to "ndjson" output or back to "text" (the default)."""
+    if output == "ndjson":
+        console.writer = NdjsonWriter(stream)
+        console.target = NdjsonConsole(console.writer)
+    else:
+        console.writer = None
+        console.target = Console(color_system="standard", file=stream)
+
+def ndjson_enabled() -> bool:
+    return console.writer is not None
+
+def event(name: str, **attributes) -> None:
+    """Write a structured event in ndjson mode, nothing in text mode. Events are flushed at once."""
+    bound = job_output.get()
+    if bound is not None:
+        if bound[1] is not None:
+            bound[1](dict(fields.get(), event=name, **attributes))
+    elif console.writer is not None:
+        console.writer.write(dict({"event": name}, **attributes), flush=True)
+
+def bind_output(target, on_event=None):
+    """Send the current context's prints to target and its events to on_event, returns the token to reset them with."""
+    return job_output.set((target, on_event))
+
+def bind(**attributes):
+    """Add fields to every event of the current context, returns the token to reset them with."""
+    return fields.set(dict(fields.get(), **attributes))
+
+def flush() -> None:
+    if console.writer is not None:
+        console.writer.flush()
@@ -1,21 +1,24 @@
 
 from abc import ABC, abstractmethod
 
-from rich.console import Console
 from rich.panel import Panel
 from rich.text import Text
 from rich import box
 
+from chart.builder.modules.cache import ChartCache
+from chart.builder.modules.output import console
+from chart.builder.modules.process import fatal_patterns, run_streaming
+from chart.builder.modules.registry import ProviderRegistry
+from chart.builder.modules.stages import pause, status
+from chart.builder.modules.tracing import span
+
+import json
 import os
 import re
 import subprocess
-import time
+import tempfile
 import textwrap
 
-# GLOBAL VARIABLES
-console = Console(color_system="standard")
-text = Text(no_wrap=True, overflow="ellipsis")
-
 #----------------------------------------
 # Factory Class
 #----------------------------------------
@@ -23,13 +26,13 @@ text = Text(no_wrap=True, overflow="ellipsis")
 class PackageManagerFactory():
 
     def __init__(self) -> None:
-        self.factories = {
-            "helm": HelmPackageManager()
-        }
+        self.factories = ProviderRegistry("chart_builder.package_managers", {
+            "helm": "chart.builder.modules.packagemanager:HelmPackageManager"
+        })
     
     def get(self, package_manager: str=None):
         try:
-            factory = self.factories[package_manager]
+            factory = self.factories.get(package_manager)
         except KeyError as err:
             raise Exception(err)
         return factory
@@ -48,16 +51,27 @@ class PackageManager(ABC):
     def deploy(self) -> None:
         pass
 
+    @abstractmethod
+    def rollback(self) -> None:
+        pass
+
 class HelmPackageManager(PackageManager):
 
     def build(self, release: str, chart: str, repository: str, version: str, namespace: str, 
                     values: list, sets: list, atomic: str, timeout: str, wait: str, 
-                    path=os.path.join(os.path.expanduser('~'), '.kube', 'config')):
+                    path=os.path.join(os.path.expanduser('~'), '.kube', 'config'),
+                    chart_cache: bool=True, chart_cache_ttl: float=None, chart_cache_size: int=None):
 
-        with console.status("Building package manager CLI command...", spinner="line") as status:
+        with status(console, "Building package manager CLI command..."):
             
             # Slow Down for logging output
-            time.sleep(2)
+            pause()
+
+            # Serve repository charts from the local chart cache, helm then skips the repository index
+            if repository is not None and chart_cache:
+                package = self._cached_chart(repository, chart, version, ChartCache(ttl=chart_cache_ttl, max_size=chart_cache_size))
+                if package is not None:
+                    chart, version, repository = package, None, None
             
             # Build 'helm upgrade' command:
             command = [
@@ -85,8 +99,10 @@ class HelmPackageManager(PackageManager):
                 for helm_set in sets:
                     command.extend(["--set", helm_set])
 
-            # Remaining parameters
-            command.extend(["--kubeconfig", path, "--reset-values"])
+            # Remaining parameters, without a path the kubeconfig is only known once the cluster is connected
+            if path is not None:
+                command.extend(["--kubeconfig", path])
+            command.append("--reset-values")
 
             if timeout is not None:
                 command.extend(["--timeout", timeout])
@@ -100,9 +116,33 @@ class HelmPackageManager(PackageManager):
             self.print(command)
             return command
 
+    def _cached_chart(self, repository: str, chart: str, version: str, cache: ChartCache):
+        """Path of the packaged chart in the cache, pulled on a miss. None when it cannot be pulled."""
+
+        package = cache.get(repository, chart, version)
+        if package is not None:
+            console.print(f'[bright_green]:heavy_check_mark:[/] [white]Chart[/] [bright_green]"{chart}"[/] [white]served from cache[/]')
+            return package
+
+        # Pull next to the cache so the package can be moved in without copying
+        with tempfile.TemporaryDirectory(dir=cache.directory) as destination:
+            command = ["helm", "pull", chart, "--repo", repository, "--destination", destination]
+            if version is not None:
+                command.extend(["--version", version])
+
+            with span("helm.pull", kind="client", chart=chart):
+                result = subprocess.run(command, capture_output=True, text=True)
+            packages = [name for name in os.listdir(destination) if name.endswith(".tgz")]
+            if result.returncode or len(packages) != 1:
+                console.print(f'[yellow]:warning: [white]Could not cache chart[/] [bright_green]"{chart}"[/][white], helm will fetch it:[/] [yellow]{result.stderr.strip()}[/]')
+                return None
+
+            return cache.put(repository, chart, version, os.path.join(destination, packages[0]))
+
     def print(self, command: list):
 
             output_command = []
+            text = Text(no_wrap=True, overflow="ellipsis")
 
             for idx, line in enumerate(command):
                 
@@ -149,26 +189,64 @@ class HelmPackageManager(PackageManager):
             # Print Command
             console.print(Panel.fit(text, box=box.SIMPLE, padding=(0,1,0,5)), style="italic")
             
-    def deploy(self, command: list):
-        """Pass in command to subprocess. Output results."""
+    def deploy(self, command: list, context: str=None, fail_patterns: list=None, label: str=None, kubeconfig: str=None):
+        """Pass in command to subprocess. Stream its output. Stop early on errors helm will not recover from."""
+
+        # The connection's kubeconfig, which may be private to this run, replaces the one the command was built with
+        if kubeconfig is not None:
+            command = [kubeconfig if index and command[index - 1] == "--kubeconfig" else argument for index, argument in enumerate(command)]
+            if "--kubeconfig" not in command:
+                command = command + ["--kubeconfig", kubeconfig]
+
+        if context is not None:
+            command = command + ["--kube-context", context]
+
+        # Prefix each line when several deployments share the console
+        prefix = f"[{label}] " if label else ""
 
         # Log it
-        with console.status("Running package manager CLI command...", spinner="line") as status:
+        with status(console, "Running package manager CLI command..."):
             
             # Slow Down for logging output
-            time.sleep(2)
-
-            # Run command
-            result = subprocess.run(command, capture_output=True, text=True)
+            pause()
+
+            # Run command, print output as it arrives
+            console.print("[bright_green]:heavy_check_mark:[/] [white]Package manager CLI output:[/]")
+            with span("helm.upgrade", kind="client") as current:
+                result = run_streaming(command,
+                    on_line=lambda line: console.print(f"     {prefix}{line}", style="bright_green", markup=False, highlight=False),
+                    patterns=fatal_patterns + list(fail_patterns or []))
+                current.set(**{
+                    "process.exit_code": result.returncode,
+                    "process.cpu_seconds": result.cpu_seconds,
+                    "process.max_rss_bytes": result.max_rss,
+                })
 
             # If Error
-            if result.stderr and result.returncode:
-                raise Exception(result.stderr)
-            elif result.stderr:
-                console.print(result.stderr, style="red")
-
-            # If Success
-            if result.stdout:
-                console.print("[bright_green]:heavy_check_mark:[/] [white]Package manager CLI output:[/]")
-                console.print(Panel.fit(f"[bright_green]{result.stdout.rstrip()}[/]", box=box.SIMPLE, padding=(0,1,0,5)))
-
+            if result.fatal is not None:
+                raise Exception(f'Stopped package manager early on: {result.fatal}\n{result.output}')
+            if result.returncode:
+                raise Exception(result.output)
+
+    def rollback(self, release: str, namespace: str=None, context: str=None,
+                 path=os.path.join(os.path.expanduser('~'), '.kube', 'config')) -> None:
+        """Undo a failed release the way --atomic does: uninstall a first install, roll an upgrade back to its previous revision."""
+        options = ["--kubeconfig", path]
+        if namespace is not None:
+            options.extend(["--namespace", namespace])
+        if context is not None:
+            options.extend(["--kube-context", context])
+
+        # helm rollback 0 has no previous revision to return to after a first install
+        history = subprocess.run(["helm", "history", release, "--max", "2", "--output", "json"] + options, capture_output=True, text=True)
+        if history.returncode:
+            raise Exception(f'Rollback of "{release}" failed, its history could not be read:\n{history.stderr.strip()}')
+        revisions = [entry.get("revision") for entry in json.loads(history.stdout or "[]")]
+        first_install = max(revisions, default=1) <= 1
+
+        with status(console, "Uninstalling release..." if first_install else "Rolling back release..."):
+            with span("helm.rollback", kind="client", uninstall=first_install):
+                result = run_streaming((["helm", "uninstall", release] if first_install else ["helm", "rollback", release, "0"]) + options)
+            if result.returncode:
+                raise Exception(f'Rollback of "{release}" failed:\n{result.output}')
+            console.print(f'[bright_green]:heavy_check_mark:[/] [white]Release[/] [bright_green]"{release}"[/] [white]{"uninstalled" if first_install else "rolled back"}[/]')
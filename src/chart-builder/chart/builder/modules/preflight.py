@@ -0,0 +1,645 @@
+from chart.builder.modules.cache import ChartCache, file_digest
+from chart.builder.modules.fingerprint import directory_digest
+from chart.builder.modules.kubeconfig import SafeLoader
+from chart.builder.modules.output import console
+from chart.builder.modules.stages import pause, status
+
+from fractions import Fraction
+
+import copy
+import json
+import math
+import os
+import re
+import tarfile
+import threading
+import yaml
+
+# GLOBAL VARIABLES
+compiled_charts = {}
+compiled_charts_lock = threading.Lock()
+max_index = 65536
+remote_values = re.compile(r'^[A-Za-z][A-Za-z0-9+.-]*://')
+helm_integer = re.compile(r'^[+-]?[0-9]+$')
+
+# Keywords whose checks match helm's exactly, so their result may also be negated (not, oneOf, if)
+exact_keywords = {"type", "enum", "const", "required", "properties", "additionalProperties", "items", "minimum", "maximum",
+    "exclusiveMinimum", "exclusiveMaximum", "multipleOf", "minLength", "maxLength", "minItems", "maxItems", "minProperties",
+    "maxProperties", "allOf", "anyOf", "oneOf", "not", "if", "then", "else"}
+annotation_keywords = {"title", "description", "default", "examples", "$comment", "$schema", "$id", "id", "definitions", "$defs", "readOnly", "writeOnly", "deprecated"}
+
+#----------------------------------------
+# Implementation Classes
+#----------------------------------------
+
+class ValuesLoader(SafeLoader):
+    """
+    SafeLoader that types scalars as helm's YAML parser does, so they validate against the same schema types.
+
+    Dates and sexagesimal numbers such as 1:30 stay strings, and y and n are booleans.
+    """
+
+    yaml_implicit_resolvers = {
+        first: [(tag, regexp) for tag, regexp in resolvers if tag not in {"tag:yaml.org,2002:timestamp", "tag:yaml.org,2002:int", "tag:yaml.org,2002:float", "tag:yaml.org,2002:bool"}]
+        for first, resolvers in SafeLoader.yaml_implicit_resolvers.items()
+    }
+
+ValuesLoader.add_implicit_resolver("tag:yaml.org,2002:bool",
+    re.compile(r'^(?:y|Y|yes|Yes|YES|n|N|no|No|NO|true|True|TRUE|false|False|FALSE|on|On|ON|off|Off|OFF)$'), list("yYnNtTfFoO"))
+ValuesLoader.add_implicit_resolver("tag:yaml.org,2002:int",
+    re.compile(r'^(?:[-+]?0b[0-1_]+|[-+]?0[0-7_]+|[-+]?(?:0|[1-9][0-9_]*)|[-+]?0x[0-9a-fA-F_]+)$'), list("-+0123456789"))
+ValuesLoader.add_implicit_resolver("tag:yaml.org,2002:float",
+    re.compile(r'^(?:[-+]?(?:[0-9][0-9_]*)\.[0-9_]*(?:[eE][-+][0-9]+)?|\.[0-9][0-9_]*(?:[eE][-+][0-9]+)?|[-+]?\.(?:inf|Inf|INF)|\.(?:nan|NaN|NAN))$'), list("-+0123456789."))
+
+# y and n are not booleans to PyYAML's constructor
+ValuesLoader.add_constructor("tag:yaml.org,2002:bool", lambda loader, node: loader.construct_scalar(node).lower() in {"y", "yes", "true", "on"})
+
+class SetParser():
+    """
+    Parses --set expressions the way helm's strvals package does.
+
+    "a.b=1,c[0]=x,d={e,f}" sets nested keys, list items and lists. A backslash escapes the next
+    character. Values become booleans, null or integers where helm would type them, anything
+    else stays a string.
+    """
+
+    def __init__(self, expression: str) -> None:
+        self.expression = expression
+        self.position = 0
+
+    def parse(self, values: dict) -> dict:
+        while self.position < len(self.expression):
+            self._key(values)
+        return values
+
+    def _until(self, stops: str):
+        """Read up to the next unescaped stop character. return (text, stop or None at the end)"""
+        text = []
+        while self.position < len(self.expression):
+            char = self.expression[self.position]
+            self.position += 1
+            if char == "\\" and self.position < len(self.expression):
+                text.append(self.expression[self.position])
+                self.position += 1
+            elif char in stops:
+                return "".join(text), char
+            else:
+                text.append(char)
+        return "".join(text), None
+
+    def _peek(self):
+        return self.expression[self.position] if self.position < len(self.expression) else None
+
+    def _value(self):
+        if self._peek() == "{":
+            self.position += 1
+            items, stop = [], None
+            while stop != "}":
+                item, stop = self._until(",}")
+                if stop is None:
+                    raise ValueError('list value is missing its closing "}"')
+                items.append(typed_value(item))
+
+            # A list value ends the expression or is followed by the next key
+            if self._peek() not in (None, ","):
+                raise ValueError(f'unexpected "{self._peek()}" after list value')
+            self.position += 1
+            return items
+        value, _ = self._until(",")
+        return typed_value(value)
+
+    def _key(self, data: dict) -> None:
+        key, stop = self._until("=[,.")
+        if stop is None:
+            if key:
+                raise ValueError(f'key "{key}" has no value')
+            return
+        if stop == ",":
+            raise ValueError(f'key "{key}" has no value (cannot end with ,)')
+        if stop == "=":
+            data[key] = self._value()
+        elif stop == ".":
+            if not key:
+                raise ValueError("key is empty")
+            if not isinstance(data.get(key), dict):
+                data[key] = {}
+            self._key(data[key])
+        else:
+            data[key] = self._item(data.get(key) if isinstance(data.get(key), list) else [])
+
+    def _item(self, items: list) -> list:
+        index, stop = self._until("]")
+        if stop is None or not helm_integer.match(index):
+            raise ValueError(f'invalid list index "{index}"')
+        index = int(index)
+        if index < 0:
+            raise ValueError(f'negative {index} index not allowed')
+        if index > max_index:
+            raise ValueError(f'index of {index} is greater than maximum supported index {max_index}')
+        items.extend([None] * (index + 1 - len(items)))
+
+        char = self._peek()
+        self.position += 1
+        if char == "=":
+            items[index] = self._value()
+        elif char == ".":
+            if not isinstance(items[index], dict):
+                items[index] = {}
+            self._key(items[index])
+        elif char == "[":
+            items[index] = self._item(items[index] if isinstance(items[index], list) else [])
+        else:
+            raise ValueError(f'key "[{index}]" has no value')
+        return items
+
+#----------------------------------------
+# Helper Functions
+#----------------------------------------
+
+def typed_value(value: str):
+    """
+    A --set value as helm's strvals typedVal types it.
+
+    true, false and null in any case, 0, and 64-bit integers that do not start with a "0" (so
+    "-012" is -12 but "012" stays a string). Anything else is a string.
+    """
+    if value.lower() == "true":
+        return True
+    if value.lower() == "false":
+        return False
+    if value.lower() == "null":
+        return None
+    if value == "0":
+        return 0
+    if value[:1] != "0" and helm_integer.match(value) and -2**63 <= int(value) < 2**63:
+        return int(value)
+    return value
+
+def parse_set(expression: str, values: dict=None) -> dict:
+    """Apply one --set expression to values (a new dict when None) and return it. Raises ValueError when malformed."""
+    return SetParser(expression).parse(values if values is not None else {})
+
+def _string_keys(document):
+    """Keys as helm sees them once values are converted to JSON: 1 becomes "1", true "true"."""
+    if isinstance(document, dict):
+        return {key if isinstance(key, str) else json.dumps(key): _string_keys(value) for key, value in document.items()}
+    if isinstance(document, list):
+        return [_string_keys(item) for item in document]
+    return document
+
+def parse_values(stream) -> dict:
+    """Parse values YAML, raises ValueError when it does not hold a mapping."""
+    document = _string_keys(yaml.load(stream, Loader=ValuesLoader))
+    if document is None:
+        return {}
+    if not isinstance(document, dict):
+        raise ValueError(f'expected a mapping of values, found {type(document).__name__}')
+    return document
+
+def load_values(path: str) -> dict:
+    with open(path) as stream:
+        return parse_values(stream)
+
+def merge_values(base: dict, override: dict) -> dict:
+    """Merge override into base in place, nested maps key by key, as helm merges --values files."""
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge_values(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+def coalesce_values(defaults: dict, values: dict) -> dict:
+    """User values over the chart's defaults. A null user value removes the default, as in helm."""
+    result = copy.deepcopy(values)
+    for key, default in defaults.items():
+        if key not in result:
+            result[key] = copy.deepcopy(default)
+        elif result[key] is None:
+            del result[key]
+        elif isinstance(result[key], dict) and isinstance(default, dict):
+            result[key] = coalesce_values(default, result[key])
+    return result
+
+def chart_files(chart: str) -> dict:
+    """values.yaml and values.schema.json of a chart directory or packaged chart, as text, by file name."""
+    names = ("values.yaml", "values.schema.json")
+    if os.path.isdir(chart):
+        files = {}
+        for name in names:
+            if os.path.isfile(os.path.join(chart, name)):
+                with open(os.path.join(chart, name)) as stream:
+                    files[name] = stream.read()
+        return files
+
+    files = {}
+    with tarfile.open(chart, "r:gz") as archive:
+        for member in archive:
+            if member.isfile() and member.name.count("/") == 1 and member.name.split("/")[1] in names:
+                files[member.name.split("/")[1]] = archive.extractfile(member).read().decode("utf-8")
+    return files
+
+def local_chart(chart: str, repository: str=None, version: str=None, chart_cache: bool=True, chart_cache_ttl: float=None, chart_cache_size: int=None):
+    """
+    Find the chart on disk without a network call.
+
+    return (path, digest), or (None, None) when the chart is remote and not in the chart cache
+    """
+    if repository is None and os.path.isdir(chart):
+        return chart, directory_digest(chart)
+    if repository is None and os.path.isfile(chart):
+        return chart, file_digest(chart)
+
+    # Cached packages are named by their digest
+    if repository is not None and chart_cache:
+        package = ChartCache(ttl=chart_cache_ttl, max_size=chart_cache_size).get(repository, chart, version)
+        if package is not None:
+            return package, os.path.basename(package)[:-len(".tgz")]
+    return None, None
+
+def compiled_chart(path: str, digest: str):
+    """The chart's default values and compiled values.schema.json validator (None without a schema), kept by chart digest."""
+    with compiled_charts_lock:
+        if digest in compiled_charts:
+            return compiled_charts[digest]
+
+    files = chart_files(path)
+    defaults = parse_values(files.get("values.yaml") or "")
+    validator = compile_schema(json.loads(files["values.schema.json"])) if "values.schema.json" in files else None
+
+    with compiled_charts_lock:
+        compiled_charts[digest] = (defaults, validator)
+    return defaults, validator
+
+def _type_name(instance) -> str:
+    if instance is None:
+        return "null"
+    if isinstance(instance, bool):
+        return "boolean"
+    if isinstance(instance, int):
+        return "integer"
+    if isinstance(instance, float):
+        return "integer" if instance.is_integer() else "number"
+    return {str: "string", dict: "object", list: "array"}.get(type(instance), type(instance).__name__)
+
+def _is_type(instance, name: str) -> bool:
+    given = _type_name(instance)
+    return given == name or (name == "number" and given == "integer")
+
+def _path(path: str, key) -> str:
+    return f'{path}.{key}' if path != "(root)" else str(key)
+
+def _pointer(root, reference: str):
+    """Resolve a local $ref such as "#/definitions/image", None when it points elsewhere."""
+    if not reference.startswith("#"):
+        return None
+    target = root
+    for part in [part for part in reference[1:].split("/") if part]:
+        part = part.replace("~1", "/").replace("~0", "~")
+        if isinstance(target, list) and part.isdigit() and int(part) < len(target):
+            target = target[int(part)]
+        elif isinstance(target, dict) and part in target:
+            target = target[part]
+        else:
+            return None
+    return target
+
+def compile_schema(schema) -> object:
+    """
+    Compile a JSON schema into a function that returns the errors of a document, an empty list when it is valid.
+
+    The keywords charts use (type, enum, const, required, properties, additionalProperties,
+    patternProperties, items, numeric, length and pattern limits, allOf, anyOf, oneOf, not,
+    if/then/else and local $ref) are checked. Anything else passes and is left to helm, and so
+    do not, oneOf and if over a schema that uses it, whose result could otherwise be inverted.
+    """
+    references = {}
+    check = _compile(schema, schema, references)
+
+    def validate(document) -> list:
+        errors = []
+        check(document, "(root)", errors)
+        return errors
+    return validate
+
+def _compile(schema, root, references: dict):
+    if schema is True or not isinstance(schema, (dict, bool)):
+        return lambda instance, path, errors: None
+    if schema is False:
+        return lambda instance, path, errors: errors.append(f'{path}: False always fails validation')
+
+    # References are compiled on first use, schemas may refer to themselves. Keywords next to $ref are ignored, as in draft 7
+    if "$ref" in schema:
+        reference = schema["$ref"]
+
+        def check_reference(instance, path, errors):
+            if reference not in references:
+                references[reference] = lambda *args: None
+                target = _pointer(root, reference) if isinstance(reference, str) else None
+                references[reference] = _compile(target, root, references) if target is not None else references[reference]
+            references[reference](instance, path, errors)
+        return check_reference
+
+    checks = []
+
+    if "type" in schema:
+        types = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+
+        def check_type(instance, path, errors):
+            if not any(_is_type(instance, name) for name in types):
+                errors.append(f'{path}: Invalid type. Expected: {" or ".join(types)}, given: {_type_name(instance)}')
+        checks.append(check_type)
+
+    if isinstance(schema.get("enum"), list):
+        allowed = schema["enum"]
+
+        def check_enum(instance, path, errors):
+            if not any(_equal(instance, value) for value in allowed):
+                errors.append(f'{path}: {path} must be one of the following: {", ".join(json.dumps(value) for value in allowed)}')
+        checks.append(check_enum)
+
+    if "const" in schema:
+        const = schema["const"]
+
+        def check_const(instance, path, errors):
+            if not _equal(instance, const):
+                errors.append(f'{path}: {path} does not match: {json.dumps(const)}')
+        checks.append(check_const)
+
+    checks.extend(_number_checks(schema))
+    checks.extend(_string_checks(schema))
+    checks.extend(_array_checks(schema, root, references))
+    checks.extend(_object_checks(schema, root, references))
+    checks.extend(_combinator_checks(schema, root, references))
+
+    def check(instance, path, errors):
+        for item in checks:
+            item(instance, path, errors)
+    return check
+
+def _exact(schema) -> bool:
+    """Whether the checks compiled for a schema are exactly helm's, and not more lenient."""
+    if isinstance(schema, bool):
+        return True
+    if not isinstance(schema, dict) or any(keyword not in exact_keywords and keyword not in annotation_keywords for keyword in schema):
+        return False
+
+    # Draft 4 exclusive limits are booleans, they are not checked
+    if isinstance(schema.get("exclusiveMinimum"), bool) or isinstance(schema.get("exclusiveMaximum"), bool):
+        return False
+
+    # Nested enum values are compared loosely (1 equals true inside a list)
+    scalars = (str, int, float, bool, type(None))
+    if not all(isinstance(value, scalars) for value in (schema.get("enum") if isinstance(schema.get("enum"), list) else [])):
+        return False
+    if "const" in schema and not isinstance(schema["const"], scalars):
+        return False
+
+    subschemas = list((schema.get("properties") or {}).values())
+    for keyword in ("allOf", "anyOf", "oneOf"):
+        subschemas.extend(schema.get(keyword) or [])
+    for keyword in ("additionalProperties", "not", "if", "then", "else"):
+        if keyword in schema:
+            subschemas.append(schema[keyword])
+    items = schema.get("items")
+    subschemas.extend(items if isinstance(items, list) else [items] if items is not None else [])
+    return all(_exact(subschema) for subschema in subschemas)
+
+def _number(value):
+    """A number as an exact fraction of its decimal form, None for infinity and NaN."""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return Fraction(str(value))
+
+def _equal(left, right) -> bool:
+    if isinstance(left, bool) or isinstance(right, bool):
+        return type(left) is type(right) and left == right
+    return left == right
+
+def _number_checks(schema: dict) -> list:
+    checks = []
+    for keyword, fails, message in (
+            ("minimum", lambda value, limit: value < limit, "Must be greater than or equal to {}"),
+            ("maximum", lambda value, limit: value > limit, "Must be less than or equal to {}"),
+            ("exclusiveMinimum", lambda value, limit: value <= limit, "Must be greater than {}"),
+            ("exclusiveMaximum", lambda value, limit: value >= limit, "Must be less than {}"),
+            ("multipleOf", lambda value, limit: limit > 0 and (value / limit).denominator != 1, "Must be a multiple of {}")):
+        limit = schema.get(keyword)
+
+        # Draft 4 spells exclusive limits as booleans next to minimum and maximum
+        if isinstance(limit, bool) or not isinstance(limit, (int, float)) or _number(limit) is None:
+            continue
+
+        # Decimal fractions compared exactly, 0.3 is a multiple of 0.1
+        def check(instance, path, errors, limit=limit, fails=fails, message=message):
+            if _is_type(instance, "number") and _number(instance) is not None and fails(_number(instance), _number(limit)):
+                errors.append(f'{path}: {message.format(limit)}')
+        checks.append(check)
+    return checks
+
+def _string_checks(schema: dict) -> list:
+    checks = []
+    if isinstance(schema.get("minLength"), int):
+        def check_min_length(instance, path, errors, limit=schema["minLength"]):
+            if isinstance(instance, str) and len(instance) < limit:
+                errors.append(f'{path}: String length must be greater than or equal to {limit}')
+        checks.append(check_min_length)
+
+    if isinstance(schema.get("maxLength"), int):
+        def check_max_length(instance, path, errors, limit=schema["maxLength"]):
+            if isinstance(instance, str) and len(instance) > limit:
+                errors.append(f'{path}: String length must be less than or equal to {limit}')
+        checks.append(check_max_length)
+
+    # Patterns Python cannot compile are left to helm
+    if isinstance(schema.get("pattern"), str):
+        try:
+            pattern = re.compile(schema["pattern"])
+        except re.error:
+            pattern = None
+        if pattern is not None:
+            def check_pattern(instance, path, errors):
+                if isinstance(instance, str) and not pattern.search(instance):
+                    errors.append(f'{path}: Does not match pattern \'{pattern.pattern}\'')
+            checks.append(check_pattern)
+    return checks
+
+def _array_checks(schema: dict, root, references: dict) -> list:
+    checks = []
+    items = schema.get("items")
+    if isinstance(items, list):
+        tuple_checks = [_compile(item, root, references) for item in items]
+        def check_tuple(instance, path, errors):
+            if isinstance(instance, list):
+                for index, (item, check) in enumerate(zip(instance, tuple_checks)):
+                    check(item, _path(path, index), errors)
+        checks.append(check_tuple)
+    elif items is not None:
+        item_check = _compile(items, root, references)
+        def check_items(instance, path, errors):
+            if isinstance(instance, list):
+                for index, item in enumerate(instance):
+                    item_check(item, _path(path, index), errors)
+        checks.append(check_items)
+
+    for keyword, fails, message in (
+            ("minItems", lambda count, limit: count < limit, "Array must have at least {} items"),
+            ("maxItems", lambda count, limit: count > limit, "Array must have at most {} items")):
+        if isinstance(schema.get(keyword), int):
+            def check(instance, path, errors, limit=schema[keyword], fails=fails, message=message):
+                if isinstance(instance, list) and fails(len(instance), limit):
+                    errors.append(f'{path}: {message.format(limit)}')
+            checks.append(check)
+
+    if schema.get("uniqueItems") is True:
+        def check_unique(instance, path, errors):
+            if isinstance(instance, list):
+                seen = [json.dumps(item, sort_keys=True, default=str) for item in instance]
+                if len(set(seen)) != len(seen):
+                    errors.append(f'{path}: array items must be unique')
+        checks.append(check_unique)
+    return checks
+
+def _object_checks(schema: dict, root, references: dict) -> list:
+    checks = []
+    properties = {name: _compile(subschema, root, references) for name, subschema in (schema.get("properties") or {}).items()}
+    patterns, additional = [], schema.get("additionalProperties", True)
+    for pattern, subschema in (schema.get("patternProperties") or {}).items():
+        try:
+            patterns.append((re.compile(pattern), _compile(subschema, root, references)))
+        except re.error:
+
+            # Without the pattern there is no telling which properties are additional
+            additional = True
+    additional_check = _compile(additional, root, references) if isinstance(additional, dict) else None
+    required = schema.get("required") if isinstance(schema.get("required"), list) else []
+
+    def check_object(instance, path, errors):
+        if not isinstance(instance, dict):
+            return
+        for name in required:
+            if name not in instance:
+                errors.append(f'{path}: {name} is required')
+        for key, value in instance.items():
+            matched = False
+            if key in properties:
+                properties[key](value, _path(path, key), errors)
+                matched = True
+            for pattern, check in patterns:
+                if pattern.search(str(key)):
+                    check(value, _path(path, key), errors)
+                    matched = True
+            if not matched:
+                if additional is False:
+                    errors.append(f'{path}: Additional property {key} is not allowed')
+                elif additional_check is not None:
+                    additional_check(value, _path(path, key), errors)
+
+    if properties or patterns or required or additional is not True:
+        checks.append(check_object)
+
+    for keyword, fails, message in (
+            ("minProperties", lambda count, limit: count < limit, "Must have at least {} properties"),
+            ("maxProperties", lambda count, limit: count > limit, "Must have at most {} properties")):
+        if isinstance(schema.get(keyword), int):
+            def check(instance, path, errors, limit=schema[keyword], fails=fails, message=message):
+                if isinstance(instance, dict) and fails(len(instance), limit):
+                    errors.append(f'{path}: {message.format(limit)}')
+            checks.append(check)
+    return checks
+
+def _combinator_checks(schema: dict, root, references: dict) -> list:
+    checks = []
+
+    def failures(check, instance, path) -> list:
+        errors = []
+        check(instance, path, errors)
+        return errors
+
+    if isinstance(schema.get("allOf"), list):
+        all_of = [_compile(subschema, root, references) for subschema in schema["allOf"]]
+        def check_all_of(instance, path, errors):
+            for check in all_of:
+                check(instance, path, errors)
+        checks.append(check_all_of)
+
+    if isinstance(schema.get("anyOf"), list):
+        any_of = [_compile(subschema, root, references) for subschema in schema["anyOf"]]
+        def check_any_of(instance, path, errors):
+            if all(failures(check, instance, path) for check in any_of):
+                errors.append(f'{path}: Must validate at least one schema (anyOf)')
+        checks.append(check_any_of)
+
+    # Negated results are only trusted when every schema involved is checked exactly
+    if isinstance(schema.get("oneOf"), list) and all(_exact(subschema) for subschema in schema["oneOf"]):
+        one_of = [_compile(subschema, root, references) for subschema in schema["oneOf"]]
+        def check_one_of(instance, path, errors):
+            if sum(not failures(check, instance, path) for check in one_of) != 1:
+                errors.append(f'{path}: Must validate one and only one schema (oneOf)')
+        checks.append(check_one_of)
+
+    if "not" in schema and _exact(schema["not"]):
+        negated = _compile(schema["not"], root, references)
+        def check_not(instance, path, errors):
+            if not failures(negated, instance, path):
+                errors.append(f'{path}: Must not validate the schema (not)')
+        checks.append(check_not)
+
+    if "if" in schema and _exact(schema["if"]):
+        condition = _compile(schema["if"], root, references)
+        then = _compile(schema.get("then", True), root, references)
+        otherwise = _compile(schema.get("else", True), root, references)
+        def check_condition(instance, path, errors):
+            (then if not failures(condition, instance, path) else otherwise)(instance, path, errors)
+        checks.append(check_condition)
+    return checks
+
+def preflight(chart: str, repository: str=None, version: str=None, values: list=None, sets: list=None,
+                chart_cache: bool=True, chart_cache_ttl: float=None, chart_cache_size: int=None) -> dict:
+    """
+    Check values files, --set expressions and the chart's values.schema.json without a network call.
+
+    Values files from a URL are left to helm. The schema is only checked when the chart is
+    a local path or already in the chart cache. Raises an Exception listing every problem found.
+
+    return the values helm will render the chart with, as far as they are known locally
+    """
+    with status(console, "Validating values and chart inputs..."):
+
+        # Slow Down for logging output
+        pause()
+
+        # Values files in order, later files override earlier ones
+        problems, user_values = [], {}
+        for path in values or []:
+            if remote_values.match(path):
+                continue
+            try:
+                merge_values(user_values, load_values(path))
+            except (OSError, ValueError, yaml.YAMLError) as err:
+                problems.append(f'{path}: {err}')
+
+        # --set expressions are applied over the values files
+        for expression in sets or []:
+            try:
+                parse_set(expression, user_values)
+            except ValueError as err:
+                problems.append(f'--helm-set "{expression}": {err}')
+
+        if problems:
+            raise Exception("Invalid chart inputs:\n- " + "\n- ".join(problems))
+
+        path, digest = local_chart(chart, repository, version, chart_cache, chart_cache_ttl, chart_cache_size)
+        if path is None:
+            console.print(f'[bright_green]:heavy_check_mark:[/] [white]Values parsed, chart[/] [bright_green]"{chart}"[/] [white]is not available locally to validate against[/]')
+            return user_values
+
+        defaults, validator = compiled_chart(path, digest)
+        merged = coalesce_values(defaults, user_values)
+        if validator is not None:
+            errors = validator(merged)
+            if errors:
+                raise Exception(f'Values don\'t meet the specifications of the schema of chart "{chart}":\n- ' + "\n- ".join(errors))
+
+        console.print(f'[bright_green]:heavy_check_mark:[/] [white]Values validated against chart[/] [bright_green]"{chart}"[/]')
+        return merged
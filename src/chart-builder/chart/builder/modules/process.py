@@ -0,0 +1,108 @@
+from collections import deque
+
+import os
+import re
+import subprocess
+import sys
+import time
+
+# GLOBAL VARIABLES
+fatal_patterns = [
+    r"another operation \(install/upgrade/rollback\) is in progress",
+    r"ImagePullBackOff",
+    r"ErrImagePull",
+    r"BackoffLimitExceeded",
+]
+
+#----------------------------------------
+# Implementation Classes
+#----------------------------------------
+
+class ProcessResult():
+
+    def __init__(self, returncode: int, tail: list, fatal: str=None, cpu_seconds: float=None, max_rss: int=None) -> None:
+        self.returncode = returncode
+        self.tail = tail
+        self.fatal = fatal
+        self.cpu_seconds = cpu_seconds
+        self.max_rss = max_rss
+
+    @property
+    def output(self) -> str:
+        return "\n".join(self.tail)
+
+#----------------------------------------
+# Helper Functions
+#----------------------------------------
+
+def _reap(process: subprocess.Popen, timeout: float=None):
+    """
+    Wait for the process like Popen.wait, and return its resource usage.
+
+    Only the exit of this process is collected, so concurrent subprocesses do not mix
+    into each other's usage. Returns None where wait4 is not available.
+    """
+    if not hasattr(os, "wait4"):
+        process.wait(timeout)
+        return None
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        pid, wait_status, usage = os.wait4(process.pid, 0 if deadline is None else os.WNOHANG)
+        if pid:
+            process.returncode = -os.WTERMSIG(wait_status) if os.WIFSIGNALED(wait_status) else os.WEXITSTATUS(wait_status)
+            return usage
+        if time.monotonic() >= deadline:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        time.sleep(0.05)
+
+def run_streaming(command: list, on_line=None, patterns: list=None, tail_lines: int=200, terminate_timeout: float=10,
+                    env: dict=None, cwd: str=None) -> ProcessResult:
+    """
+    Run a command and hand each line of its combined stdout and stderr to on_line as it arrives.
+
+    Only the last tail_lines lines are kept for error reporting. When a line matches one of
+    the fatal patterns the process is terminated instead of waiting for it to time out.
+    The result carries the CPU time and peak memory of the process when the platform reports them.
+
+    :param patterns: Regular expressions that mark a failure the process will not recover from.
+    :type patterns: list
+
+    return ProcessResult
+    """
+    fatal_regex = re.compile("|".join(f"(?:{pattern})" for pattern in patterns)) if patterns else None
+    tail = deque(maxlen=tail_lines)
+    fatal = None
+
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1, env=env, cwd=cwd) as process:
+        try:
+            for line in process.stdout:
+                line = line.rstrip("\n")
+                tail.append(line)
+                if on_line is not None:
+                    on_line(line)
+                if fatal_regex is not None and fatal_regex.search(line):
+                    fatal = line
+                    break
+
+            # Stop early, give the process a chance to clean up before killing it
+            usage = None
+            if fatal is not None:
+                process.terminate()
+                try:
+                    usage = _reap(process, timeout=terminate_timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            if process.returncode is None:
+                usage = _reap(process)
+
+        except BaseException:
+            process.kill()
+            raise
+
+    if usage is None:
+        return ProcessResult(process.returncode, list(tail), fatal)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return ProcessResult(process.returncode, list(tail), fatal, usage.ru_utime + usage.ru_stime, max_rss)
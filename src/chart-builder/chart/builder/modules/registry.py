@@ -0,0 +1,69 @@
+from importlib import import_module
+
+import threading
+
+#----------------------------------------
+# Helper Functions
+#----------------------------------------
+
+def _entry_points(group: str) -> list:
+    """Entry points other installed packages register under group."""
+
+    # importlib.metadata takes longer to import than the built-in providers, and is only in the standard library from Python 3.8
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return []
+    found = entry_points()
+    if hasattr(found, "select"): # Python 3.10+
+        return list(found.select(group=group))
+    return list(found.get(group, []))
+
+def load_reference(reference: str):
+    """Import the object a "module:attribute" reference points at."""
+    module, _, attribute = reference.partition(":")
+    target = import_module(module)
+    for name in attribute.split(".") if attribute else []:
+        target = getattr(target, name)
+    return target
+
+#----------------------------------------
+# Implementation Classes
+#----------------------------------------
+
+class ProviderRegistry():
+    """
+    Providers by name, imported and instantiated only when a run asks for them.
+
+    Built-in providers are given as "module:Class" references, more can be added by any
+    installed package through entry points in group. Each provider is created once, with
+    the registry's arguments, and reused.
+    """
+
+    def __init__(self, group: str, providers: dict, *args, **kwargs) -> None:
+        self.group = group
+        self.providers = dict(providers)
+        self.args = args
+        self.kwargs = kwargs
+        self.instances = {}
+        self.lock = threading.Lock()
+
+    def names(self) -> list:
+        return sorted(set(self.providers) | {entry_point.name for entry_point in _entry_points(self.group)})
+
+    def _reference(self, name: str) -> str:
+        if name in self.providers:
+            return self.providers[name]
+
+        # Only scan installed packages for names that are not built in
+        for entry_point in _entry_points(self.group):
+            if entry_point.name == name:
+                return entry_point.value
+        raise KeyError(name)
+
+    def get(self, name: str):
+        """Provider registered as name, raises KeyError when there is none."""
+        with self.lock:
+            if name not in self.instances:
+                self.instances[name] = load_reference(self._reference(name))(*self.args, **self.kwargs)
+            return self.instances[name]
@@ -1,21 +1,13 @@
 
 from abc import ABC, abstractmethod
-from rich.console import Console
 
-from datadog_api_client import ApiClient, Configuration
-from datadog_api_client.v1.api.events_api import EventsApi
-from datadog_api_client.v1.model.event_alert_type import EventAlertType
-from datadog_api_client.v1.model.event_create_request import EventCreateRequest
+from chart.builder.modules.delivery import DeliveryWorker
+from chart.builder.modules.output import console
+from chart.builder.modules.registry import ProviderRegistry
 
 import gzip
 import json
 import os
-import requests
-import sys
-import time
-
-# GLOBAL VARIABLES
-console = Console(color_system="standard")
 
 #----------------------------------------
 # Factory Class
@@ -23,20 +15,20 @@ console = Console(color_system="standard")
 
 class ReportingServicesFactory():
 
-    def __init__(self) -> None:
-        self.factories = {
-            "datadog": Datadog(),
-            "newrelic": NewRelic(),
-            "local": Local()
-        }
+    def __init__(self, flush_timeout: float=None) -> None:
+        self.factories = ProviderRegistry("chart_builder.reporting_platforms", {
+            "datadog": "chart.builder.modules.reportingservices:Datadog",
+            "newrelic": "chart.builder.modules.reportingservices:NewRelic",
+            "local": "chart.builder.modules.reportingservices:Local"
+        }, flush_timeout)
 
     def get(self, reporter): 
         """Constructs a monitoring platform services factory based on implementation"""
         try:
-            factory = self.factories[reporter]
+            factory = self.factories.get(reporter)
         except KeyError:
             console.print(f'[white]Reporting platform[/] [green]"{reporter}"[/] [white]not supported.[/]')
-            factory = self.factories["local"]
+            factory = self.factories.get("local")
         return factory
 
 #----------------------------------------
@@ -51,109 +43,139 @@ class ReportingServices(ABC):
 
 class Datadog(ReportingServices):
 
+    def __init__(self, flush_timeout: float=None) -> None:
+        self.events_api = None
+        self.delivery = DeliveryWorker(self.send, "datadog", flush_timeout=flush_timeout, batch_size=50, batch_delay=1,
+            on_delivered=lambda events: console.print("[bright_green]:heavy_check_mark:[/] [white]Deployment status reported to Datadog[/]"))
+
     def post_event(self, devops_platform="Gitlab", event_message="Successfully deployed.", event_status="success", **kwargs) -> None:
 
-        # Log it
-        with console.status("Reporting deployment status...", spinner="line") as status:
-            
-            # Slow Down for logging output
-            time.sleep(2)
+        # Set Event Title and Message        
+        event_title = f'Event on pipelines from {devops_platform.capitalize()}'
 
-            # Set Event Title and Message        
-            event_title = f'Event on pipelines from {devops_platform.capitalize()}'
+        # Set Event Title
+        event_tags = []
+        for key, value in kwargs.items():
+            event_tags.append(f'{key}:{value}')
 
-            # Set Event Title
-            event_tags = []
-            for key, value in kwargs.items():
-                event_tags.append(f'{key}:{value}')
+        if devops_platform == "Gitlab":
 
-            if devops_platform == "Gitlab":
+            # Set Source Type Name - https://docs.datadoghq.com/integrations/faq/list-of-api-source-attribute-value/
+            event_tags.append(f'source:{devops_platform}') 
 
-                # Set Source Type Name - https://docs.datadoghq.com/integrations/faq/list-of-api-source-attribute-value/
-                event_tags.append(f'source:{devops_platform}') 
+            # Predefined Variables - https://docs.gitlab.com/ee/ci/variables/predefined_variables.html
+            event_tags.append(f'ci-pipeline-id:{os.environ.get("CI_PIPELINE_ID")}')
+            event_tags.append(f'ci-pipeline-url:{os.environ.get("CI_PIPELINE_URL")}')
+            event_tags.append(f'ci-pipeline-created-at:{os.environ.get("CI_PIPELINE_CREATED_AT")}')
+            event_tags.append(f'ci-pipeline-source:{os.environ.get("CI_PIPELINE_SOURCE")}')
 
-                # Predefined Variables - https://docs.gitlab.com/ee/ci/variables/predefined_variables.html
-                event_tags.append(f'ci-pipeline-id:{os.environ.get("CI_PIPELINE_ID")}')
-                event_tags.append(f'ci-pipeline-url:{os.environ.get("CI_PIPELINE_URL")}')
-                event_tags.append(f'ci-pipeline-created-at:{os.environ.get("CI_PIPELINE_CREATED_AT")}')
-                event_tags.append(f'ci-pipeline-source:{os.environ.get("CI_PIPELINE_SOURCE")}')
+        # Deliver in the background, the deployment never waits on Datadog
+        self.delivery.submit({
+            "title": event_title,
+            "text": event_message,
+            "tags": event_tags,
+            "source_type_name": devops_platform,
+            "alert_type": event_status,
+        })
 
-            # Set Alert Type
-            alert_type = EventAlertType(
-                value = event_status,
-            )
+        if event_status == "error":
+            console.print_exception(extra_lines=5, show_locals=True)
+
+    def send(self, events: list) -> None:
+
+        # Imported on first delivery, runs reporting elsewhere never load the SDK
+        from datadog_api_client import ApiClient, Configuration
+        from datadog_api_client.v1.api.events_api import EventsApi
+        from datadog_api_client.v1.model.event_alert_type import EventAlertType
+        from datadog_api_client.v1.model.event_create_request import EventCreateRequest
+
+        # One client for the life of the process, every event reuses its keep-alive connection
+        if self.events_api is None:
+            configuration = Configuration() # Loads environment variables
+            self.events_api = EventsApi(ApiClient(configuration))
+
+        # The events API takes one event per request, send the batch back to back over the pooled connection
+        while events:
 
             # EventCreateRequest - https://docs.datadoghq.com/api/latest/events/#post-an-event 
+            event = events[0]
             body = EventCreateRequest(
-                title = event_title,
-                text = event_message,
-                tags = event_tags,
-                source_type_name = devops_platform,
-                alert_type = alert_type,
+                title = event["title"],
+                text = event["text"],
+                tags = event["tags"],
+                source_type_name = event["source_type_name"],
+                alert_type = EventAlertType(value = event["alert_type"]),
             )
 
             # Post Event to Datadog Events API
-            configuration = Configuration() # Loads environment variables
-            with ApiClient(configuration) as api_client:
-                api_instance = EventsApi(api_client)
-                response = api_instance.create_event(body=body)
+            self.events_api.create_event(body=body, _request_timeout=10)
 
-            if event_status == "error":
-                console.print_exception(extra_lines=5, show_locals=True)
-                sys.exit(1)
-            else:
-                console.print("[bright_green]:heavy_check_mark:[/] [white]Deployment status reported to Datadog[/]")
+            # Delivered events are not retried with the rest of the batch
+            events.pop(0)
 
 class NewRelic(ReportingServices):
 
+    def __init__(self, flush_timeout: float=None) -> None:
+        self.session = None
+        self.delivery = DeliveryWorker(self.send, "newrelic", flush_timeout=flush_timeout, batch_size=500, batch_delay=1,
+            on_delivered=lambda events: console.print("[bright_green]:heavy_check_mark:[/] [white]Deployment status reported to New Relic[/]"))
+
     def post_event(self, devops_platform="Gitlab", event_message="Successfully deployed.", event_status="success", **kwargs) -> None:
 
-        # Log it
-        with console.status("Reporting deployment status...", spinner="line") as status:
-            
-            # Slow Down for logging output
-            time.sleep(2)
+        content = {
+            "eventType": "Deployments",
+            "source":"gitlab",
+            "status": event_status,
+            "success": "0" if event_status == "error" else "1", # An info event, such as a skipped deployment, did not fail
+            "message":f'{event_message}'
+        }
+
+        for key, value in kwargs.items():
+            if key == "service":
+                content["app_name"] = f'{value}'
+            elif isinstance(value, (int, float)):
+                content[key] = value # Numeric attributes such as stage durations can be charted
+            else:
+                content[key] = f'{value}'
+
+        if devops_platform == "Gitlab":
+            content['ci-pipeline-id'] = os.environ.get("CI_PIPELINE_ID")
+            content["ci-pipeline-url"] = os.environ.get("CI_PIPELINE_URL")
+            content["ci-pipeline-created-at"] = os.environ.get("CI_PIPELINE_CREATED_AT")
+            content["ci-pipeline-source"] = os.environ.get("CI_PIPELINE_SOURCE")
+
+        # Deliver in the background, the deployment never waits on New Relic
+        self.delivery.submit(content)
+
+        if event_status == "error":
+            console.print_exception(extra_lines=5, show_locals=True)
+
+    def send(self, events: list) -> None:
 
-            url = f'https://insights-collector.newrelic.com/v1/accounts/{os.environ.get("NEW_RELIC_ACCOUNT_ID")}/events'
+        import requests
 
-            headers = {
+        # One session for the life of the process, every batch reuses its keep-alive connection
+        if self.session is None:
+            self.session = requests.Session()
+            self.session.headers.update({
                 "Content-Type": "application/json",
                 "X-Insert-Key": os.environ.get("NEW_RELIC_INSERT_KEY"),
                 "Content-Encoding": "gzip",
-            }
-
-            content = {
-                "eventType": "Deployments",
-                "source":"gitlab",
-                "status": event_status,
-                "success": "1" if event_status == "success" else "0",
-                "message":f'{event_message}'
-            }
-
-            for key, value in kwargs.items():
-                if key == "service":
-                    content["app_name"] = f'{value}'
-                else:
-                    content[key] = f'{value}'
-
-            if devops_platform == "Gitlab":
-                content['ci-pipeline-id'] = os.environ.get("CI_PIPELINE_ID")
-                content["ci-pipeline-url"] = os.environ.get("CI_PIPELINE_URL")
-                content["ci-pipeline-created-at"] = os.environ.get("CI_PIPELINE_CREATED_AT")
-                content["ci-pipeline-source"] = os.environ.get("CI_PIPELINE_SOURCE")
-            
-            response = requests.post(url, headers=headers, data=gzip.compress(json.dumps(content).encode('utf-8')),)
-
-            if event_status == "error":
-                console.print_exception(extra_lines=5, show_locals=True)
-                sys.exit(1)
-            else:
-                console.print("[bright_green]:heavy_check_mark:[/] [white]Deployment status reported to New Relic[/]")
+            })
+
+        # NEW_RELIC_EVENTS_URL points at another collector, e.g. the EU region's
+        url = os.environ.get("NEW_RELIC_EVENTS_URL") or f'https://insights-collector.newrelic.com/v1/accounts/{os.environ.get("NEW_RELIC_ACCOUNT_ID")}/events'
+
+        # The event API takes an array of events, the whole batch goes out as one gzip payload
+        response = self.session.post(url, data=gzip.compress(json.dumps(events).encode('utf-8')), timeout=10)
+        response.raise_for_status()
 
 class Local(ReportingServices):
 
+    def __init__(self, flush_timeout: float=None) -> None:
+        pass
+
     def post_event(self, devops_platform="Gitlab", event_message="Successfully deployed.", event_status="success", **kwargs) -> None:
 
         if event_status == "error":
             console.print_exception(extra_lines=5, show_locals=True)
-            sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,238 @@
+from datetime import datetime, timezone
+
+from chart.builder.modules.tracing import propagate, span
+
+import queue
+import re
+import threading
+import time
+
+# GLOBAL VARIABLES
+terminal_reasons = {"CrashLoopBackOff", "ImagePullBackOff", "ErrImagePull", "InvalidImageName", "CreateContainerConfigError", "CreateContainerError", "RunContainerError"}
+
+#----------------------------------------
+# Helper Functions
+#----------------------------------------
+
+def duration_seconds(duration: str, default: float=300) -> float:
+    """Seconds in a helm style duration such as "5m0s" or "90s", default when none is given."""
+    if not duration:
+        return default
+    parts = re.findall(r"(\d+(?:\.\d+)?)(h|ms|m|s)", duration)
+    if not parts:
+        return float(duration)
+    return sum(float(value) * {"h": 3600, "m": 60, "s": 1, "ms": 0.001}[unit] for value, unit in parts)
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+def pod_failure(pod, since: datetime=None):
+    """Why a pod will not become ready on its own, None while it may still start. Pods created before since are ignored."""
+    if since is not None and pod.metadata.creation_timestamp is not None and pod.metadata.creation_timestamp < since:
+        return None
+
+    statuses = list(pod.status.init_container_statuses or []) + list(pod.status.container_statuses or [])
+    for container in statuses:
+        waiting = container.state.waiting if container.state is not None else None
+        if waiting is not None and waiting.reason in terminal_reasons:
+            return f'container "{container.name}" {waiting.reason}: {waiting.message or ""}'.rstrip(": ")
+
+    # Job pods may fail and be retried, the job reports when it gives up
+    owners = [owner.kind for owner in pod.metadata.owner_references or []]
+    if pod.status.phase == "Failed" and "Job" not in owners:
+        return f'{pod.status.reason or "Failed"}: {pod.status.message or ""}'.rstrip(": ")
+    return None
+
+def _condition(workload, condition_type: str):
+    for condition in workload.status.conditions or []:
+        if condition.type == condition_type:
+            return condition
+    return None
+
+def workload_progress(kind: str, workload):
+    """
+    How far a workload has rolled out.
+
+    return (ready, desired, failure), failure is None unless the workload will not become ready on its own
+    """
+    spec, status = workload.spec, workload.status
+
+    if kind == "Job":
+        failed = _condition(workload, "Failed")
+        if failed is not None and failed.status == "True":
+            return status.succeeded or 0, spec.completions or 1, f'{failed.reason}: {failed.message or ""}'.rstrip(": ")
+        return status.succeeded or 0, spec.completions or 1, None
+
+    # A daemon set runs one pod on every node it is scheduled to
+    desired = status.desired_number_scheduled or 0 if kind == "DaemonSet" else spec.replicas if spec.replicas is not None else 1
+
+    # Status describes an older generation until the controller has observed the new spec
+    if (status.observed_generation or 0) < (workload.metadata.generation or 0):
+        return 0, desired, None
+
+    if kind == "DaemonSet":
+
+        # Pods of an OnDelete daemon set are only replaced when deleted, there is no rollout to wait for
+        if spec.update_strategy is not None and spec.update_strategy.type == "OnDelete":
+            return desired, desired, None
+        if (status.updated_number_scheduled or 0) < desired:
+            return min(status.updated_number_scheduled or 0, status.number_available or 0), desired, None
+        return status.number_available or 0, desired, None
+
+    if kind == "Deployment":
+        progressing = _condition(workload, "Progressing")
+        if progressing is not None and progressing.reason == "ProgressDeadlineExceeded":
+            return status.available_replicas or 0, desired, progressing.message or progressing.reason
+
+        # Old replicas still running count against the rollout
+        if (status.updated_replicas or 0) < desired or (status.replicas or 0) > (status.updated_replicas or 0):
+            return min(status.updated_replicas or 0, status.available_replicas or 0), desired, None
+        return status.available_replicas or 0, desired, None
+
+    if kind == "StatefulSet":
+        if status.update_revision and status.current_revision != status.update_revision and (status.updated_replicas or 0) < desired:
+            return min(status.updated_replicas or 0, status.ready_replicas or 0), desired, None
+        return status.ready_replicas or 0, desired, None
+
+    return 0, desired, None
+
+#----------------------------------------
+# Implementation Classes
+#----------------------------------------
+
+class RolloutWatcher():
+    """
+    Follows a release's Deployments, StatefulSets, DaemonSets, Jobs and Pods through watch streams until every workload is ready.
+
+    Each kind is listed once and then watched from that list's resource version, so no change
+    is missed and nothing is polled. A pod that cannot start (CrashLoopBackOff, ImagePullBackOff
+    and the like), a failed job or a deployment past its progress deadline fails the rollout
+    at once instead of at the timeout.
+    """
+
+    def __init__(self, api_client, namespace: str, selector: str, timeout: float=300, since: datetime=None, on_progress=None, sources: dict=None) -> None:
+        self.namespace = namespace
+        self.selector = selector
+        self.timeout = timeout
+        self.since = since
+        self.on_progress = on_progress
+        self.sources = sources if sources is not None else self._sources(api_client)
+        self.events = queue.Queue()
+        self.stopped = threading.Event()
+        self.watches = []
+        self.lock = threading.Lock()
+
+    def _sources(self, api_client) -> dict:
+        """List functions by kind. Watches need the generated API methods themselves, they read the returned type from their docstrings."""
+        from kubernetes import client
+
+        apps, batch, core = client.AppsV1Api(api_client), client.BatchV1Api(api_client), client.CoreV1Api(api_client)
+        return {
+            "Deployment": apps.list_namespaced_deployment,
+            "StatefulSet": apps.list_namespaced_stateful_set,
+            "DaemonSet": apps.list_namespaced_daemon_set,
+            "Job": batch.list_namespaced_job,
+            "Pod": core.list_namespaced_pod,
+        }
+
+    def _watch(self, list_func, resource_version: str, timeout_seconds: int):
+        from kubernetes import watch
+
+        stream = watch.Watch()
+        with self.lock:
+            self.watches.append(stream)
+        return stream.stream(list_func, self.namespace, label_selector=self.selector, resource_version=resource_version, timeout_seconds=timeout_seconds)
+
+    def _follow(self, kind: str, list_func) -> None:
+        """List, then watch one kind until stopped. Runs on its own thread and hands everything to the events queue."""
+        from kubernetes.client.exceptions import ApiException
+
+        synced = False
+        while not self.stopped.is_set():
+            try:
+                listed = list_func(self.namespace, label_selector=self.selector)
+                for item in listed.items:
+                    self.events.put((kind, "ADDED", item))
+                if not synced:
+                    self.events.put((kind, "SYNCED", None))
+                    synced = True
+
+                for event in self._watch(list_func, listed.metadata.resource_version, max(int(self.timeout), 1)):
+                    if self.stopped.is_set():
+                        return
+                    self.events.put((kind, event["type"], event["object"]))
+
+            except ApiException as err:
+
+                # The resource version is too old to watch from, list again
+                if err.status == 410:
+                    continue
+                self.events.put((kind, "ERROR", err))
+                return
+            except Exception as err: # pylint: disable=broad-except
+                self.events.put((kind, "ERROR", err))
+                return
+
+    def stop(self) -> None:
+        self.stopped.set()
+        with self.lock:
+            for stream in self.watches:
+                stream.stop()
+
+    def wait(self) -> dict:
+        """
+        Block until every workload is ready. Raises an Exception on the first terminal failure or at the timeout.
+
+        return (ready, desired) by "Kind/name" for every workload followed, empty when the release has none to wait for
+        """
+        with span("rollout.watch", namespace=self.namespace, selector=self.selector):
+            for kind, list_func in self.sources.items():
+                threading.Thread(target=propagate(self._follow), args=(kind, list_func), daemon=True).start()
+
+            try:
+                return self._wait()
+            finally:
+                self.stop()
+
+    def _wait(self) -> dict:
+        deadline = time.monotonic() + self.timeout
+        synced, workloads, reported = set(), {}, {}
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                waiting = [f"{name} {ready}/{desired}" for name, (ready, desired) in workloads.items() if ready < desired]
+                raise Exception(f'Rollout did not finish within {self.timeout:g}s, waiting for: {", ".join(waiting) or "workloads to be listed"}')
+
+            try:
+                kind, event_type, item = self.events.get(timeout=min(remaining, 1))
+            except queue.Empty:
+                continue
+
+            if event_type == "ERROR":
+                raise item
+            if event_type == "SYNCED":
+                synced.add(kind)
+            elif kind == "Pod":
+                failure = pod_failure(item, self.since) if event_type != "DELETED" else None
+                if failure is not None:
+                    raise Exception(f'Pod "{item.metadata.name}" cannot start, {failure}')
+            else:
+                name = f"{kind}/{item.metadata.name}"
+                if event_type == "DELETED":
+                    workloads.pop(name, None)
+                    continue
+                ready, desired, failure = workload_progress(kind, item)
+                if failure is not None:
+                    raise Exception(f'{name} failed, {failure}')
+                workloads[name] = (ready, desired)
+
+                # Report progress as it changes
+                if reported.get(name) != (ready, desired):
+                    reported[name] = (ready, desired)
+                    if self.on_progress is not None:
+                        self.on_progress(name, ready, desired)
+
+            # A release of only CronJobs or config has nothing to wait for, as with helm --wait
+            if len(synced) == len(self.sources) and all(ready >= desired for ready, desired in workloads.values()):
+                return workloads
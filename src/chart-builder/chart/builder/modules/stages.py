@@ -0,0 +1,165 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager, nullcontext
+
+from chart.builder.modules.output import event
+from chart.builder.modules.tracing import propagate, span
+
+import threading
+import time
+
+# GLOBAL VARIABLES
+demo_mode = threading.Event()
+live_display = threading.Lock()
+
+#----------------------------------------
+# Helper Functions
+#----------------------------------------
+
+def set_demo_mode(enabled: bool) -> None:
+    """Turn the cosmetic pauses between stages on or off."""
+    if enabled:
+        demo_mode.set()
+    else:
+        demo_mode.clear()
+
+def pause(seconds: float=2) -> None:
+    """Slow down for logging output, only when running in demo mode."""
+    if demo_mode.is_set():
+        time.sleep(seconds)
+
+@contextmanager
+def status(console: object, message: str):
+    """
+    Show a spinner for the current stage unless another stage already owns the live display.
+
+    Stages run concurrently, and two rich live displays cannot share a terminal.
+    """
+    acquired = live_display.acquire(blocking=False)
+    try:
+        with console.status(message, spinner="line") if acquired else nullcontext():
+            yield
+    finally:
+        if acquired:
+            live_display.release()
+
+def first_match(probes: dict, max_workers: int=8):
+    """
+    Run probes concurrently and stop at the first one that returns a truthy result.
+
+    Probes that have not started are cancelled once a match is found, probes already
+    running are left to finish in the background.
+
+    :param probes: Callables by key.
+    :type probes: dict
+
+    return (matching key or None, list of (key, seconds, error) for every probe that finished)
+    """
+
+    def timed(probe):
+        start = time.perf_counter()
+        try:
+            return bool(probe()), time.perf_counter() - start, None
+        except Exception as err: # pylint: disable=broad-except
+            return False, time.perf_counter() - start, err
+
+    match, results = None, []
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        running = {executor.submit(propagate(timed), probe): key for key, probe in probes.items()}
+        while running and match is None:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                found, seconds, error = future.result()
+                results.append((key, seconds, error))
+                if found and match is None:
+                    match = key
+        for future in running:
+            future.cancel()
+    finally:
+        executor.shutdown(wait=False)
+
+    return match, results
+
+#----------------------------------------
+# Implementation Classes
+#----------------------------------------
+
+class Stage():
+
+    def __init__(self, name: str, func, requires: list=None) -> None:
+        self.name = name
+        self.func = func
+        self.requires = list(requires or [])
+
+class StageExecutor():
+
+    def __init__(self, stages: list, max_workers: int=4, on_stage=None) -> None:
+        self.stages = {stage.name: stage for stage in stages}
+        self.max_workers = max_workers
+        self.on_stage = on_stage
+        self.results = {}
+        self.durations = {}
+
+        # Validate dependencies
+        for stage in stages:
+            for requirement in stage.requires:
+                if requirement not in self.stages:
+                    raise Exception(f'Stage "{stage.name}" requires unknown stage "{requirement}"')
+
+    def run(self) -> dict:
+        """Run every stage as soon as the stages it requires have finished. Returns results by stage name."""
+
+        pending = dict(self.stages)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+
+            while pending or running:
+
+                # Submit stages whose requirements are met
+                for name, stage in list(pending.items()):
+                    if all(requirement in self.results for requirement in stage.requires):
+                        running[executor.submit(propagate(self._run_stage), stage)] = name
+                        del pending[name]
+                        self._notify(name, "started")
+
+                if not running:
+                    raise Exception(f'Stages could not be scheduled (circular requirements): {", ".join(pending)}')
+
+                # Wait for the next stage to finish
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        self._notify(name, "failed")
+
+                        # Stop scheduling, let running stages finish, surface the first failure
+                        for other in running:
+                            other.cancel()
+                        raise error
+
+                    self.results[name] = future.result()
+                    self._notify(name, "finished")
+
+        return self.results
+
+    def _run_stage(self, stage: Stage):
+        """Run one stage as a "stage.<name>" span, its duration is kept and reported whether it succeeds or fails."""
+        with span(f"stage.{stage.name}") as current:
+            event("stage", stage=stage.name, status="started")
+            try:
+                result = stage.func()
+            except BaseException as err:
+                self.durations[stage.name] = time.perf_counter() - current.perf_start
+                event("stage", stage=stage.name, status="failed", seconds=round(self.durations[stage.name], 3), error=str(err) or type(err).__name__)
+                raise
+            self.durations[stage.name] = time.perf_counter() - current.perf_start
+            event("stage", stage=stage.name, status="finished", seconds=round(self.durations[stage.name], 3))
+            return result
+
+    def _notify(self, name: str, state: str) -> None:
+        """Report a stage starting, finishing or failing to on_stage."""
+        if self.on_stage is not None:
+            self.on_stage(name, state)
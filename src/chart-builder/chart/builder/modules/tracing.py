@@ -0,0 +1,249 @@
+from collections import deque
+from contextlib import contextmanager
+
+import contextvars
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+
+# GLOBAL VARIABLES
+current_span = contextvars.ContextVar("current_span", default=None)
+span_kinds = {"internal": 1, "client": 3}
+
+#----------------------------------------
+# Implementation Classes
+#----------------------------------------
+
+class Span():
+    """One timed operation. Spans started while another is current on the same thread or context become its children."""
+
+    def __init__(self, tracer, name: str, parent=None, kind: str="internal", attributes: dict=None) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent is not None else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time_ns()
+        self.end_time = None
+        self.error = None
+        self.token = None
+        self.perf_start = time.perf_counter()
+        self.seconds = None
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def end(self, error: BaseException=None) -> None:
+        self.seconds = time.perf_counter() - self.perf_start
+        self.end_time = self.start_time + int(self.seconds * 1e9)
+        if error is not None:
+            self.error = str(error) or type(error).__name__
+        if self.token is not None:
+            current_span.reset(self.token)
+            self.token = None
+        self.tracer.record(self)
+
+class Tracer():
+    """
+    Keeps the last max_spans finished spans of the process for OTLP export.
+
+    Metrics are updated as each span finishes, so they cover every span of the process, not only the last max_spans.
+    """
+
+    def __init__(self, max_spans: int=10000) -> None:
+        self.finished = deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+
+        # Running totals and the latest gauges for the Prometheus export
+        self.totals = {}
+        self.tokens = {"hit": 0, "miss": 0}
+        self.stages = {}
+        self.helm = {}
+
+        # Stage durations and helm usage of traces whose root span is still open
+        self.open_traces = {}
+
+    def record(self, span: Span) -> None:
+        with self.lock:
+            self.finished.append(span)
+
+            count, seconds = self.totals.get(span.name, (0, 0.0))
+            self.totals[span.name] = (count + 1, seconds + span.seconds)
+            if span.name == "azure.token" and span.attributes.get("cache") in self.tokens:
+                self.tokens[span.attributes["cache"]] += 1
+
+            if span.name.startswith("stage."):
+                self.open_traces.setdefault(span.trace_id, {"stages": {}})["stages"][span.name[len("stage."):]] = span.seconds
+            elif span.name == "helm.upgrade":
+                self.open_traces.setdefault(span.trace_id, {"stages": {}})["helm"] = span.attributes
+
+            # Release and cluster are set once, on the deployment span at the root of the trace, which finishes last
+            if span.parent_id is None:
+                trace = self.open_traces.pop(span.trace_id, {"stages": {}})
+                labels = (span.attributes.get("release"), span.attributes.get("cluster"))
+                self.stages.update({labels + (stage,): seconds for stage, seconds in trace["stages"].items()})
+                if "helm" in trace:
+                    self.helm[labels] = trace["helm"]
+
+    def spans(self, name: str=None) -> list:
+        with self.lock:
+            return [span for span in self.finished if name is None or span.name == name]
+
+    def otlp(self) -> dict:
+        """Spans in the OpenTelemetry protocol's JSON encoding, as accepted by OTLP/HTTP collectors."""
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": _otlp_attributes({"service.name": "chart-builder"})},
+                "scopeSpans": [{
+                    "scope": {"name": "chart.builder"},
+                    "spans": [_otlp_span(span) for span in self.spans()],
+                }],
+            }],
+        }
+
+    def prometheus(self) -> str:
+        """
+        Spans as Prometheus text exposition, for the node exporter's textfile collector.
+
+        Every span name gets a duration summary. Stage durations and helm resource usage of
+        the latest run of each release and cluster are exported as gauges, Azure AD token
+        cache hits and misses as a counter.
+        """
+        with self.lock:
+            totals, stages, helm, tokens = dict(self.totals), dict(self.stages), dict(self.helm), dict(self.tokens)
+
+        lines = [
+            "# HELP chart_builder_span_seconds Time spent in each kind of span.",
+            "# TYPE chart_builder_span_seconds summary",
+        ]
+        for name, (count, seconds) in sorted(totals.items()):
+            lines.append(f'chart_builder_span_seconds_sum{{span="{_escape(name)}"}} {seconds:.6f}')
+            lines.append(f'chart_builder_span_seconds_count{{span="{_escape(name)}"}} {count}')
+
+        lines.extend([
+            "# HELP chart_builder_stage_seconds Duration of each stage of the latest deployment.",
+            "# TYPE chart_builder_stage_seconds gauge",
+        ])
+        for (release, cluster, stage), seconds in stages.items():
+            lines.append(f'chart_builder_stage_seconds{{release="{_escape(release)}",cluster="{_escape(cluster)}",stage="{_escape(stage)}"}} {seconds:.6f}')
+
+        for metric, attribute, description in (
+                ("chart_builder_helm_cpu_seconds", "process.cpu_seconds", "CPU time of the latest helm upgrade."),
+                ("chart_builder_helm_max_rss_bytes", "process.max_rss_bytes", "Peak resident memory of the latest helm upgrade.")):
+            lines.extend([f"# HELP {metric} {description}", f"# TYPE {metric} gauge"])
+            for (release, cluster), attributes in helm.items():
+                if attributes.get(attribute) is not None:
+                    lines.append(f'{metric}{{release="{_escape(release)}",cluster="{_escape(cluster)}"}} {attributes[attribute]}')
+
+        lines.extend([
+            "# HELP chart_builder_azure_token_cache_total Azure AD token lookups in the on-disk token cache, a hit saves a token request.",
+            "# TYPE chart_builder_azure_token_cache_total counter",
+        ])
+        for result, count in tokens.items():
+            lines.append(f'chart_builder_azure_token_cache_total{{result="{result}"}} {count}')
+
+        return "\n".join(lines) + "\n"
+
+class TracedClient():
+    """Stands in for an SDK client and times each of its method calls as a client span named "<prefix>.<method>"."""
+
+    def __init__(self, client, prefix: str) -> None:
+        self._client = client
+        self._prefix = prefix
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            with span(f"{self._prefix}.{name}", kind="client"):
+                return attribute(*args, **kwargs)
+        return call
+
+# Process-wide tracer, every deployment of the process records into it
+tracer = Tracer()
+
+#----------------------------------------
+# Helper Functions
+#----------------------------------------
+
+def _escape(value) -> str:
+    return str(value if value is not None else "").replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _otlp_attributes(attributes: dict) -> list:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+def _otlp_span(span: Span) -> dict:
+    document = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": span_kinds.get(span.kind, 1),
+        "startTimeUnixNano": str(span.start_time),
+        "endTimeUnixNano": str(span.end_time),
+        "attributes": _otlp_attributes(span.attributes),
+        "status": {"code": 2, "message": span.error} if span.error is not None else {"code": 1},
+    }
+    if span.parent_id is not None:
+        document["parentSpanId"] = span.parent_id
+    return document
+
+def start_span(name: str, kind: str="internal", **attributes) -> Span:
+    """Start a span and make it current, call end() on it from the same thread."""
+    span = Span(tracer, name, current_span.get(), kind, attributes)
+    span.token = current_span.set(span)
+    return span
+
+@contextmanager
+def span(name: str, kind: str="internal", **attributes):
+    """Time the block as a span, a raised exception marks it failed."""
+    current = start_span(name, kind, **attributes)
+    try:
+        yield current
+    except BaseException as err:
+        current.end(err)
+        raise
+    current.end()
+
+def traced(client, prefix: str) -> TracedClient:
+    return TracedClient(client, prefix)
+
+def propagate(func):
+    """Wrap func to run in a copy of the caller's context, so spans it starts on a pool thread get the right parent."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
+
+def _write_atomic(path: str, text: str) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, 'w') as stream:
+            stream.write(text)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def export_spans(trace_file: str=None, metrics_file: str=None) -> None:
+    """Write the recorded spans as OTLP JSON and as a Prometheus textfile. Files are replaced atomically."""
+    if trace_file:
+        _write_atomic(trace_file, json.dumps(tracer.otlp()))
+    if metrics_file:
+        _write_atomic(metrics_file, tracer.prometheus())
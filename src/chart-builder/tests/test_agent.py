@@ -0,0 +1,169 @@
+from chart.builder.modules.agent import DeployAgent, JobOutput, agent_token, make_server
+
+import http.client
+import json
+import pytest
+import os
+import socket
+import stat
+import threading
+import time
+
+class UnixConnection(http.client.HTTPConnection):
+
+    def __init__(self, path: str) -> None:
+        super().__init__("localhost")
+        self.path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+def wait_for(job, timeout: float=5) -> None:
+    deadline = time.monotonic() + timeout
+    while not job.done and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert job.done
+
+def test_agent_limits_jobs_per_cluster():
+
+    active, peak, lock = {}, {}, threading.Lock()
+
+    def deploy(job):
+        with lock:
+            active[job.cluster] = active.get(job.cluster, 0) + 1
+            peak[job.cluster] = max(peak.get(job.cluster, 0), active[job.cluster])
+        time.sleep(0.05)
+        with lock:
+            active[job.cluster] -= 1
+        return "deployed"
+
+    agent = DeployAgent(max_workers=4, cluster_concurrency=1)
+    jobs = [agent.submit(f"app-{index}", f"aks-{index % 2}", deploy) for index in range(6)]
+    for job in jobs:
+        wait_for(job)
+    agent.shutdown()
+
+    assert peak == {"aks-0": 1, "aks-1": 1}
+    assert {job.status for job in jobs} == {"deployed"}
+
+def test_agent_reports_failures_and_keeps_running():
+
+    def fail(job):
+        raise SystemExit(1)
+
+    agent = DeployAgent(max_workers=1)
+    failed = agent.submit("app", "aks-1", fail)
+    succeeded = agent.submit("app", "aks-1", lambda job: "no-op")
+    wait_for(failed)
+    wait_for(succeeded)
+    agent.shutdown()
+
+    assert failed.status == "failed"
+    assert [event["event"] for event in failed.events] == ["status", "status", "error", "status"]
+    assert succeeded.status == "no-op"
+
+def test_agent_forgets_old_jobs():
+
+    agent = DeployAgent(max_workers=1, history=2)
+    jobs = [agent.submit("app", "aks-1", lambda job: "deployed") for _ in range(4)]
+    wait_for(jobs[-1])
+    agent.shutdown()
+
+    assert agent.get(jobs[0].id) is None
+    assert agent.get(jobs[-1].id) is jobs[-1]
+
+def test_job_output_turns_lines_into_events():
+
+    agent = DeployAgent(max_workers=1)
+    job = agent.submit("app", "aks-1", lambda job: JobOutput(job).write("one\ntw") and "deployed")
+    wait_for(job)
+    agent.shutdown()
+
+    assert [event["line"] for event in job.events if event["event"] == "log"] == ["one"]
+
+def test_job_api_streams_progress(tmp_path):
+
+    release = threading.Event()
+
+    def parse(document):
+        if "release" not in document:
+            raise ValueError("release is required")
+
+        def run(job):
+            job.emit({"event": "stage", "stage": "deploy", "state": "started"})
+            release.wait(5)
+            return "deployed"
+
+        return document["release"], document.get("clustername"), run
+
+    agent = DeployAgent()
+    server = make_server(agent, parse, socket_path=str(tmp_path / "agent.sock"))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        # Bad requests are rejected before anything is queued
+        connection = UnixConnection(str(tmp_path / "agent.sock"))
+        connection.request("POST", "/jobs", body=json.dumps({"clustername": "aks-1"}), headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        assert response.status == 400
+        assert json.loads(response.read())["error"] == "release is required"
+
+        # Events arrive while the job runs, the response ends with the final status
+        connection = UnixConnection(str(tmp_path / "agent.sock"))
+        connection.request("POST", "/jobs", body=json.dumps({"release": "api", "clustername": "aks-1"}), headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        assert response.getheader("Content-Type") == "application/x-ndjson"
+
+        events = []
+        while not events or events[-1].get("stage") != "deploy":
+            events.append(json.loads(response.fp.readline()))
+        release.set()
+        events.extend(json.loads(line) for line in response.read().splitlines())
+
+        assert events[-1]["status"] == "deployed"
+        assert events[-1]["seconds"] >= 0
+
+        connection = UnixConnection(str(tmp_path / "agent.sock"))
+        connection.request("GET", f"/jobs/{events[0]['job']}")
+        assert json.loads(connection.getresponse().read())["status"] == "deployed"
+    finally:
+        server.shutdown()
+        server.server_close()
+        agent.shutdown()
+
+    assert not (tmp_path / "agent.sock").exists()
+
+def test_loopback_job_api_requires_token_json_and_loopback_host(tmp_path):
+
+    token = agent_token(str(tmp_path / "agent.token"))
+    assert agent_token(str(tmp_path / "agent.token")) == token
+    assert stat.S_IMODE(os.stat(tmp_path / "agent.token").st_mode) == 0o600
+
+    agent = DeployAgent()
+    server = make_server(agent, lambda document: ("api", "aks-1", lambda job: "deployed"), port=0, token=token)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def post(headers, body=b"{}"):
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+        connection.request("POST", "/jobs?wait=false", body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+
+    try:
+        authorization = {"Authorization": f"Bearer {token}"}
+        assert post({"Content-Type": "application/json"}) == 401
+        assert post({"Content-Type": "application/json", "Authorization": "Bearer wrong"}) == 401
+
+        # Cross-site requests from a browser, a simple text/plain POST or a rebound DNS name
+        assert post({"Content-Type": "text/plain", **authorization}) == 415
+        assert post({"Content-Type": "application/json", "Host": "attacker.example.com", **authorization}) == 403
+
+        assert post({"Content-Type": "application/json; charset=utf-8", **authorization}) == 202
+    finally:
+        server.shutdown()
+        server.server_close()
+        agent.shutdown()
@@ -0,0 +1,124 @@
+from chart.builder.modules.batch import BatchJob, BatchRunner, ClusterConnections, batch_arguments, cluster_targets, connection_key, expand_clusters, load_batch
+
+from argparse import Namespace
+
+import json
+import pytest
+import threading
+import time
+
+def test_load_batch_yaml_and_json(tmp_path):
+
+    yaml_file = tmp_path / "batch.yaml"
+    yaml_file.write_text("deployments:\n  - release: api\n    clustername: aks-1\n")
+    json_file = tmp_path / "batch.json"
+    json_file.write_text(json.dumps([{"release": "api", "clustername": "aks-1"}]))
+
+    assert load_batch(str(yaml_file)) == load_batch(str(json_file)) == [{"release": "api", "clustername": "aks-1"}]
+
+def test_load_batch_rejects_non_list(tmp_path):
+
+    path = tmp_path / "batch.yaml"
+    path.write_text("release: api\n")
+    with pytest.raises(Exception):
+        load_batch(str(path))
+
+def test_batch_arguments():
+
+    arguments = batch_arguments({"release": "api", "helm_set": ["a=1", "b=2"], "demo": True, "helm-atomic": None})
+    assert arguments == ["--release", "api", "--helm-set", "a=1", "--helm-set", "b=2", "--demo"]
+
+def test_batch_runner_limits_per_cluster():
+
+    lock = threading.Lock()
+    active, peak = {}, {}
+
+    def deploy(cluster):
+        with lock:
+            active[cluster] = active.get(cluster, 0) + 1
+            peak[cluster] = max(peak.get(cluster, 0), active[cluster])
+        time.sleep(0.02)
+        with lock:
+            active[cluster] -= 1
+
+    jobs = [BatchJob(f"release-{index}", f"aks-{index % 2}", lambda index=index: deploy(f"aks-{index % 2}")) for index in range(8)]
+    BatchRunner(max_workers=8, cluster_concurrency=2).run(jobs)
+
+    assert peak == {"aks-0": 2, "aks-1": 2}
+    assert all(job.succeeded for job in jobs)
+
+def test_batch_runner_isolates_failures():
+
+    def fail():
+        raise RuntimeError("helm failed")
+
+    jobs = [BatchJob("api", "aks-1", fail), BatchJob("web", "aks-1", lambda: None), BatchJob("worker", "aks-1", lambda: False)]
+    BatchRunner().run(jobs)
+
+    assert [job.succeeded for job in jobs] == [False, True, False]
+    assert isinstance(jobs[0].error, RuntimeError)
+    assert all(job.seconds is not None for job in jobs)
+
+def test_cluster_connections_fetch_once():
+
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.02)
+        return object()
+
+    connections = ClusterConnections()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(connections.get("aks-1", fetch))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len(set(map(id, results))) == 1
+
+def test_cluster_connections_expire_after_ttl():
+
+    connections = ClusterConnections(ttl=0.05)
+    first = connections.get("aks-1", object)
+
+    assert connections.get("aks-1", object) is first
+    time.sleep(0.1)
+    assert connections.get("aks-1", object) is not first
+
+def test_connection_key_separates_service_principals():
+
+    args = Namespace(tenant_id="tenant", client_id="app-1", client_secret="secret-1", subscription_id="sub", resource_group="rg", cluster="aks-1")
+
+    assert connection_key(args) == connection_key(Namespace(**vars(args)))
+    assert connection_key(args) != connection_key(Namespace(**{**vars(args), "client_id": "app-2"}))
+    assert connection_key(args) != connection_key(Namespace(**{**vars(args), "client_secret": "secret-2"}))
+    assert "secret-1" not in connection_key(args)
+
+def test_cluster_targets_from_names_and_group(tmp_path):
+
+    group = tmp_path / "clusters.yaml"
+    group.write_text("clusters:\n  - aks-west\n  - clustername: aks-north\n    resource-group: rg-north\n")
+
+    assert cluster_targets("aks-east, aks-central", str(group)) == [
+        {"cluster": "aks-east"},
+        {"cluster": "aks-central"},
+        {"cluster": "aks-west"},
+        {"cluster": "aks-north", "resource_group": "rg-north", "subscription_id": None},
+    ]
+
+def test_expand_clusters():
+
+    args = Namespace(cluster="aks-east,aks-west", cluster_group=None, resource_group=None, helm_release="api")
+    deployments = expand_clusters(args)
+
+    assert [deployment.cluster for deployment in deployments] == ["aks-east", "aks-west"]
+    assert all(deployment.helm_release == "api" for deployment in deployments)
+    assert args.cluster == "aks-east,aks-west"
+
+def test_expand_clusters_requires_a_cluster():
+
+    with pytest.raises(Exception):
+        expand_clusters(Namespace(cluster=None, cluster_group=None))
@@ -0,0 +1,22 @@
+from benchmarks.offline_deploy import regressions
+
+baseline = {
+    "scenario": {"wall": 1.0, "stages": {"credentials": 0.5, "deploy": 0.2}},
+}
+
+def result(wall: float, credentials: float, deploy: float) -> dict:
+    return {"scenario": {"wall": wall, "stages": {"credentials": credentials, "deploy": deploy}}}
+
+def test_regressions_within_tolerance():
+
+    assert regressions(result(1.4, 0.8, 0.3), baseline, tolerance=0.5, slack=0.1) == []
+
+def test_regressions_reports_slow_stages():
+
+    found = regressions(result(1.7, 0.5, 0.5), baseline, tolerance=0.5, slack=0.1)
+
+    assert [regression.split(":")[0] for regression in found] == ["scenario deploy", "scenario wall"]
+
+def test_regressions_ignores_scenarios_without_baseline():
+
+    assert regressions({"other": {"wall": 9.0, "stages": {"deploy": 9.0}}}, baseline, tolerance=0.5, slack=0.1) == []
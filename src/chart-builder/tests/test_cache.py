@@ -0,0 +1,218 @@
+from chart.builder.modules.cache import ChartCache, CredentialCache, SubscriptionIndex, TokenCache, cache_directory, read_json, write_json
+from chart.builder.modules.clusteroperations import PersistentTokenCredential
+from chart.builder.modules.tracing import Tracer
+
+from concurrent.futures import ThreadPoolExecutor
+
+import io
+import os
+import pytest
+import stat
+import tarfile
+import time
+
+def test_cache_directory_override(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("CHART_BUILDER_CACHE_DIR", str(tmp_path))
+    assert cache_directory("charts") == os.path.join(str(tmp_path), "charts")
+    assert os.path.isdir(tmp_path / "charts")
+
+def test_subscription_index_round_trip(tmp_path):
+
+    index = SubscriptionIndex(path=str(tmp_path / "subscriptions.json"))
+    assert index.get("tenant", "rg-do-aks") is None
+
+    index.set("tenant", "rg-do-aks", "sub-1")
+    assert index.get("tenant", "RG-DO-AKS") == "sub-1"
+    assert index.get("other-tenant", "rg-do-aks") is None
+
+    index.discard("tenant", "rg-do-aks")
+    assert index.get("tenant", "rg-do-aks") is None
+
+def test_subscription_index_stale_entry(tmp_path):
+
+    index = SubscriptionIndex(path=str(tmp_path / "subscriptions.json"), ttl=60)
+    index.set("tenant", "rg-do-aks", "sub-1")
+
+    entries = read_json(index.path)
+    entries["tenant/rg-do-aks"]["updated"] = time.time() - 120
+    write_json(index.path, entries)
+
+    assert index.get("tenant", "rg-do-aks") is None
+
+def test_subscription_index_concurrent_runs_keep_every_entry(tmp_path):
+
+    path = str(tmp_path / "subscriptions.json")
+
+    # An index per thread, as every deploy builds its own
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(lambda number: SubscriptionIndex(path=path).set("tenant", f"rg-{number}", f"sub-{number}"), range(32)))
+
+    assert all(SubscriptionIndex(path=path).get("tenant", f"rg-{number}") == f"sub-{number}" for number in range(32))
+
+def test_credential_cache_respects_expiry_margin(tmp_path):
+
+    cache = CredentialCache(directory=str(tmp_path), margin=3600)
+
+    cache.set("sub-1", "rg-do-aks", "aks", "apiVersion: v1", time.time() + 7200)
+    assert cache.get("sub-1", "rg-do-aks", "aks") == "apiVersion: v1"
+    assert cache.get("sub-2", "rg-do-aks", "aks") is None
+
+    cache.set("sub-1", "rg-do-aks", "aks", "apiVersion: v1", time.time() + 1800)
+    assert cache.get("sub-1", "rg-do-aks", "aks") is None
+
+    cache.discard("sub-1", "rg-do-aks", "aks")
+    cache.discard("sub-1", "rg-do-aks", "aks")
+    assert not os.listdir(tmp_path)
+
+def test_token_cache_is_private_and_bound_to_the_secret(tmp_path):
+
+    cache = TokenCache(directory=str(tmp_path / "tokens"), margin=300)
+    scopes = ("https://management.azure.com/.default",)
+
+    cache.set("tenant", "client", "secret", scopes, "token", int(time.time()) + 3600)
+    assert cache.get("tenant", "client", "secret", scopes)[0] == "token"
+    assert cache.get("tenant", "client", "rotated", scopes) is None
+    assert cache.get("tenant", "other-client", "secret", scopes) is None
+    assert stat.S_IMODE(os.stat(tmp_path / "tokens").st_mode) == 0o700
+    assert stat.S_IMODE(os.stat(cache.path("tenant", "client", scopes)).st_mode) == 0o600
+
+    cache.set("tenant", "client", "secret", scopes, "token", int(time.time()) + 120)
+    assert cache.get("tenant", "client", "secret", scopes) is None
+
+def test_persistent_token_credential_counts_hits_and_misses(tmp_path, monkeypatch):
+    pytest.importorskip("azure.core")
+
+    class Credential():
+        requests = 0
+
+        def get_token(self, *scopes, **kwargs):
+            Credential.requests += 1
+            return type("AccessToken", (), {"token": "token", "expires_on": int(time.time()) + 3600})()
+
+    local = Tracer()
+    monkeypatch.setattr("chart.builder.modules.tracing.tracer", local)
+    cache = TokenCache(directory=str(tmp_path))
+
+    # The second run finds the first run's token on disk, repeated calls stay in memory
+    for _ in range(2):
+        credential = PersistentTokenCredential(Credential(), "tenant", "client", "secret", cache)
+        assert credential.get_token("https://management.azure.com/.default").token == "token"
+        assert credential.get_token("https://management.azure.com/.default").token == "token"
+
+    assert Credential.requests == 1
+    assert [span.attributes["cache"] for span in local.spans("azure.token")] == ["miss", "hit"]
+    assert 'chart_builder_azure_token_cache_total{result="hit"} 1' in local.prometheus()
+
+def test_persistent_token_credential_serves_bearer_token_policies(tmp_path, monkeypatch):
+    pytest.importorskip("azure.core")
+    from azure.core.credentials import AccessTokenInfo
+    from azure.core.pipeline import PipelineRequest, PipelineContext
+    from azure.core.pipeline.policies import BearerTokenCredentialPolicy
+    from azure.core.rest import HttpRequest
+
+    class Credential():
+        requests = 0
+
+        def get_token(self, *scopes, **kwargs):
+            pytest.fail("get_token_info is preferred by the policy")
+
+        def get_token_info(self, *scopes, options=None):
+            Credential.requests += 1
+            return AccessTokenInfo("token", int(time.time()) + 3600)
+
+    local = Tracer()
+    monkeypatch.setattr("chart.builder.modules.tracing.tracer", local)
+    cache = TokenCache(directory=str(tmp_path))
+
+    # Every SDK client has a policy of its own, as every ARM client does
+    for _ in range(2):
+        credential = PersistentTokenCredential(Credential(), "tenant", "client", "secret", cache)
+        for _ in range(3):
+            request = PipelineRequest(HttpRequest("GET", "https://management.azure.com/subscriptions"), PipelineContext(None))
+            BearerTokenCredentialPolicy(credential, "https://management.azure.com/.default").on_request(request)
+            assert request.http_request.headers["Authorization"] == "Bearer token"
+
+    assert Credential.requests == 1
+    assert [span.attributes["cache"] for span in local.spans("azure.token")] == ["miss", "hit"]
+
+def package(directory, name="api", version="1.2.3", padding=0):
+    path = os.path.join(str(directory), f"{name}-{version}.tgz")
+    with tarfile.open(path, "w:gz") as archive:
+        for member, data in ((f"{name}/Chart.yaml", f"name: {name}\nversion: {version}\n".encode()), (f"{name}/files.bin", os.urandom(padding))):
+            info = tarfile.TarInfo(member)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return path
+
+def test_chart_cache_exact_version(tmp_path):
+
+    cache = ChartCache(directory=str(tmp_path / "charts"))
+    os.makedirs(cache.directory)
+    assert cache.get("https://charts", "api", "1.2.3") is None
+
+    path = cache.put("https://charts", "api", "1.2.3", package(tmp_path))
+    assert path.endswith(".tgz") and os.path.exists(path)
+    assert cache.get("https://charts/", "api", "1.2.3") == path
+    assert cache.get("https://charts", "api", "v1.2.3") == path
+    assert cache.get("https://charts", "web", "1.2.3") is None
+
+def test_chart_cache_resolves_ranges_within_ttl(tmp_path):
+
+    cache = ChartCache(directory=str(tmp_path / "charts"), ttl=60)
+    os.makedirs(cache.directory)
+
+    path = cache.put("https://charts", "api", "^1.0.0", package(tmp_path))
+    assert cache.get("https://charts", "api", "^1.0.0") == path
+    assert cache.get("https://charts", "api", "1.2.3") == path
+    assert cache.get("https://charts", "api", None) is None
+
+    index = read_json(cache.index_path)
+    index["resolved"]["https://charts|api|^1.0.0"]["updated"] -= 120
+    write_json(cache.index_path, index)
+    assert cache.get("https://charts", "api", "^1.0.0") is None
+
+def test_chart_cache_evicts_least_recently_used(tmp_path):
+
+    cache = ChartCache(directory=str(tmp_path / "charts"), max_size=5000)
+    os.makedirs(cache.directory)
+
+    first = cache.put("https://charts", "api", "1.0.0", package(tmp_path, version="1.0.0", padding=2000))
+    second = cache.put("https://charts", "api", "2.0.0", package(tmp_path, version="2.0.0", padding=2000))
+    os.utime(first, (time.time() - 3600, time.time() - 3600))
+    os.utime(second, (time.time() - 1800, time.time() - 1800))
+    third = cache.put("https://charts", "api", "3.0.0", package(tmp_path, version="3.0.0", padding=2000))
+
+    assert os.path.exists(third)
+    assert not os.path.exists(first)
+    assert cache.get("https://charts", "api", "1.0.0") is None
+    assert cache.get("https://charts", "api", "3.0.0") == third
+
+def test_chart_cache_keeps_charts_another_deploy_just_used(tmp_path):
+
+    cache = ChartCache(directory=str(tmp_path / "charts"), max_size=3000)
+    os.makedirs(cache.directory)
+
+    first = cache.put("https://charts", "api", "1.0.0", package(tmp_path, version="1.0.0", padding=2000))
+    os.utime(first, (time.time() - 3600, time.time() - 3600))
+
+    # Served to another deploy a moment ago, helm may still be reading it
+    assert cache.get("https://charts", "api", "1.0.0") == first
+    cache.put("https://charts", "api", "2.0.0", package(tmp_path, version="2.0.0", padding=2000))
+
+    assert os.path.exists(first)
+
+def test_chart_cache_concurrent_runs_keep_every_entry(tmp_path):
+
+    directory = str(tmp_path / "charts")
+    os.makedirs(directory)
+    packages = []
+    for version in range(16):
+        os.makedirs(tmp_path / str(version))
+        packages.append(package(tmp_path / str(version), version=f"1.0.{version}"))
+
+    # A cache per thread, as every deploy builds its own
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(lambda version: ChartCache(directory=directory).put("https://charts", "api", f"1.0.{version}", packages[version]), range(16)))
+
+    assert all(ChartCache(directory=directory).get("https://charts", "api", f"1.0.{version}") for version in range(16))
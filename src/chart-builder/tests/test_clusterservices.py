@@ -0,0 +1,162 @@
+from benchmarks.fakes import fake_kubernetes
+from chart.builder.modules.clusterservices import AzureManagedClusterServices, api_resource, manifest_path, namespace_manifest, pull_secret_manifest, server_side_apply
+from chart.builder.modules.output import set_output
+
+import base64
+import io
+import json
+import os
+import threading
+
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("rich")
+
+class FakeApiClient():
+
+    def __init__(self) -> None:
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def call_api(self, path, method, query_params=None, header_params=None, body=None, **kwargs):
+        with self.lock:
+            self.calls.append((method, path, dict(query_params), header_params["Content-Type"]))
+        return json.loads(body)
+
+# Discovery results for the kinds these tests apply
+resources = {
+    "Namespace": SimpleNamespace(name="namespaces", namespaced=False),
+    "ServiceAccount": SimpleNamespace(name="serviceaccounts", namespaced=True),
+    "ConfigMap": SimpleNamespace(name="configmaps", namespaced=True),
+    "Ingress": SimpleNamespace(name="ingresses", namespaced=True),
+}
+
+def kubernetes_client(url):
+    kubernetes = pytest.importorskip("kubernetes")
+    configuration = kubernetes.client.Configuration()
+    configuration.host = url
+    return kubernetes.client.ApiClient(configuration)
+
+def test_manifest_path():
+
+    assert manifest_path(namespace_manifest("api"), resources["Namespace"]) == "/api/v1/namespaces/api"
+    assert manifest_path({"apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": "settings", "namespace": "api"}}, resources["ConfigMap"]) == "/api/v1/namespaces/api/configmaps/settings"
+    assert manifest_path({"apiVersion": "networking.k8s.io/v1", "kind": "Ingress", "metadata": {"name": "web", "namespace": "api"}}, resources["Ingress"]) == "/apis/networking.k8s.io/v1/namespaces/api/ingresses/web"
+
+def test_api_resource_discovers_plurals_and_scope_once(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("CHART_BUILDER_CACHE_DIR", str(tmp_path))
+    with fake_kubernetes() as server:
+        api_client = kubernetes_client(server.url)
+
+        quota = api_resource(api_client, "v1", "ResourceQuota")
+        priority = api_resource(api_client, "scheduling.k8s.io/v1", "PriorityClass")
+        assert (quota.name, quota.namespaced, priority.name, priority.namespaced) == ("resourcequotas", True, "priorityclasses", False)
+        discovered = dict(server.counts)
+
+        # A later run against the same API server reads discovery from the cache
+        api_resource(kubernetes_client(server.url), "v1", "ResourceQuota")
+        assert server.counts == discovered
+        assert os.listdir(tmp_path / "discovery")
+
+def test_build_prerequisites_only_namespaces_namespaced_kinds(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("CHART_BUILDER_CACHE_DIR", str(tmp_path))
+    with fake_kubernetes() as server:
+        AzureManagedClusterServices().build_prerequisites("api", [
+            {"apiVersion": "v1", "kind": "ServiceAccount", "metadata": {"name": "api"}},
+            {"apiVersion": "scheduling.k8s.io/v1", "kind": "PriorityClass", "metadata": {"name": "critical"}, "value": 1000},
+        ], api_client=kubernetes_client(server.url))
+
+        assert server.objects[("serviceaccounts", "api", "api")]["metadata"] == {"name": "api", "namespace": "api"}
+        assert server.objects[("priorityclasses", "", "critical")]["metadata"] == {"name": "critical"}
+
+def test_pull_secret_manifest():
+
+    secret = pull_secret_manifest("registry", "api", "example.azurecr.io", "user", "password", "someone@example.com")
+    config = json.loads(base64.b64decode(secret["data"][".dockerconfigjson"]))
+
+    assert secret["type"] == "kubernetes.io/dockerconfigjson"
+    assert config["auths"]["example.azurecr.io"]["auth"] == base64.b64encode(b"user:password").decode("utf-8")
+
+def test_server_side_apply_one_patch_per_object(monkeypatch):
+
+    monkeypatch.setattr("chart.builder.modules.clusterservices.api_resource", lambda api_client, api_version, kind: resources[kind])
+    api_client = FakeApiClient()
+    manifests = [
+        {"apiVersion": "v1", "kind": "ServiceAccount", "metadata": {"name": "api", "namespace": "api"}},
+        namespace_manifest("api"),
+        {"apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": "settings", "namespace": "api"}},
+    ]
+
+    applied = server_side_apply(api_client, manifests)
+
+    assert [result["kind"] for result in applied] == ["ServiceAccount", "Namespace", "ConfigMap"]
+    assert len(api_client.calls) == 3
+    assert all(method == "PATCH" and query == {"fieldManager": "chart-builder", "force": "true"} and content_type == "application/apply-patch+yaml"
+        for method, _, query, content_type in api_client.calls)
+
+    # The namespace is applied before the objects that live in it
+    assert api_client.calls[0][1] == "/api/v1/namespaces/api"
+
+def test_propagate_registry_credentials_only_applies_changes(tmp_path, monkeypatch):
+    from chart.builder.modules import clusterservices
+
+    monkeypatch.setenv("CHART_BUILDER_CACHE_DIR", str(tmp_path))
+
+    # A namespace that rejects the secret, e.g. one that is terminating
+    def apply_manifest(api_client, manifest):
+        if manifest["metadata"]["namespace"] == "f":
+            raise Exception("namespace f is being terminated")
+        return apply(api_client, manifest)
+
+    apply = clusterservices.apply_manifest
+    monkeypatch.setattr(clusterservices, "apply_manifest", apply_manifest)
+
+    with fake_kubernetes() as server:
+        for namespace, tenant in (("a", "retail"), ("b", "retail"), ("c", "retail"), ("d", "other")):
+            server.objects[("namespaces", "", namespace)] = {"metadata": {"name": namespace, "labels": {"tenant": tenant}}}
+        current = pull_secret_manifest("registry", "b", "example.azurecr.io", "user", "password", "someone@spreetail.com")
+        stale = pull_secret_manifest("registry", "c", "example.azurecr.io", "user", "old", "someone@spreetail.com")
+        server.objects[("secrets", "b", "registry")] = current
+        server.objects[("secrets", "c", "registry")] = stale
+
+        api_client = kubernetes_client(server.url)
+
+        summary = AzureManagedClusterServices().propagate_registry_credentials(
+            "registry", "example.azurecr.io", "user", "password", namespaces=["e", "f"], selector="tenant=retail", api_client=api_client)
+
+        assert summary == {"created": ["a", "e"], "updated": ["c"], "unchanged": ["b"], "failed": ["f"], "errors": {"f": "namespace f is being terminated"}}
+        assert server.counts["PATCH object"] == 3
+        assert server.objects[("secrets", "c", "registry")]["data"] == current["data"]
+
+def test_watch_rollout_keeps_the_release_prefix(monkeypatch):
+
+    class Watcher():
+
+        def __init__(self, api_client, namespace, selector, on_progress=None, **kwargs):
+            self.on_progress = on_progress
+
+        def wait(self):
+            if self.on_progress is not None:
+                self.on_progress("Deployment/api", 1, 2)
+            return workloads
+
+    monkeypatch.setattr("chart.builder.modules.rollout.RolloutWatcher", Watcher)
+    stream = io.StringIO()
+    set_output("ndjson", stream)
+    try:
+        workloads = {"Deployment/api": (2, 2)}
+        AzureManagedClusterServices().watch_rollout("api", "apps", label="api@aks-east", api_client=object())
+
+        # Nothing to wait for passes, with a warning in case the selector missed the workloads
+        workloads = {}
+        AzureManagedClusterServices().watch_rollout("api", "apps", label="api@aks-east", api_client=object())
+    finally:
+        set_output("text")
+
+    messages = [json.loads(line)["message"] for line in stream.getvalue().splitlines()]
+    assert messages[0] == "✔ [api@aks-east] Deployment/api 1/2 ready"
+    assert messages[-1].startswith('⚠ [api@aks-east] No Deployments, StatefulSets, DaemonSets or Jobs match "app.kubernetes.io/instance=api"')
@@ -0,0 +1,150 @@
+from chart.builder.modules.delivery import DeliveryWorker
+
+import json
+import threading
+import time
+
+def read_outbox(path):
+    with open(path) as stream:
+        return [json.loads(line)["event"] for line in stream]
+
+def test_delivery_worker_delivers_in_background(tmp_path):
+
+    delivered = []
+    worker = DeliveryWorker(delivered.extend, "test", outbox=str(tmp_path / "outbox.jsonl"))
+    worker.submit({"status": "success"})
+
+    assert worker.flush(timeout=5) == 0
+    assert delivered == [{"status": "success"}]
+
+def test_delivery_worker_retries_with_backoff(tmp_path):
+
+    attempts = []
+
+    def send(batch):
+        attempts.append(batch)
+        if len(attempts) < 3:
+            raise ConnectionError("endpoint unavailable")
+
+    worker = DeliveryWorker(send, "test", outbox=str(tmp_path / "outbox.jsonl"), backoff=0.01)
+    worker.submit({"status": "success"})
+
+    assert worker.flush(timeout=5) == 0
+    assert len(attempts) == 3
+
+def test_delivery_worker_spills_undelivered_events(tmp_path):
+
+    release = threading.Event()
+    outbox = str(tmp_path / "outbox.jsonl")
+    worker = DeliveryWorker(lambda batch: release.wait(5), "test", outbox=outbox)
+    worker.submit({"id": 1})
+    worker.submit({"id": 2})
+
+    assert worker.flush(timeout=0.1) == 2
+    release.set()
+    assert sorted(event["id"] for event in read_outbox(outbox)) == [1, 2]
+
+def test_delivery_worker_spills_after_retries(tmp_path):
+
+    def send(batch):
+        raise ConnectionError("endpoint unavailable")
+
+    outbox = str(tmp_path / "outbox.jsonl")
+    worker = DeliveryWorker(send, "test", outbox=outbox, retries=2, backoff=0.01)
+    worker.submit({"id": 1})
+
+    worker.flush(timeout=5)
+    assert read_outbox(outbox) == [{"id": 1}]
+    assert isinstance(worker.last_error, ConnectionError)
+
+def test_delivery_worker_replays_outbox(tmp_path):
+
+    outbox = tmp_path / "outbox.jsonl"
+    outbox.write_text(json.dumps({"id": 1}) + "\n")
+
+    delivered = []
+    worker = DeliveryWorker(delivered.extend, "test", outbox=str(outbox))
+    worker.submit({"id": 2})
+
+    worker.flush(timeout=5)
+    assert sorted(event["id"] for event in delivered) == [1, 2]
+    assert not outbox.exists()
+
+def test_delivery_worker_batches_by_size(tmp_path):
+
+    batches = []
+    worker = DeliveryWorker(batches.append, "test", outbox=str(tmp_path / "outbox.jsonl"), batch_size=3, batch_delay=5)
+    for index in range(7):
+        worker.submit({"id": index})
+
+    worker.flush(timeout=5)
+    assert [len(batch) for batch in batches][:2] == [3, 3]
+    assert sum(len(batch) for batch in batches) == 7
+
+def test_delivery_worker_batches_by_time(tmp_path):
+
+    batches = []
+    worker = DeliveryWorker(batches.append, "test", outbox=str(tmp_path / "outbox.jsonl"), batch_size=100, batch_delay=0.1)
+    worker.submit({"id": 1})
+    worker.submit({"id": 2})
+
+    # Sent once the delay passes, without a flush
+    for _ in range(100):
+        if batches:
+            break
+        threading.Event().wait(0.01)
+    assert batches == [[{"id": 1}, {"id": 2}]]
+
+def test_delivery_worker_retries_only_undelivered_events(tmp_path):
+
+    sent = []
+
+    def send(batch):
+        sent.append(batch.pop(0))
+        if batch:
+            raise ConnectionError("endpoint unavailable")
+
+    worker = DeliveryWorker(send, "test", outbox=str(tmp_path / "outbox.jsonl"), backoff=0.01, batch_size=3, batch_delay=5)
+    for index in range(3):
+        worker.submit({"id": index})
+
+    assert worker.flush(timeout=5) == 0
+    assert [event["id"] for event in sent] == [0, 1, 2]
+
+def test_delivery_worker_drops_rejected_events(tmp_path):
+
+    class Rejected(Exception):
+        status = 403
+
+    def send(batch):
+        attempts.append(batch)
+        raise Rejected("invalid insert key")
+
+    attempts = []
+    outbox = tmp_path / "outbox.jsonl"
+    worker = DeliveryWorker(send, "test", outbox=str(outbox), backoff=0.01)
+    worker.submit({"id": 1})
+
+    assert worker.flush(timeout=5) == 0
+    assert len(attempts) == 1 and worker.dropped == 1
+    assert not outbox.exists()
+
+def test_delivery_worker_gives_up_on_outbox_entries(tmp_path):
+
+    def send(batch):
+        raise ConnectionError("endpoint unavailable")
+
+    outbox = tmp_path / "outbox.jsonl"
+    outbox.write_text(json.dumps({"event": {"id": 1}, "attempts": 1, "queued": time.time()}) + "\n"
+        + json.dumps({"event": {"id": 2}, "attempts": 4, "queued": time.time()}) + "\n"
+        + json.dumps({"event": {"id": 3}, "attempts": 1, "queued": time.time() - 7 * 86400}) + "\n")
+
+    # Every run that fails to deliver an entry counts an attempt, old and often tried entries are dropped
+    worker = DeliveryWorker(send, "test", outbox=str(outbox), retries=1, max_outbox=3)
+    for index in range(4, 7):
+        worker.submit({"id": index})
+    worker.flush(timeout=5)
+
+    entries = [json.loads(line) for line in outbox.read_text().splitlines()]
+    assert [(entry["event"]["id"], entry["attempts"]) for entry in entries] == [(4, 1), (5, 1), (6, 1)]
+    assert worker.dropped == 3
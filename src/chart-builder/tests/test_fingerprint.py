@@ -0,0 +1,36 @@
+from chart.builder.modules.fingerprint import release_fingerprint
+
+def command(chart, *options):
+    return ["helm", "upgrade", "--install", "api", str(chart), *options]
+
+def test_release_fingerprint_local_chart(tmp_path):
+
+    chart = tmp_path / "chart"
+    chart.mkdir()
+    (chart / "Chart.yaml").write_text("name: api\nversion: 1.0.0\n")
+    values = tmp_path / "values.yaml"
+    values.write_text("replicas: 2\n")
+
+    first = release_fingerprint(command(chart, "--values", str(values), "--set", "image.tag=1", "--kubeconfig", "/a", "--atomic"))
+    again = release_fingerprint(command(chart, "--values", str(values), "--set", "image.tag=1", "--kubeconfig", "/b", "--atomic", "--kube-context", "aks-admin"))
+    assert first is not None and first == again
+
+    assert release_fingerprint(command(chart, "--values", str(values), "--set", "image.tag=2", "--atomic")) != release_fingerprint(command(chart, "--values", str(values), "--set", "image.tag=1", "--atomic"))
+    assert release_fingerprint(command(chart, "--values", str(values), "--set", "image.tag=1")) != first
+
+    values.write_text("replicas: 3\n")
+    assert release_fingerprint(command(chart, "--values", str(values), "--set", "image.tag=1", "--atomic")) != first
+
+    (chart / "Chart.yaml").write_text("name: api\nversion: 1.0.1\n")
+    values.write_text("replicas: 2\n")
+    assert release_fingerprint(command(chart, "--values", str(values), "--set", "image.tag=1", "--atomic")) != first
+
+def test_release_fingerprint_repository_chart():
+
+    assert release_fingerprint(command("api", "--version", "1.2.3", "--repo", "https://charts")) is not None
+    assert release_fingerprint(command("api", "--version", "^1.2.0", "--repo", "https://charts")) is None
+    assert release_fingerprint(command("api", "--repo", "https://charts")) is None
+
+def test_release_fingerprint_remote_values():
+
+    assert release_fingerprint(command("api", "--version", "1.2.3", "--values", "https://example.com/values.yaml")) is None
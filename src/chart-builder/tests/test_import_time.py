@@ -0,0 +1,24 @@
+from benchmarks.importtime import import_times
+
+import os
+import pytest
+
+# Cold-start budget for importing the command line, override with CHART_BUILDER_IMPORT_BUDGET_MS on slow machines
+budget = float(os.environ.get("CHART_BUILDER_IMPORT_BUDGET_MS", 400))
+
+# SDKs only the provider that needs them may import
+sdks = ["azure", "kubernetes", "datadog_api_client", "requests"]
+
+pytest.importorskip("rich")
+
+def test_command_line_imports_no_provider_sdks():
+
+    _, packages = import_times("chart.builder.__main__")
+
+    assert [sdk for sdk in sdks if sdk in packages] == []
+
+def test_command_line_import_within_budget():
+
+    total, _ = min((import_times("chart.builder.__main__") for _ in range(3)), key=lambda times: times[0])
+
+    assert total / 1000 < budget
@@ -0,0 +1,174 @@
+from chart.builder.modules.kubeconfig import certificate_expiry, certificate_not_after, load_kubeconfig, merge_kubeconfig, private_kubeconfig, write_kubeconfig
+
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import base64
+import os
+import pytest
+import stat
+import sys
+import time
+import yaml
+
+CERTIFICATE = """-----BEGIN CERTIFICATE-----
+MIIBtTCCAVugAwIBAgIUWsuGV17GIHfW9oKJI0EU8dw7DKEwCgYIKoZIzj0EAwIw
+MDEXMBUGA1UECgwOc3lzdGVtOm1hc3RlcnMxFTATBgNVBAMMDG1hc3RlcmNsaWVu
+dDAeFw0yNjEwMTcxNzEyMjJaFw0zNjEwMTQxNzEyMjJaMDAxFzAVBgNVBAoMDnN5
+c3RlbTptYXN0ZXJzMRUwEwYDVQQDDAxtYXN0ZXJjbGllbnQwWTATBgcqhkjOPQIB
+BggqhkjOPQMBBwNCAAQhqPFIEOHXIsdx6BZ1qBseZQwxW1xNbstyw4HNfDZ/6erJ
+46892pRRrByJzDdfifkleNZ8i5wSKzV1NZdjXJkVo1MwUTAdBgNVHQ4EFgQUhYv3
+SLaILwKrro9CiDca2ZxpNgIwHwYDVR0jBBgwFoAUhYv3SLaILwKrro9CiDca2Zxp
+NgIwDwYDVR0TAQH/BAUwAwEB/zAKBggqhkjOPQQDAgNIADBFAiEAxwVnY29OG3I1
+2OcwxJUYtYnHEI4fqmHMO/4L2k5KbjsCIAItEng3mDZg9f3RlC1jjsqWLUE48Gue
+b2bDEHJgIppc
+-----END CERTIFICATE-----
+"""
+
+EXPIRY = datetime(2036, 10, 14, 17, 12, 22, tzinfo=timezone.utc).timestamp()
+
+def test_certificate_not_after():
+
+    assert certificate_not_after(CERTIFICATE) == EXPIRY
+
+def test_certificate_expiry_from_kubeconfig():
+
+    kubeconfig = {
+        "users": [
+            {"name": "clusterAdmin_rg_aks", "user": {"client-certificate-data": base64.b64encode(CERTIFICATE.encode()).decode()}},
+            {"name": "token-user", "user": {"token": "secret"}},
+        ]
+    }
+    assert certificate_expiry(kubeconfig) == EXPIRY
+
+def test_certificate_expiry_without_certificates():
+
+    assert certificate_expiry({"users": [{"name": "token-user", "user": {"token": "secret"}}]}) is None
+    assert certificate_expiry(None) is None
+
+def kubeconfig(*names, server="https://aks:443"):
+    return {
+        "apiVersion": "v1",
+        "clusters": [{"name": name, "cluster": {"server": server}} for name in names],
+        "users": [{"name": f"clusterAdmin_{name}", "user": {"token": name}} for name in names],
+        "contexts": [{"name": name, "context": {"cluster": name, "user": f"clusterAdmin_{name}"}} for name in names],
+        "current-context": names[-1],
+    }
+
+def test_merge_kubeconfig_adds_and_moves_entries():
+
+    existing = kubeconfig("aks-1", "aks-2", "aks-3")
+    addition = kubeconfig("aks-2", "aks-4")
+
+    assert merge_kubeconfig(existing, addition)
+    assert [context["name"] for context in existing["contexts"]] == ["aks-1", "aks-3", "aks-2", "aks-4"]
+    assert existing["current-context"] == "aks-4"
+
+def test_merge_kubeconfig_unchanged():
+
+    existing = kubeconfig("aks-1", "aks-2")
+    assert not merge_kubeconfig(existing, kubeconfig("aks-2"))
+    assert len(existing["clusters"]) == 2
+
+def test_merge_kubeconfig_conflict():
+
+    existing = kubeconfig("aks-1")
+    with pytest.raises(Exception):
+        merge_kubeconfig(existing, kubeconfig("aks-1", server="https://other:443"))
+
+    assert merge_kubeconfig(existing, kubeconfig("aks-1", server="https://other:443"), replace=True)
+    assert existing["clusters"] == [{"name": "aks-1", "cluster": {"server": "https://other:443"}}]
+
+def test_write_kubeconfig_is_private_and_atomic(tmp_path):
+
+    path = tmp_path / "config"
+    path.write_text("stale")
+    os.chmod(path, 0o644)
+
+    write_kubeconfig(str(path), kubeconfig("aks-1"))
+
+    assert yaml.safe_load(path.read_text()) == kubeconfig("aks-1")
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert os.listdir(tmp_path) == ["config"]
+
+def test_load_kubeconfig_parses_once(tmp_path):
+
+    path = tmp_path / "config"
+    path.write_text(yaml.safe_dump(kubeconfig("aks-1")))
+
+    first = load_kubeconfig(str(path))
+    assert first == kubeconfig("aks-1")
+    assert load_kubeconfig(str(path)) is first
+
+def test_load_kubeconfig_reparses_changed_file(tmp_path):
+
+    path = tmp_path / "config"
+    path.write_text(yaml.safe_dump(kubeconfig("aks-1")))
+    first = load_kubeconfig(str(path))
+
+    path.write_text(yaml.safe_dump(kubeconfig("aks-1", "aks-22")))
+    assert load_kubeconfig(str(path)) == kubeconfig("aks-1", "aks-22")
+    assert load_kubeconfig(str(path)) is not first
+
+def test_write_kubeconfig_primes_load_cache(tmp_path):
+
+    path = tmp_path / "config"
+    document = kubeconfig("aks-1")
+    write_kubeconfig(str(path), document)
+
+    assert load_kubeconfig(str(path)) is document
+
+def test_private_kubeconfig_prefers_runtime_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+
+    first, second = private_kubeconfig(), private_kubeconfig()
+    write_kubeconfig(first, {"apiVersion": "v1", "kind": "Config", "current-context": "aks-east-admin"})
+
+    assert first != second
+    assert os.path.dirname(os.path.dirname(first)) == str(tmp_path)
+    assert stat.S_IMODE(os.stat(os.path.dirname(first)).st_mode) == 0o700
+    assert stat.S_IMODE(os.stat(first).st_mode) == 0o600
+
+@pytest.mark.parametrize("isolated", [False, True])
+def test_isolated_credentials_never_reach_the_credential_cache(tmp_path, monkeypatch, isolated):
+    pytest.importorskip("kubernetes")
+    from benchmarks import fakes
+    from chart.builder.modules.clusteroperations import AzureManagedClusterOperations
+
+    monkeypatch.setitem(sys.modules, "azure.mgmt.containerservice", SimpleNamespace(ContainerServiceClient=fakes.FakeContainerServiceClient))
+    monkeypatch.setattr("chart.builder.modules.clusteroperations.AzureManagedClusterOperations._credentials", lambda *args: fakes.FakeCredential(*args[1:4]))
+    monkeypatch.setattr("chart.builder.modules.clusteroperations.certificate_expiry", lambda document: time.time() + 86400)
+    monkeypatch.setenv("CHART_BUILDER_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    monkeypatch.setenv("FAKE_KUBE_SERVER", "https://aks-east.example.com")
+
+    connection = AzureManagedClusterOperations().build_cluster_admin_credentials("rg-do-aks-east", "aks-east", "tenant", "client", "secret",
+        path=str(tmp_path / "config"), subscription_id="sub-1", isolated=isolated, token_cache=False)
+    connection.api_client.close()
+
+    # The admin kubeconfig holds the cluster's admin key, isolated runs keep it off the disk
+    directory = tmp_path / "cache" / "credentials"
+    assert bool(directory.is_dir() and os.listdir(directory)) is not isolated
+
+def test_unreadable_certificate_skips_the_credential_cache(tmp_path, monkeypatch):
+    pytest.importorskip("kubernetes")
+    from benchmarks import fakes
+    from chart.builder.modules.clusteroperations import AzureManagedClusterOperations
+
+    def certificate_expiry(document):
+        raise ValueError("certificate is not a DER sequence")
+
+    monkeypatch.setitem(sys.modules, "azure.mgmt.containerservice", SimpleNamespace(ContainerServiceClient=fakes.FakeContainerServiceClient))
+    monkeypatch.setattr("chart.builder.modules.clusteroperations.AzureManagedClusterOperations._credentials", lambda *args: fakes.FakeCredential(*args[1:4]))
+    monkeypatch.setattr("chart.builder.modules.clusteroperations.certificate_expiry", certificate_expiry)
+    monkeypatch.setenv("CHART_BUILDER_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("FAKE_KUBE_SERVER", "https://aks-east.example.com")
+
+    connection = AzureManagedClusterOperations().build_cluster_admin_credentials("rg-do-aks-east", "aks-east", "tenant", "client", "secret",
+        path=str(tmp_path / "config"), subscription_id="sub-1", token_cache=False)
+    connection.api_client.close()
+
+    # The credentials stage still connects, only the cache entry is skipped
+    directory = tmp_path / "cache" / "credentials"
+    assert connection.context
+    assert not (directory.is_dir() and os.listdir(directory))
@@ -0,0 +1,83 @@
+from chart.builder.modules.output import NdjsonWriter, bind, bind_output, console, event, fields, job_output, set_output
+from chart.builder.modules.stages import Stage, StageExecutor
+
+from concurrent.futures import ThreadPoolExecutor
+from rich.console import Console
+
+import io
+import json
+
+import pytest
+
+@pytest.fixture
+def ndjson():
+    stream = io.StringIO()
+    set_output("ndjson", stream)
+    yield lambda: [json.loads(line) for line in stream.getvalue().splitlines()]
+    set_output("text")
+
+def test_writer_lines_do_not_interleave():
+    stream = io.StringIO()
+    writer = NdjsonWriter(stream)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for worker in range(8):
+            executor.submit(lambda worker=worker: [writer.write({"event": "log", "worker": worker, "message": "x" * 500}) for _ in range(100)])
+
+    events = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert len(events) == 800
+
+def test_console_prints_plain_log_events(ndjson):
+
+    with console.status("Working..."):
+        console.print('[bright_green]Namespace[/] [white]"api" applied[/]')
+        console.print("  [not markup]  ", markup=False)
+
+    assert [(event["event"], event["message"]) for event in ndjson()] == [("log", 'Namespace "api" applied'), ("log", "[not markup]")]
+
+def test_stage_events_carry_bound_fields(ndjson):
+
+    token = bind(release="api", cluster="aks-east")
+    try:
+        StageExecutor([Stage("package", lambda: "command"), Stage("deploy", lambda: "deployed", requires=["package"])]).run()
+    finally:
+        fields.reset(token)
+
+    events = [event for event in ndjson() if event["event"] == "stage"]
+    assert [(event["stage"], event["status"]) for event in events] == [("package", "started"), ("package", "finished"), ("deploy", "started"), ("deploy", "finished")]
+    assert all(event["release"] == "api" and event["cluster"] == "aks-east" for event in events)
+    assert "seconds" in events[-1]
+
+def test_failed_stage_event(ndjson):
+
+    def fail():
+        raise ValueError("chart not found")
+
+    with pytest.raises(ValueError):
+        StageExecutor([Stage("package", fail)]).run()
+
+    failed = ndjson()[-1]
+    assert (failed["stage"], failed["status"], failed["error"]) == ("package", "failed", "chart not found")
+
+def test_bound_output_keeps_a_jobs_prints_and_events_apart(ndjson):
+
+    def job(name):
+        stream, events = io.StringIO(), []
+        token, output = bind(release=name), bind_output(Console(file=stream, color_system=None), on_event=events.append)
+        try:
+
+            # Stages run on other threads, they print and fail into the job that started them
+            StageExecutor([Stage("package", lambda: console.print(f"[white]packaging {name}[/]"))]).run()
+            event("error", message=f"{name} failed")
+        finally:
+            job_output.reset(output)
+            fields.reset(token)
+        return stream.getvalue(), events
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        api, web = executor.map(job, ["api", "web"])
+
+    assert api[0] == "packaging api\n" and web[0] == "packaging web\n"
+    assert {"release": "web", "event": "error", "message": "web failed"} in web[1]
+    assert not any(document.get("release") == "api" for document in web[1])
+    assert ndjson() == []
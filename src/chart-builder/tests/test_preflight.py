@@ -0,0 +1,116 @@
+from chart.builder.modules.preflight import compile_schema, compiled_charts, parse_set, parse_values, preflight
+
+import json
+import pytest
+import tarfile
+
+schema = {
+    "type": "object",
+    "required": ["image"],
+    "properties": {
+        "image": {"$ref": "#/definitions/image"},
+        "replicas": {"type": "integer", "minimum": 1},
+    },
+    "definitions": {
+        "image": {
+            "type": "object",
+            "required": ["tag"],
+            "properties": {"tag": {"type": "string"}, "pullPolicy": {"enum": ["Always", "IfNotPresent"]}},
+        },
+    },
+}
+
+def chart(directory, values="image:\n  tag: \"1.0\"\nreplicas: 1\n"):
+    directory.mkdir()
+    (directory / "Chart.yaml").write_text("name: api\nversion: 1.0.0\n")
+    (directory / "values.yaml").write_text(values)
+    (directory / "values.schema.json").write_text(json.dumps(schema))
+    return str(directory)
+
+def test_parse_set_follows_helm():
+
+    values = parse_set("image.tag=1.2,replicas=3,debug=true,owner=null,port=08080,hosts={a,b}")
+    assert values == {"image": {"tag": "1.2"}, "replicas": 3, "debug": True, "owner": None, "port": "08080", "hosts": ["a", "b"]}
+
+    assert parse_set("a=NULL,b=-012,c=+5,d=012,e=TRUE,f=9223372036854775808") == {"a": None, "b": -12, "c": 5, "d": "012", "e": True, "f": "9223372036854775808"}
+    assert parse_set(r"annotations.kubernetes\.io/role=a\,b") == {"annotations": {"kubernetes.io/role": "a,b"}}
+    assert parse_set("env[1].name=B", {"env": [{"name": "A"}]}) == {"env": [{"name": "A"}, {"name": "B"}]}
+
+    for expression in ("image.tag", "image.tag,replicas=1", "env[x]=1", "hosts={a,b"):
+        with pytest.raises(ValueError):
+            parse_set(expression)
+
+def test_compile_schema_reports_every_error():
+
+    errors = compile_schema(schema)({"image": {"tag": 1, "pullPolicy": "Never"}, "replicas": 0})
+
+    assert "image.tag: Invalid type. Expected: string, given: integer" in errors
+    assert "replicas: Must be greater than or equal to 1" in errors
+    assert len(errors) == 3
+    assert compile_schema(schema)({"image": {"tag": "1.0"}}) == []
+
+def test_compile_schema_never_rejects_what_helm_accepts():
+
+    validate = compile_schema({"properties": {
+        "cpu": {"multipleOf": 0.1, "maximum": 0.7},
+        "email": {"not": {"format": "email"}},
+        "name": {"oneOf": [{"type": "string"}, {"pattern": "^a"}]},
+        "port": {"$ref": "#/definitions/port", "type": "string"},
+    }, "definitions": {"port": {"type": "integer"}}})
+
+    assert validate({"cpu": 0.3}) == validate({"cpu": 0.7}) == []
+    assert validate({"cpu": 0.35}) == ["cpu: Must be a multiple of 0.1"]
+
+    # Unchecked keywords (format, pattern) pass, so they cannot invert not or oneOf
+    assert validate({"email": "user@example.com", "name": "api"}) == []
+
+    # Keywords next to $ref are ignored, as in draft 7
+    assert validate({"port": 8080}) == []
+
+def test_parse_values_types_scalars_as_helm_does():
+
+    values = parse_values("debug: y\ntime: 1:30\ndate: 2024-01-01\nsize: 1_000\n1: one\n")
+
+    assert values == {"debug": True, "time": "1:30", "date": "2024-01-01", "size": 1000, "1": "one"}
+
+def test_preflight_validates_values_and_sets_against_the_chart(tmp_path):
+
+    path = chart(tmp_path / "api")
+    values = tmp_path / "values.yaml"
+    values.write_text("image:\n  pullPolicy: Always\n")
+
+    merged = preflight(path, values=[str(values)], sets=["replicas=2"])
+    assert merged == {"image": {"tag": "1.0", "pullPolicy": "Always"}, "replicas": 2}
+
+    with pytest.raises(Exception, match="image.tag: Invalid type"):
+        preflight(path, values=[str(values)], sets=["image.tag=2"])
+
+    # A null user value removes the chart default
+    with pytest.raises(Exception, match="image: tag is required"):
+        preflight(path, sets=["image.tag=null"])
+
+    values.write_text("image: [unclosed\n")
+    with pytest.raises(Exception, match="Invalid chart inputs"):
+        preflight(path, values=[str(values)], sets=["replicas"])
+
+def test_preflight_caches_compiled_schemas_by_chart_digest(tmp_path, monkeypatch):
+
+    path = chart(tmp_path / "api")
+    package = tmp_path / "api-1.0.0.tgz"
+    with tarfile.open(package, "w:gz") as archive:
+        archive.add(path, arcname="api")
+
+    preflight(str(package))
+    compiled = [digest for digest in compiled_charts if compiled_charts[digest][1] is not None]
+
+    monkeypatch.setattr("chart.builder.modules.preflight.chart_files", lambda chart: pytest.fail("schema compiled twice"))
+    with pytest.raises(Exception, match="replicas: Must be greater than or equal to 1"):
+        preflight(str(package), sets=["replicas=0"])
+    assert [digest for digest in compiled_charts if compiled_charts[digest][1] is not None] == compiled
+
+def test_preflight_skips_charts_that_are_not_local(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("CHART_BUILDER_CACHE_DIR", str(tmp_path))
+
+    assert preflight("api", repository="https://charts.example.com", version="1.0.0", sets=["replicas=0"]) == {"replicas": 0}
+    assert preflight("oci://registry.example.com/charts/api", values=["https://example.com/values.yaml"]) == {}
@@ -0,0 +1,45 @@
+from chart.builder.modules.process import fatal_patterns, run_streaming
+
+import sys
+import time
+
+def python(code: str) -> list:
+    return [sys.executable, "-c", code]
+
+def test_run_streaming_hands_over_lines_as_they_arrive():
+
+    arrivals = []
+    result = run_streaming(
+        python("import sys, time\nfor i in range(3):\n    print(i, flush=True)\n    time.sleep(0.1)\nprint('done', file=sys.stderr)"),
+        on_line=lambda line: arrivals.append((line, time.perf_counter())))
+
+    assert result.returncode == 0
+    assert [line for line, _ in arrivals] == ["0", "1", "2", "done"]
+    assert arrivals[1][1] - arrivals[0][1] > 0.05
+
+def test_run_streaming_keeps_a_bounded_tail():
+
+    result = run_streaming(python("for i in range(1000): print(i)\nraise SystemExit(3)"), tail_lines=5)
+
+    assert result.returncode == 3
+    assert result.tail == ["995", "996", "997", "998", "999"]
+    assert result.output.endswith("999")
+
+def test_run_streaming_stops_on_fatal_pattern():
+
+    start = time.perf_counter()
+    result = run_streaming(
+        python("import time\nprint('Error: UPGRADE FAILED: another operation (install/upgrade/rollback) is in progress', flush=True)\ntime.sleep(30)"),
+        patterns=fatal_patterns)
+
+    assert time.perf_counter() - start < 10
+    assert result.returncode != 0
+    assert "another operation" in result.fatal
+
+def test_run_streaming_reports_resource_usage():
+
+    result = run_streaming(python("data = bytearray(64 * 1024 * 1024)\nsum(range(2000000))\nraise SystemExit(2)"))
+
+    assert result.returncode == 2
+    assert result.cpu_seconds > 0
+    assert result.max_rss > 64 * 1024 * 1024
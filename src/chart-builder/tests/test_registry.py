@@ -0,0 +1,36 @@
+from chart.builder.modules.registry import ProviderRegistry, load_reference
+
+import pytest
+import sys
+
+def provider_module(tmp_path, monkeypatch, name: str) -> str:
+    (tmp_path / f"{name}.py").write_text(
+        "class Provider():\n"
+        "    def __init__(self, option=None):\n"
+        "        self.option = option\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    return f"{name}:Provider"
+
+def test_registry_imports_providers_on_first_use(tmp_path, monkeypatch):
+
+    registry = ProviderRegistry("chart_builder.tests", {"lazy": provider_module(tmp_path, monkeypatch, "lazy_provider")}, option=3)
+    assert "lazy_provider" not in sys.modules
+
+    provider = registry.get("lazy")
+
+    assert "lazy_provider" in sys.modules
+    assert provider.option == 3
+    assert registry.get("lazy") is provider
+
+def test_registry_rejects_unknown_providers():
+
+    registry = ProviderRegistry("chart_builder.tests", {"local": "collections:OrderedDict"})
+
+    with pytest.raises(KeyError):
+        registry.get("missing")
+    assert registry.names() == ["local"]
+
+def test_load_reference_follows_attributes():
+
+    assert load_reference("os.path:join") is __import__("os").path.join
+    assert load_reference("collections:OrderedDict.fromkeys") == __import__("collections").OrderedDict.fromkeys
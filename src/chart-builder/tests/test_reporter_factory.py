@@ -18,4 +18,14 @@ def test_local_reporter_factory(reporting_platform="local"):
 def test_invalid_reporter_factory(reporting_platform=None):
 
     reporter_client = ReportingServicesFactory().get(reporting_platform)
-    assert isinstance(reporter_client, ReportingServices)
\ No newline at end of file
+    assert isinstance(reporter_client, ReportingServices)
+def test_newrelic_counts_skipped_deployments_as_successful():
+
+    reporter_client = ReportingServicesFactory().get("newrelic")
+    submitted = []
+    reporter_client.delivery.submit = submitted.append
+
+    reporter_client.post_event(service="api", event_message="No changes since the last deployment, package manager skipped.", event_status="info", result="no-op")
+    reporter_client.post_event(service="api", result="deployed")
+
+    assert [(event["success"], event["result"]) for event in submitted] == [("1", "no-op"), ("1", "deployed")]
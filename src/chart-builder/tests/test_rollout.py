@@ -0,0 +1,135 @@
+from chart.builder.modules.packagemanager import HelmPackageManager
+from chart.builder.modules.rollout import RolloutWatcher, duration_seconds, pod_failure, workload_progress
+
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import json
+import os
+import stat
+import sys
+import time
+
+import pytest
+
+kubernetes = pytest.importorskip("kubernetes")
+models = kubernetes.client
+
+now = datetime.now(timezone.utc)
+
+def pod(name: str, reason: str=None, phase: str="Pending", created: datetime=now):
+    state = models.V1ContainerState(waiting=models.V1ContainerStateWaiting(reason=reason, message="back-off")) if reason else models.V1ContainerState()
+    return models.V1Pod(
+        metadata=models.V1ObjectMeta(name=name, creation_timestamp=created),
+        status=models.V1PodStatus(phase=phase, container_statuses=[
+            models.V1ContainerStatus(name="api", image="api", image_id="", ready=False, restart_count=0, state=state)]))
+
+def deployment(name: str, ready: int, replicas: int=2, updated: int=None, generation: int=2, observed: int=2, conditions: list=None):
+    return models.V1Deployment(
+        metadata=models.V1ObjectMeta(name=name, generation=generation),
+        spec=SimpleNamespace(replicas=replicas),
+        status=models.V1DeploymentStatus(observed_generation=observed, replicas=replicas, updated_replicas=replicas if updated is None else updated,
+            available_replicas=ready, conditions=conditions))
+
+def listed(*items):
+    return SimpleNamespace(items=list(items), metadata=SimpleNamespace(resource_version="1"))
+
+class ScriptedWatcher(RolloutWatcher):
+    """Watch events come from a script instead of the API server."""
+
+    def __init__(self, sources: dict, events: dict, **kwargs) -> None:
+        super().__init__(None, "api", "app.kubernetes.io/instance=api", sources=sources, **kwargs)
+        self.script = events
+
+    def _watch(self, list_func, resource_version, timeout_seconds):
+        kind = next(kind for kind, func in self.sources.items() if func is list_func)
+        for delay, event_type, item in self.script.pop(kind, []):
+            time.sleep(delay)
+            yield {"type": event_type, "object": item}
+        self.stopped.wait(timeout_seconds)
+
+def test_duration_seconds():
+
+    assert duration_seconds("5m0s") == 300
+    assert duration_seconds("1h30m") == 5400
+    assert duration_seconds("90s") == 90
+    assert duration_seconds(None) == 300
+
+def test_pod_failure():
+
+    assert pod_failure(pod("api-1", "ImagePullBackOff")) == 'container "api" ImagePullBackOff: back-off'
+    assert pod_failure(pod("api-1", "ContainerCreating")) is None
+    assert pod_failure(pod("api-1", "CrashLoopBackOff", created=now - timedelta(hours=1)), since=now - timedelta(seconds=5)) is None
+
+def test_workload_progress():
+
+    assert workload_progress("Deployment", deployment("api", ready=2)) == (2, 2, None)
+    assert workload_progress("Deployment", deployment("api", ready=2, observed=1)) == (0, 2, None)
+    assert workload_progress("Deployment", deployment("api", ready=2, updated=1)) == (1, 2, None)
+
+    daemon_set = models.V1DaemonSet(metadata=models.V1ObjectMeta(name="agent", generation=2), spec=SimpleNamespace(update_strategy=None),
+        status=models.V1DaemonSetStatus(observed_generation=2, desired_number_scheduled=3, updated_number_scheduled=2, number_available=3,
+            current_number_scheduled=3, number_misscheduled=0, number_ready=3))
+    assert workload_progress("DaemonSet", daemon_set) == (2, 3, None)
+    daemon_set.status.updated_number_scheduled = 3
+    assert workload_progress("DaemonSet", daemon_set) == (3, 3, None)
+
+    stuck = models.V1DeploymentCondition(type="Progressing", status="False", reason="ProgressDeadlineExceeded", message="timed out")
+    assert workload_progress("Deployment", deployment("api", ready=1, conditions=[stuck]))[2] == "timed out"
+
+def test_watcher_waits_for_readiness():
+    progress = []
+
+    watcher = ScriptedWatcher(
+        {"Deployment": lambda *args, **kwargs: listed(deployment("api", ready=0)), "Pod": lambda *args, **kwargs: listed()},
+        {"Deployment": [(0.05, "MODIFIED", deployment("api", ready=1)), (0.05, "MODIFIED", deployment("api", ready=2))]},
+        timeout=5, on_progress=lambda name, ready, desired: progress.append(ready))
+
+    assert watcher.wait() == {"Deployment/api": (2, 2)}
+    assert progress == [0, 1, 2]
+
+def test_watcher_fails_fast_on_terminal_pod():
+
+    watcher = ScriptedWatcher(
+        {"Deployment": lambda *args, **kwargs: listed(deployment("api", ready=0)), "Pod": lambda *args, **kwargs: listed(pod("api-1"))},
+        {"Pod": [(0.05, "MODIFIED", pod("api-1", "CrashLoopBackOff"))]},
+        timeout=30)
+
+    start = time.monotonic()
+    with pytest.raises(Exception, match='Pod "api-1" cannot start, container "api" CrashLoopBackOff'):
+        watcher.wait()
+    assert time.monotonic() - start < 5
+
+def test_watcher_times_out():
+
+    watcher = ScriptedWatcher({"Deployment": lambda *args, **kwargs: listed(deployment("api", ready=1))}, {}, timeout=0.2)
+
+    with pytest.raises(Exception, match="Deployment/api 1/2"):
+        watcher.wait()
+
+def test_watcher_passes_when_there_is_nothing_to_wait_for():
+
+    watcher = ScriptedWatcher({"Deployment": lambda *args, **kwargs: listed(), "Pod": lambda *args, **kwargs: listed()}, {}, timeout=30)
+
+    start = time.monotonic()
+    assert watcher.wait() == {}
+    assert time.monotonic() - start < 5
+
+@pytest.mark.parametrize("revisions, undo", [([1], "uninstall"), ([1, 2], "rollback")])
+def test_rollback_uninstalls_a_failed_first_install(tmp_path, monkeypatch, revisions, undo):
+
+    # A helm that reports the release's history and records every other command
+    helm = tmp_path / "helm"
+    helm.write_text(f"""#!{sys.executable}
+import json, sys
+if sys.argv[1] == "history":
+    print(json.dumps({json.dumps([{"revision": revision} for revision in revisions])}))
+else:
+    open({json.dumps(str(tmp_path / "commands"))}, "a").write(" ".join(sys.argv[1:3]) + "\\n")
+""")
+    helm.chmod(helm.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+    HelmPackageManager().rollback("api", "apps", path=str(tmp_path / "kubeconfig"))
+
+    assert (tmp_path / "commands").read_text().splitlines() == [f"{undo} api"]
@@ -0,0 +1,126 @@
+from chart.builder.modules.stages import Stage, StageExecutor, first_match
+
+import threading
+import time
+import pytest
+
+def test_stage_executor_respects_requirements():
+
+    order = []
+    executor = StageExecutor([
+        Stage("deploy", lambda: order.append("deploy"), requires=["namespace", "package"]),
+        Stage("namespace", lambda: order.append("namespace"), requires=["credentials"]),
+        Stage("credentials", lambda: order.append("credentials")),
+        Stage("package", lambda: order.append("package")),
+    ])
+    executor.run()
+
+    assert order.index("credentials") < order.index("namespace") < order.index("deploy")
+    assert order.index("package") < order.index("deploy")
+
+def test_stage_executor_runs_independent_stages_concurrently():
+
+    barrier = threading.Barrier(2, timeout=5)
+    executor = StageExecutor([
+        Stage("credentials", barrier.wait),
+        Stage("package", barrier.wait),
+    ])
+
+    # Both stages must be running at the same time for the barrier to release
+    executor.run()
+
+def test_stage_executor_passes_results():
+
+    executor = StageExecutor([
+        Stage("package", lambda: ["helm", "upgrade"]),
+        Stage("deploy", lambda: len(executor.results["package"]), requires=["package"]),
+    ])
+
+    assert executor.run()["deploy"] == 2
+
+def test_stage_executor_stops_on_failure():
+
+    def fail():
+        raise ValueError("credentials failed")
+
+    ran = []
+    executor = StageExecutor([
+        Stage("credentials", fail),
+        Stage("namespace", lambda: ran.append("namespace"), requires=["credentials"]),
+    ])
+
+    with pytest.raises(ValueError):
+        executor.run()
+    assert not ran
+
+def test_stage_executor_unknown_requirement():
+
+    with pytest.raises(Exception):
+        StageExecutor([Stage("deploy", lambda: None, requires=["package"])])
+
+
+def test_first_match_returns_matching_key_and_timings():
+
+    def fail():
+        raise RuntimeError("throttled")
+
+    match, results = first_match({"sub-1": lambda: False, "sub-2": fail, "sub-3": lambda: True})
+
+    assert match == "sub-3"
+    errors = {key: error for key, _, error in results}
+    assert isinstance(errors.get("sub-2", RuntimeError()), RuntimeError)
+
+def test_first_match_does_not_wait_for_slow_probes():
+
+    release = threading.Event()
+    start = time.perf_counter()
+    match, results = first_match({"slow": lambda: release.wait(5), "fast": lambda: True}, max_workers=2)
+    release.set()
+
+    assert match == "fast"
+    assert time.perf_counter() - start < 1
+    assert [key for key, _, _ in results] == ["fast"]
+
+def test_first_match_cancels_queued_probes():
+
+    probed = []
+
+    def probe(key):
+        probed.append(key)
+        time.sleep(0.05)
+        return key == "a"
+
+    match, _ = first_match({key: (lambda key=key: probe(key)) for key in "abcdef"}, max_workers=1)
+
+    assert match == "a"
+    assert len(probed) < 6
+
+def test_first_match_no_match():
+
+    match, results = first_match({"sub-1": lambda: False, "sub-2": lambda: False})
+    assert match is None
+    assert len(results) == 2
+
+def test_stage_executor_reports_progress():
+
+    events = []
+    executor = StageExecutor([
+        Stage("package", lambda: None),
+        Stage("deploy", lambda: 1 / 0, requires=["package"]),
+    ], on_stage=lambda name, state: events.append((name, state)))
+
+    with pytest.raises(ZeroDivisionError):
+        executor.run()
+
+    assert events == [("package", "started"), ("package", "finished"), ("deploy", "started"), ("deploy", "failed")]
+
+def test_stage_executor_times_stages():
+
+    executor = StageExecutor([
+        Stage("package", lambda: time.sleep(0.05)),
+        Stage("deploy", lambda: None, requires=["package"]),
+    ])
+    executor.run()
+
+    assert executor.durations["package"] >= 0.05
+    assert set(executor.durations) == {"package", "deploy"}
@@ -0,0 +1,96 @@
+from chart.builder.modules.tracing import Tracer, export_spans, propagate, span, traced, tracer
+
+from concurrent.futures import ThreadPoolExecutor
+
+import json
+import pytest
+
+def test_spans_nest_across_threads():
+
+    def stage():
+        with span("stage.package") as current:
+            return current
+
+    with span("deploy", release="api", cluster="aks-1") as deployment:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            child = executor.submit(propagate(stage)).result()
+
+    assert child.trace_id == deployment.trace_id
+    assert child.parent_id == deployment.span_id
+    assert deployment.parent_id is None
+
+def test_span_records_failures():
+
+    with pytest.raises(ValueError):
+        with span("helm.upgrade") as current:
+            raise ValueError("boom")
+
+    assert current.error == "boom"
+    assert current.seconds >= 0
+
+def test_traced_client_times_each_call():
+
+    class Api():
+        version = "v1"
+
+        def list_namespace(self, selector=None):
+            return [selector]
+
+    api = traced(Api(), "kubernetes")
+
+    assert api.list_namespace(selector="metadata.name=apps") == ["metadata.name=apps"]
+    assert api.version == "v1"
+    assert tracer.spans("kubernetes.list_namespace")[-1].kind == "client"
+
+def test_otlp_export(tmp_path):
+
+    with span("deploy", release="api", cluster="aks-1"):
+        with span("stage.deploy"):
+            pass
+    export_spans(trace_file=str(tmp_path / "trace.json"))
+
+    spans = json.loads((tmp_path / "trace.json").read_text())["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    stage = [item for item in spans if item["name"] == "stage.deploy"][-1]
+    parent = [item for item in spans if item["spanId"] == stage["parentSpanId"]][0]
+
+    assert parent["name"] == "deploy"
+    assert {"key": "release", "value": {"stringValue": "api"}} in parent["attributes"]
+    assert int(stage["endTimeUnixNano"]) >= int(stage["startTimeUnixNano"])
+    assert stage["status"] == {"code": 1}
+
+def test_prometheus_export_labels_stages_with_their_deployment(monkeypatch):
+
+    local = Tracer()
+    monkeypatch.setattr("chart.builder.modules.tracing.tracer", local)
+
+    with span("deploy", release="api", cluster="aks-1"):
+        with span("stage.credentials"):
+            pass
+        with span("helm.upgrade") as helm:
+            helm.set(**{"process.cpu_seconds": 1.5, "process.max_rss_bytes": 1024})
+
+    text = local.prometheus()
+
+    assert 'chart_builder_span_seconds_count{span="stage.credentials"} 1' in text
+    assert 'chart_builder_stage_seconds{release="api",cluster="aks-1",stage="credentials"}' in text
+    assert 'chart_builder_helm_cpu_seconds{release="api",cluster="aks-1"} 1.5' in text
+    assert 'chart_builder_helm_max_rss_bytes{release="api",cluster="aks-1"} 1024' in text
+
+def test_prometheus_totals_outlive_the_span_buffer(monkeypatch):
+
+    local = Tracer(max_spans=10)
+    monkeypatch.setattr("chart.builder.modules.tracing.tracer", local)
+
+    for _ in range(25):
+        with span("deploy", release="api", cluster="aks-1"):
+            with span("azure.token", cache="hit"):
+                pass
+            with span("stage.deploy"):
+                pass
+
+    text = local.prometheus()
+
+    assert len(local.spans()) == 10
+    assert 'chart_builder_span_seconds_count{span="deploy"} 25' in text
+    assert 'chart_builder_azure_token_cache_total{result="hit"} 25' in text
+    assert 'chart_builder_stage_seconds{release="api",cluster="aks-1",stage="deploy"}' in text